@@ -2,22 +2,24 @@
 Provide functionality to listen for commands from a microphone with PyAudio and webrtcvad.
 """
 import logging
-import os
 import math
 import asyncio
-import wave
 import threading
-import requests
-import io
+import time
 
 import voluptuous as vol
 
 from homeassistant.const import CONF_NAME
 from homeassistant.helpers import intent, config_validation as cv
 
+from .microphone_hub import get_microphone_hub
+from .rhasspy_audio import (
+    RingBuffer, FrameQueue, WavBuffer, encode_audio, CODEC_CONTENT_TYPE,
+    Endpointer, PHRASE_START, PHRASE_CONTINUE, PHRASE_END, PHRASE_TIMEOUT)
+
 _LOGGER = logging.getLogger(__name__)
 
-REQUIREMENTS = ['PyAudio==0.2.8', 'webrtcvad==2.0.10']
+REQUIREMENTS = ['PyAudio==0.2.8', 'webrtcvad==2.0.10', 'numpy==1.14.5']
 
 DOMAIN = 'command_listener'
 
@@ -56,11 +58,41 @@ CONF_SILENCE_SEC = 'silence_sec'
 # Total number of seconds to record before timing out (defaults to 30 seconds).
 CONF_TIMEOUT_SEC = 'timeout_sec'
 
+# Number of seconds of audio from *before* speech is detected to include in
+# the recording (defaults to 0.3 seconds). Keeps the first syllable from being
+# cut off when speaking right after the hotword.
+CONF_PREROLL_SEC = 'preroll_sec'
+
 # URL to POST recorded WAV data to when finished recording.
 # This will probably be something like http://server:8123/api/stt_pocketsphinx
 # if you're using stt_pocketsphinx on a server.
 CONF_URL = 'url'
 
+# True if audio should be streamed to the URL while the command is still
+# being recorded (defaults to False). The upload starts as soon as speech is
+# detected, and is sent as raw PCM with rate/width/channels query parameters.
+# Use http://server:8123/api/stt_pocketsphinx/stream for the URL, so the
+# server decodes while you speak. If the stream fails before all of the audio
+# was sent, the recording is POSTed as WAV data to the URL without /stream.
+CONF_STREAM_UPLOAD = 'stream_upload'
+
+# Compression used when POSTing recorded audio (defaults to 'none').
+# 'none' sends a WAV file.
+# 'delta' sends losslessly compressed audio (about 1/3 the size of a WAV file
+# for speech). Only stt_pocketsphinx's main endpoint understands it.
+# Streaming uploads are never compressed.
+CONF_COMPRESSION = 'compression'
+
+# Seconds to wait for the server to accept recorded audio (defaults to 10).
+CONF_UPLOAD_TIMEOUT_SEC = 'upload_timeout_sec'
+
+# Number of times to retry a failed upload (defaults to 2).
+# Waits 0.5, 1, 2, ... seconds between attempts. Only uploads that couldn't
+# connect to the server are retried. Once the audio may have been sent, a
+# retry could decode the command twice, so timeouts and error responses are
+# not retried.
+CONF_UPLOAD_RETRIES = 'upload_retries'
+
 # ----------------------
 # Configuration defaults
 # ----------------------
@@ -77,8 +109,22 @@ DEFAULT_VAD_MODE = 0         # 0-3 (aggressiveness)
 DEFAULT_MIN_SEC = 2.0        # min seconds that command must last
 DEFAULT_SILENCE_SEC = 0.5    # min seconds of silence after command
 DEFAULT_TIMEOUT_SEC = 30.0   # max seconds that command can last
+DEFAULT_PREROLL_SEC = 0.3    # seconds of audio to keep before speech
 
 DEFAULT_URL = None           # Use URL from service request
+DEFAULT_STREAM_UPLOAD = False
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_DELTA = 'delta'
+DEFAULT_COMPRESSION = COMPRESSION_NONE
+DEFAULT_UPLOAD_TIMEOUT_SEC = 10.0
+DEFAULT_UPLOAD_RETRIES = 2
+
+# Seconds to wait before the first retry (doubled after each attempt)
+UPLOAD_RETRY_DELAY_SEC = 0.5
+
+# Removed from a streaming URL to get the URL for POSTing a whole recording
+STREAM_URL_SUFFIX = '/stream'
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
@@ -94,8 +140,15 @@ CONFIG_SCHEMA = vol.Schema({
         vol.Optional(CONF_MIN_SEC, DEFAULT_MIN_SEC): float,
         vol.Optional(CONF_SILENCE_SEC, DEFAULT_SILENCE_SEC): float,
         vol.Optional(CONF_TIMEOUT_SEC, DEFAULT_TIMEOUT_SEC): float,
-
-        vol.Optional(CONF_URL, DEFAULT_URL): cv.string
+        vol.Optional(CONF_PREROLL_SEC, DEFAULT_PREROLL_SEC): float,
+
+        vol.Optional(CONF_URL, DEFAULT_URL): cv.string,
+        vol.Optional(CONF_STREAM_UPLOAD, DEFAULT_STREAM_UPLOAD): cv.boolean,
+        vol.Optional(CONF_COMPRESSION, DEFAULT_COMPRESSION):
+            vol.In([COMPRESSION_NONE, COMPRESSION_DELTA]),
+        vol.Optional(CONF_UPLOAD_TIMEOUT_SEC, DEFAULT_UPLOAD_TIMEOUT_SEC): float,
+        vol.Optional(CONF_UPLOAD_RETRIES, DEFAULT_UPLOAD_RETRIES):
+            vol.All(int, vol.Range(min=0))
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -135,7 +188,12 @@ class CommandListener(object):
     import webrtcvad
 
     def __init__(self, device_index, sample_rate, sample_width, channels,
-                 chunk_size, vad_mode, min_sec, silence_sec, timeout_sec):
+                 chunk_size, vad_mode, min_sec, silence_sec, timeout_sec,
+                 preroll_sec=DEFAULT_PREROLL_SEC, session=None,
+                 stream_upload=DEFAULT_STREAM_UPLOAD,
+                 compression=DEFAULT_COMPRESSION,
+                 upload_timeout_sec=DEFAULT_UPLOAD_TIMEOUT_SEC,
+                 upload_retries=DEFAULT_UPLOAD_RETRIES):
         self._logger = logging.getLogger(__name__)
 
         self._device_index = device_index
@@ -149,147 +207,340 @@ class CommandListener(object):
         self._silence_sec = silence_sec
         self._timeout_sec = timeout_sec
 
-        self._seconds_per_buffer = self._chunk_size / self._sample_rate
-        self._max_buffers = int(math.ceil(self._timeout_sec / self._seconds_per_buffer))
+        # aiohttp session (shared, keeps connections to the server alive)
+        self._session = session
+        self._stream_upload = stream_upload
+        self._compression = compression
+        self._upload_timeout_sec = upload_timeout_sec
+        self._upload_retries = upload_retries
 
-        self._vad = None
-        self._audio = None
+        # Audio from just before speech starts (preallocated)
+        bytes_per_sec = sample_rate * sample_width * channels
+        preroll_size = int(preroll_sec * sample_rate) * sample_width * channels
+        self._preroll = RingBuffer(preroll_size)
 
-    @asyncio.coroutine
-    def async_listen(self, filename=None, url=None):
-        import pyaudio
-
-        if self._vad is None:
-            import webrtcvad
-            self._vad = webrtcvad.Vad()
-            self._vad.set_mode(self._vad_mode)
+        # Recorded command (allocated once and reused). Room for the timeout,
+        # pre-roll, and one extra chunk in case the chunk size doesn't divide
+        # evenly into the timeout.
+        max_bytes = int(math.ceil(timeout_sec * bytes_per_sec)) + preroll_size + \
+            (chunk_size * sample_width * channels)
+        self._recording = WavBuffer(max_bytes, sample_rate, sample_width, channels)
 
-        recorded_data = []
-        finished_event = threading.Event()
-
-        # Recording state
-        max_buffers = int(math.ceil(self._timeout_sec / self._seconds_per_buffer))
-        silence_buffers = int(math.ceil(self._silence_sec / self._seconds_per_buffer))
-        min_phrase_buffers = int(math.ceil(self._min_sec / self._seconds_per_buffer))
-        in_phrase = False
-        after_phrase = False
-        finished = False
-
-        # PyAudio callback function
-        def stream_callback(data, frame_count, time_info, status):
-            nonlocal max_buffers, silence_buffers, min_phrase_buffers
-            nonlocal in_phrase, after_phrase
-            nonlocal recorded_data, finished
-
-            # Check maximum number of seconds to record
-            max_buffers -= 1
-            if max_buffers <= 0:
-                # Timeout
-                finished = True
-
-                # Reset
-                in_phrase = False
-                after_phrase = False
-
-            # Detect speech in chunk
-            is_speech = self._vad.is_speech(data, self._sample_rate)
-            if is_speech and not in_phrase:
-                # Start of phrase
-                in_phrase = True
-                after_phrase = False
-                recorded_data = data
-                min_phrase_buffers = int(math.ceil(self._min_sec / self._seconds_per_buffer))
-            elif in_phrase and (min_phrase_buffers > 0):
-                # In phrase, before minimum seconds
-                recorded_data += data
-                min_phrase_buffers -= 1
-            elif in_phrase and is_speech:
-                # In phrase, after minimum seconds
-                recorded_data += data
-            elif not is_speech:
-                # Outside of speech
-                if after_phrase and (silence_buffers > 0):
-                    # After phrase, before stop
-                    recorded_data += data
-                    silence_buffers -= 1
-                elif after_phrase and (silence_buffers <= 0):
-                    # Phrase complete
-                    recorded_data += data
-                    finished = True
-
-                    # Reset
-                    in_phrase = False
-                    after_phrase = False
-                elif in_phrase and (min_phrase_buffers <= 0):
-                    # Transition to after phrase
-                    after_phrase = True
-                    silence_buffers = int(math.ceil(self._silence_sec / self._seconds_per_buffer))
-
-            if finished:
-                finished_event.set()
+        # Audio callback statistics from the last recording
+        self.stats = {}
 
-            return (data, pyaudio.paContinue)
+        # Statistics from the last upload
+        self.upload_stats = {}
 
-        # -----------------------------------------------------------------
+    @property
+    def sample_rate(self):
+        return self._sample_rate
 
-        # Open microphone device
-        audio = pyaudio.PyAudio()
-        device_index = None
-        if self._device_index >= 0:
-            device_index = self._device_index
+    @property
+    def sample_width(self):
+        return self._sample_width
 
-        data_format = pyaudio.get_format_from_width(self._sample_width)
+    @property
+    def channels(self):
+        return self._channels
 
-        mic = audio.open(format=data_format,
-                            channels=self._channels,
-                            rate=self._sample_rate,
-                            input_device_index=device_index,
-                            input=True,
-                            stream_callback=stream_callback,
-                            frames_per_buffer=self._chunk_size)
+    @asyncio.coroutine
+    def async_listen(self, filename=None, url=None, hub=None):
+        """Records a command, reading from hub (a MicrophoneHub) if given."""
+        import pyaudio
 
         loop = asyncio.get_event_loop()
-        # Start listening
-        self._logger.debug('Listening')
-        mic.start_stream()
+        recorded_data = self._recording
+        recorded_data.clear()
+        finished_event = threading.Event()
 
-        yield from loop.run_in_executor(None, finished_event.wait)
+        # Upload while recording
+        stream_upload = self._stream_upload and (url is not None) and (filename is None)
+        upload_chunks = asyncio.Queue()
+        upload_progress = { 'sent': False, 'responded': False }
+        upload_task = None
+
+        def start_upload():
+            nonlocal upload_task
+            upload_task = loop.create_task(
+                self.async_stream_post(url, upload_chunks, upload_progress))
+
+        def record(data, start=False):
+            """Adds audio to the recording (and upload if streaming)."""
+            if start:
+                recorded_data.clear()
+
+            recorded_data.append(data)
+            if stream_upload and (len(data) > 0):
+                if start:
+                    loop.call_soon_threadsafe(start_upload)
+
+                loop.call_soon_threadsafe(upload_chunks.put_nowait, bytes(data))
+
+        preroll = self._preroll
+        preroll.clear()
+
+        chunk_size = self._chunk_size if hub is None else hub.chunk_size
+        endpointer = Endpointer(self._vad_mode, self._sample_rate, chunk_size,
+                                self._min_sec, self._silence_sec,
+                                self._timeout_sec)
+
+        # Called for each buffer from audio device (outside of the PyAudio
+        # callback, so VAD doesn't hold up the audio thread).
+        def process_buffer(data):
+            if endpointer.finished:
+                # Ignore audio until the stream is stopped
+                return
+
+            result = endpointer.process(data)
+            if result == PHRASE_START:
+                # Include audio from just before speech
+                record(preroll.read_last() + data, start=True)
+            elif (result in [PHRASE_CONTINUE, PHRASE_END]) or \
+                 ((result == PHRASE_TIMEOUT) and endpointer.in_phrase):
+                record(data)
+            else:
+                # Keep recent audio in case speech starts in the next buffer
+                preroll.write(data)
+
+            if endpointer.finished:
+                finished_event.set()
+
+        # -----------------------------------------------------------------
 
-        # Stop listening and clean up
-        mic.stop_stream()
-        mic.close()
-        audio.terminate()
+        if hub is not None:
+            # Read from shared microphone
+            subscription = hub.subscribe()
+
+            def read_hub():
+                while not finished_event.is_set():
+                    data = subscription.get()
+                    if data is None:
+                        break
+
+                    process_buffer(data)
+
+            self._logger.debug('Listening (shared microphone)')
+            thread = threading.Thread(target=read_hub, daemon=True)
+            thread.start()
+
+            yield from loop.run_in_executor(None, finished_event.wait)
+            subscription.close()
+        else:
+            # Open microphone device
+            audio = pyaudio.PyAudio()
+            device_index = None
+            if self._device_index >= 0:
+                device_index = self._device_index
+
+            data_format = pyaudio.get_format_from_width(self._sample_width)
+
+            # PyAudio callback only queues buffers for process_buffer
+            frame_queue = FrameQueue(process_buffer,
+                                     continue_flag=pyaudio.paContinue,
+                                     overflow_flag=pyaudio.paInputOverflow)
+
+            mic = audio.open(format=data_format,
+                             channels=self._channels,
+                             rate=self._sample_rate,
+                             input_device_index=device_index,
+                             input=True,
+                             stream_callback=frame_queue.callback,
+                             frames_per_buffer=self._chunk_size)
+
+            # Start listening
+            self._logger.debug('Listening')
+            frame_queue.start()
+            mic.start_stream()
+
+            yield from loop.run_in_executor(None, finished_event.wait)
+
+            # Stop listening and clean up
+            mic.stop_stream()
+            mic.close()
+            audio.terminate()
+            frame_queue.stop()
+
+            self.stats = frame_queue.stats
 
         self._logger.debug('Stopped listening')
         self._logger.info('Recorded %s byte(s) of audio' % len(recorded_data))
 
+        if recorded_data.dropped > 0:
+            self._logger.warning('Dropped %s byte(s) of audio' % recorded_data.dropped)
+
         if filename is not None:
             # Write WAV data to file system
-            with wave.open(filename, mode='wb') as wav_file:
-                wav_file.setframerate(self._sample_rate)
-                wav_file.setsampwidth(self._sample_width)
-                wav_file.setnchannels(self._channels)
-                wav_file.writeframesraw(recorded_data)
+            with open(filename, 'wb') as wav_file:
+                wav_file.write(recorded_data.wav())
         elif url is not None:
-            # POST WAV data to URL
-            with io.BytesIO() as wav_data:
-                with wave.open(wav_data, mode='wb') as wav_file:
-                    wav_file.setframerate(self._sample_rate)
-                    wav_file.setsampwidth(self._sample_width)
-                    wav_file.setnchannels(self._channels)
-                    wav_file.writeframesraw(recorded_data)
+            if upload_task is not None:
+                # Finish streaming upload (cancelled on timeout)
+                upload_chunks.put_nowait(None)
+                try:
+                    success = yield from asyncio.wait_for(
+                        upload_task, self._upload_timeout_sec)
+                except asyncio.TimeoutError:
+                    self._logger.error('Timed out streaming to %s' % url)
+                    success = False
+                    self.upload_stats = {
+                        'upload_sec': self._upload_timeout_sec,
+                        'upload_bytes': 0,
+                        'upload_attempts': 1,
+                        'upload_ok': False
+                    }
+
+                if success:
+                    return
+
+                if upload_progress['sent'] or upload_progress['responded']:
+                    # Server may have decoded the command already, so
+                    # sending it again could fire speech_to_text twice.
+                    self._logger.warning('Streaming upload failed after all audio was sent. Not resending.')
+                    return
+
+                # POST WAV data to the non-streaming endpoint (the stream
+                # endpoint only accepts raw PCM).
+                self._logger.warning('Streaming upload failed. Sending recording instead.')
+                post_url = url.rstrip('/')
+                if post_url.endswith(STREAM_URL_SUFFIX):
+                    post_url = post_url[:-len(STREAM_URL_SUFFIX)]
+
+                yield from self.async_post(post_url, recorded_data.wav(),
+                                           { 'Content-Type': 'audio/wav' })
+                return
+
+            if self._compression == COMPRESSION_DELTA:
+                # POST compressed audio to URL
+                encoded_data = yield from loop.run_in_executor(
+                    None, encode_audio, recorded_data.frames,
+                    self._sample_rate, self._sample_width, self._channels)
+
+                yield from self.async_post(url, encoded_data,
+                                           { 'Content-Type': CODEC_CONTENT_TYPE })
+            else:
+                # POST WAV data to URL (straight from the recording buffer)
+                yield from self.async_post(url, recorded_data.wav(),
+                                           { 'Content-Type': 'audio/wav' })
 
-                wav_data.seek(0)
-                requests.post(url, data=wav_data,
-                              headers={ 'Content-Type': 'audio/wav' },
-                              timeout=10)
+    @asyncio.coroutine
+    def async_stream_post(self, url, chunks, progress):
+        """POSTs raw PCM chunks from an asyncio.Queue as they arrive (until None).
+
+        Sets progress['sent'] once all chunks are written, and
+        progress['responded'] once the server responds.
+        Returns True if the server accepted the data.
+        """
+        import aiohttp
+
+        num_bytes = 0
+        end_time = None
+
+        @aiohttp.streamer
+        def send_chunks(writer):
+            nonlocal num_bytes, end_time
+            while True:
+                chunk = yield from chunks.get()
+                if chunk is None:
+                    break
+
+                yield from writer.write(chunk)
+                num_bytes += len(chunk)
+
+            end_time = time.time()
+            progress['sent'] = True
+
+        params = {
+            'rate': self._sample_rate,
+            'width': self._sample_width,
+            'channels': self._channels
+        }
+
+        start_time = time.time()
+        try:
+            response = yield from self._session.post(
+                url, data=send_chunks(), params=params,
+                headers={ 'Content-Type': 'application/octet-stream' })
+
+            progress['responded'] = True
+            try:
+                response.raise_for_status()
+            finally:
+                yield from response.release()
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            self._logger.error('Failed to stream to %s: %s' % (url, e))
+            return False
+
+        # Time from end of recording to server response
+        upload_sec = time.time() - (end_time or start_time)
+        self.upload_stats = {
+            'upload_sec': round(upload_sec, 3),
+            'upload_bytes': num_bytes,
+            'upload_attempts': 1,
+            'upload_ok': True,
+            'stream_sec': round(time.time() - start_time, 3)
+        }
+
+        self._logger.debug('Streamed %s byte(s) to %s' % (num_bytes, url))
+        return True
 
-                self._logger.debug('POSTed %s byte(s) to' % url)
+    @asyncio.coroutine
+    def async_post(self, url, data, headers):
+        """POSTs data without blocking the event loop.
+
+        Retries only if the connection failed (nothing was sent). Returns True
+        if the server accepted the data.
+        """
+        import aiohttp
+        import async_timeout
+
+        start_time = time.time()
+        attempts = 0
+        success = False
+
+        while not success:
+            attempts += 1
+            try:
+                with async_timeout.timeout(self._upload_timeout_sec):
+                    response = yield from self._session.post(
+                        url, data=data, headers=headers)
+
+                    try:
+                        response.raise_for_status()
+                    finally:
+                        yield from response.release()
+
+                success = True
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                # The server may already have the audio (and be decoding it)
+                sent = not isinstance(e, aiohttp.ClientConnectorError)
+                if sent or (attempts > self._upload_retries):
+                    self._logger.error('Failed to POST to %s: %s' % (url, e))
+                    break
+
+                delay_sec = UPLOAD_RETRY_DELAY_SEC * (2 ** (attempts - 1))
+                self._logger.warning('POST to %s failed (%s). Retrying in %s second(s).' % (url, e, delay_sec))
+                yield from asyncio.sleep(delay_sec)
+
+        upload_sec = time.time() - start_time
+        self.upload_stats = {
+            'upload_sec': round(upload_sec, 3),
+            'upload_bytes': len(data),
+            'upload_attempts': attempts,
+            'upload_ok': success
+        }
+
+        if success:
+            self._logger.debug('POSTed %s byte(s) to %s in %s second(s)' % (len(data), url, upload_sec))
+
+        return success
 
 # -----------------------------------------------------------------------------
 
 @asyncio.coroutine
 def async_setup(hass, config):
+    from homeassistant.helpers.aiohttp_client import async_get_clientsession
+
     name = config[DOMAIN].get(CONF_NAME, DEFAULT_NAME)
 
     # Create listener
@@ -303,7 +554,13 @@ def async_setup(hass, config):
         config[DOMAIN].get(CONF_VAD_MODE, DEFAULT_VAD_MODE),
         config[DOMAIN].get(CONF_MIN_SEC, DEFAULT_MIN_SEC),
         config[DOMAIN].get(CONF_SILENCE_SEC, DEFAULT_SILENCE_SEC),
-        config[DOMAIN].get(CONF_TIMEOUT_SEC, DEFAULT_TIMEOUT_SEC))
+        config[DOMAIN].get(CONF_TIMEOUT_SEC, DEFAULT_TIMEOUT_SEC),
+        config[DOMAIN].get(CONF_PREROLL_SEC, DEFAULT_PREROLL_SEC),
+        session=async_get_clientsession(hass),
+        stream_upload=config[DOMAIN].get(CONF_STREAM_UPLOAD, DEFAULT_STREAM_UPLOAD),
+        compression=config[DOMAIN].get(CONF_COMPRESSION, DEFAULT_COMPRESSION),
+        upload_timeout_sec=config[DOMAIN].get(CONF_UPLOAD_TIMEOUT_SEC, DEFAULT_UPLOAD_TIMEOUT_SEC),
+        upload_retries=config[DOMAIN].get(CONF_UPLOAD_RETRIES, DEFAULT_UPLOAD_RETRIES))
 
     url = config[DOMAIN].get(CONF_URL, DEFAULT_URL)
 
@@ -320,7 +577,14 @@ def async_setup(hass, config):
         hass.states.async_set(OBJECT_MICROPHONE, STATE_RECORDING, state_attrs)
         filename = call.data.get(ATTR_FILENAME)
         url = call.data.get(ATTR_URL, url)
-        yield from hass.data[DOMAIN].async_listen(filename=filename, url=url)
+
+        listener = hass.data[DOMAIN]
+        hub = get_microphone_hub(hass, listener.sample_rate,
+                                 listener.sample_width, listener.channels)
+
+        yield from listener.async_listen(filename=filename, url=url, hub=hub)
+        state_attrs.update(listener.stats)
+        state_attrs.update(listener.upload_stats)
         hass.states.async_set(OBJECT_MICROPHONE, STATE_IDLE, state_attrs)
 
         # Fire recorded event
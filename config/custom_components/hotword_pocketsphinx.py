@@ -11,9 +11,14 @@ import voluptuous as vol
 from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import intent, config_validation as cv
 
+from .microphone_hub import get_microphone_hub
+from .rhasspy_audio import (
+    SpeechGate, DEFAULT_GATE_ENERGY, KEYPHRASE_PHRASE, KEYPHRASE_THRESHOLD,
+    get_keyphrases, set_keyphrases)
+
 _LOGGER = logging.getLogger(__name__)
 
-REQUIREMENTS = ['pocketsphinx==0.1.15']
+REQUIREMENTS = ['pocketsphinx==0.1.15', 'webrtcvad==2.0.10', 'numpy==1.14.5']
 
 DOMAIN = 'hotword_pocketsphinx'
 
@@ -31,11 +36,20 @@ CONF_DICTIONARY = 'dictionary'
 
 # Word or phrase to use for hot/wake word.
 # CMU recommends this be 3-4 syllables long.
+# Not used with shared_decoder (set hotword in stt_pocketsphinx instead).
+#
+# May also be a list of hotwords, each with its own threshold. They are all
+# spotted by the same decoder in a single pass:
+#
+# hotword:
+#   - phrase: okay rhasspy
+#     threshold: 1e-30
+#   - phrase: hey computer
 CONF_HOTWORD = 'hotword'
 
 # Likelihood of hotword occuring (tune to lower false positive rate).
 # CMU recommends this be in the range 1e-50 to 1e-5.
-# Defaults to 1e-40.
+# Defaults to 1e-40. Used for hotwords without their own threshold.
 CONF_THRESHOLD = 'threshold'
 
 # Name of the audio device to record on.
@@ -57,6 +71,19 @@ CONF_SAMPLE_RATE = 'sample_rate'
 # Size of recording buffer (defaults to 2048).
 CONF_BUFFER_SIZE = 'buffer_size'
 
+# True if the hotword should be spotted with a decoder from stt_pocketsphinx
+# (defaults to False). The acoustic model and dictionary are then only loaded
+# once, and each decoder switches between the hotword and command searches.
+# Requires hotword to be set for stt_pocketsphinx.
+CONF_SHARED_DECODER = 'shared_decoder'
+
+# True if audio should only be decoded when it's loud enough and webrtcvad
+# thinks it contains speech (defaults to False). Saves CPU in quiet rooms.
+CONF_SPEECH_GATE = 'speech_gate'
+
+# Minimum RMS energy of audio before webrtcvad is checked (defaults to 100).
+CONF_GATE_ENERGY = 'gate_energy'
+
 # ----------------------
 # Configuration defaults
 # ----------------------
@@ -69,12 +96,20 @@ DEFAULT_THRESHOLD = 1e-40  # 1e-50 to 1e-5 recommended
 DEFAULT_AUDIO_DEVICE = None
 DEFAULT_SAMPLE_RATE = 16000
 DEFAULT_BUFFER_SIZE = 2048
+DEFAULT_SHARED_DECODER = False
+DEFAULT_SPEECH_GATE = False
+
+# One hotword or a list of hotwords with thresholds (see get_keyphrases)
+KEYPHRASES_SCHEMA = vol.Any(cv.string, [vol.Schema({
+    vol.Required(KEYPHRASE_PHRASE): cv.string,
+    vol.Optional(KEYPHRASE_THRESHOLD): float
+})])
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Optional(CONF_NAME, DEFAULT_NAME): cv.string,
 
-        vol.Required(CONF_HOTWORD): cv.string,
+        vol.Optional(CONF_HOTWORD): KEYPHRASES_SCHEMA,
         vol.Optional(CONF_ACOUSTIC_MODEL, DEFAULT_ACOUSTIC_MODEL): cv.string,
         vol.Optional(CONF_DICTIONARY, DEFAULT_DICTIONARY): cv.string,
         vol.Optional(CONF_THRESHOLD, DEFAULT_THRESHOLD): float,
@@ -82,7 +117,10 @@ CONFIG_SCHEMA = vol.Schema({
 
         vol.Optional(CONF_AUDIO_DEVICE, DEFAULT_AUDIO_DEVICE): cv.string,
         vol.Optional(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE): int,
-        vol.Optional(CONF_BUFFER_SIZE, DEFAULT_BUFFER_SIZE): int
+        vol.Optional(CONF_BUFFER_SIZE, DEFAULT_BUFFER_SIZE): int,
+        vol.Optional(CONF_SHARED_DECODER, DEFAULT_SHARED_DECODER): cv.boolean,
+        vol.Optional(CONF_SPEECH_GATE, DEFAULT_SPEECH_GATE): cv.boolean,
+        vol.Optional(CONF_GATE_ENERGY, DEFAULT_GATE_ENERGY): float
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -104,6 +142,9 @@ STATE_LISTENING = 'listening'
 # Fired when the hotword is detected
 EVENT_HOTWORD_DETECTED = 'hotword_detected'
 
+# Name of the keyword spotting search
+SEARCH_HOTWORD = 'hotword'
+
 # -----------------------------------------------------------------------------
 @asyncio.coroutine
 def async_setup(hass, config):
@@ -116,20 +157,36 @@ def async_setup(hass, config):
     audio_device_str = config[DOMAIN].get(CONF_AUDIO_DEVICE, DEFAULT_AUDIO_DEVICE)
     sample_rate = config[DOMAIN].get(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE)
     buffer_size = config[DOMAIN].get(CONF_BUFFER_SIZE, DEFAULT_BUFFER_SIZE)
+    shared_decoder = config[DOMAIN].get(CONF_SHARED_DECODER, DEFAULT_SHARED_DECODER)
+    speech_gate = config[DOMAIN].get(CONF_SPEECH_GATE, DEFAULT_SPEECH_GATE)
+    gate_energy = config[DOMAIN].get(CONF_GATE_ENERGY, DEFAULT_GATE_ENERGY)
 
     detected_event = threading.Event()
     detected_phrase = None
     terminated = False
 
     from pocketsphinx import Pocketsphinx, Ad
-    decoder = Pocketsphinx(
-        hmm=acoustic_model,
-        lm=False,
-        dic=dictionary,
-        keyphrase=hotword,
-        kws_threshold=threshold)
-
-    audio_device = Ad(audio_device_str, sample_rate)
+    if shared_decoder:
+        # Decoders are leased from stt_pocketsphinx for each listen
+        decoder = None
+        hotwords = None
+    elif hotword is None:
+        _LOGGER.error('%s is required unless %s is set' % (CONF_HOTWORD, CONF_SHARED_DECODER))
+        return False
+    else:
+        decoder = Pocketsphinx(
+            hmm=acoustic_model,
+            lm=False,
+            dic=dictionary)
+
+        keyphrases = get_keyphrases(hotword, threshold)
+        set_keyphrases(decoder, SEARCH_HOTWORD, keyphrases)
+        decoder.set_search(SEARCH_HOTWORD)
+
+        hotwords = set(phrase for phrase, _ in keyphrases)
+
+    # Opened on first use (not needed with microphone_hub)
+    audio_device = None
 
     state_attrs = {
         'friendly_name': 'Hotword',
@@ -138,42 +195,106 @@ def async_setup(hass, config):
 
     @asyncio.coroutine
     def async_listen(call):
-        nonlocal terminated, detected_phrase
+        nonlocal terminated, detected_phrase, audio_device
         terminated = False
         detected_phrase = None
 
         hass.states.async_set(OBJECT_DECODER, STATE_LISTENING, state_attrs)
 
-        def listen():
+        pool = None
+        if shared_decoder:
+            # Only needed (and loaded) with shared_decoder
+            from .stt_pocketsphinx import DOMAIN as STT_DOMAIN, SEARCH_KWS
+
+            pool = hass.data.get(STT_DOMAIN)
+            if pool is None:
+                _LOGGER.error('No shared decoder. Set %s for %s.' % (CONF_HOTWORD, STT_DOMAIN))
+                hass.states.async_set(OBJECT_DECODER, STATE_IDLE, state_attrs)
+                return
+
+        # Use shared microphone if available (16-bit mono)
+        hub = get_microphone_hub(hass, sample_rate, 2, 1)
+        if (hub is None) and (audio_device is None):
+            audio_device = Ad(audio_device_str, sample_rate)
+
+        # Skips the decoder when there's no speech
+        gate = None
+        if speech_gate:
+            gate = SpeechGate(sample_rate, energy_threshold=gate_energy)
+
+        def process(decoder, buf):
+            if gate is None:
+                return decode(decoder, buf)
+
+            for gated_buf in gate.process(buf):
+                if decode(decoder, gated_buf):
+                    return True
+
+            return False
+
+        def decode(decoder, buf):
+            nonlocal detected_phrase
+            decoder.process_raw(buf, False, False)
+            hyp = decoder.hyp()
+            if hyp:
+                with decoder.end_utterance():
+                    # Make sure a hotword is matched (any keyphrase from
+                    # the shared search)
+                    detected_phrase = hyp.hypstr.strip()
+                    if shared_decoder or (detected_phrase in hotwords):
+                        return True
+
+            return False
+
+        def listen(decoder):
             buf = bytearray(buffer_size)
 
             with audio_device:
                 with decoder.start_utterance():
                     while not terminated and audio_device.readinto(buf) >= 0:
-                        decoder.process_raw(buf, False, False)
-                        hyp = decoder.hyp()
-                        if hyp:
-                            with decoder.end_utterance():
-                                # Make sure the hotword is matched
-                                detected_phrase = hyp.hypstr
-                                if detected_phrase == hotword:
-                                    break
+                        if process(decoder, buf):
+                            break
 
-            detected_event.set()
+        def listen_hub(decoder):
+            with hub.subscribe() as subscription:
+                with decoder.start_utterance():
+                    while not terminated:
+                        buf = subscription.get()
+                        if (buf is None) or process(decoder, buf):
+                            break
+
+        def run():
+            try:
+                target = listen if hub is None else listen_hub
+                if pool is None:
+                    target(decoder)
+                else:
+                    # Returned to the pool before hotword_detected is fired,
+                    # so stt_pocketsphinx can decode the command with it.
+                    with pool.lease() as pooled_decoder:
+                        pooled_decoder.set_search(SEARCH_KWS)
+                        target(pooled_decoder)
+            finally:
+                detected_event.set()
 
         # Listen asynchronously
         detected_event.clear()
-        thread = threading.Thread(target=listen, daemon=True)
+        thread = threading.Thread(target=run, daemon=True)
         thread.start()
         yield from asyncio.get_event_loop().run_in_executor(None, detected_event.wait)
 
         if not terminated:
             thread.join()
+            if gate is not None:
+                # Fraction of audio that was decoded
+                state_attrs.update(gate.stats)
+
             hass.states.async_set(OBJECT_DECODER, STATE_IDLE, state_attrs)
 
             # Fire detected event
             hass.bus.async_fire(EVENT_HOTWORD_DETECTED, {
-                'name': name  # name of the component
+                'name': name,              # name of the component
+                'hotword': detected_phrase  # which hotword was spoken
             })
 
     hass.services.async_register(DOMAIN, SERVICE_LISTEN, async_listen)
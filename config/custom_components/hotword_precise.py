@@ -1,19 +1,36 @@
 """
 Provide functionality to listen for a hot/wake word from mycroft-precise.
+
+The precise-engine process (which loads TensorFlow and the model) is started
+on the first listen and kept running until Home Assistant stops. The listen
+service only arms detection. While disarmed, the runner is paused (no
+predictions), and audio from before a listen is flushed out of the model's
+window when it's armed again.
+
+Without microphone_hub, the microphone is only open while detection is armed,
+so other components can record between listens.
 """
 import logging
 import os
+import math
 import asyncio
 import threading
+import time
 
 import voluptuous as vol
 
 from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import intent, config_validation as cv
 
+from .microphone_hub import get_microphone_hub
+from .rhasspy_audio import (
+    PreciseInProcessEngine, SpeechGate, GatedStream, ArmedMicrophone,
+    load_precise_params, PRECISE_CHUNK_SIZE, DEFAULT_GATE_ENERGY)
+
 _LOGGER = logging.getLogger(__name__)
 
-REQUIREMENTS = ['mycroft-precise==0.2.0', 'precise-runner==0.2.1']
+REQUIREMENTS = ['mycroft-precise==0.2.0', 'precise-runner==0.2.1',
+                'webrtcvad==2.0.10', 'numpy==1.14.5']
 
 DOMAIN = 'hotword_precise'
 
@@ -32,6 +49,21 @@ CONF_SENSITIVITY = 'sensitivity'
 # Higher values add latency but reduce false positives.
 CONF_TRIGGER_LEVEL = 'trigger_level'
 
+# How the model is run (defaults to 'engine').
+# 'engine' pipes audio to a precise-engine process.
+# 'tensorflow' loads the model into Home Assistant's process and computes
+# features with numpy, which avoids a round trip to the process for each chunk
+# (requires tensorflow). Run etc/benchmark_precise.py to compare them.
+CONF_BACKEND = 'backend'
+
+# True if audio should only be passed to precise when it's loud enough and
+# webrtcvad thinks it contains speech (defaults to False). Saves CPU in quiet
+# rooms.
+CONF_SPEECH_GATE = 'speech_gate'
+
+# Minimum RMS energy of audio before webrtcvad is checked (defaults to 100).
+CONF_GATE_ENERGY = 'gate_energy'
+
 # ----------------------
 # Configuration defaults
 # ----------------------
@@ -40,13 +72,22 @@ DEFAULT_NAME = 'hotword_precise'
 DEFAULT_SENSITIVITY = 0.5
 DEFAULT_TRIGGER_LEVEL = 3
 
+BACKEND_ENGINE = 'engine'
+BACKEND_TENSORFLOW = 'tensorflow'
+DEFAULT_BACKEND = BACKEND_ENGINE
+DEFAULT_SPEECH_GATE = False
+
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Optional(CONF_NAME, DEFAULT_NAME): cv.string,
 
         vol.Required(CONF_MODEL): cv.string,
         vol.Optional(CONF_SENSITIVITY, DEFAULT_SENSITIVITY): float,
-        vol.Optional(CONF_TRIGGER_LEVEL, DEFAULT_TRIGGER_LEVEL): int
+        vol.Optional(CONF_TRIGGER_LEVEL, DEFAULT_TRIGGER_LEVEL): int,
+        vol.Optional(CONF_BACKEND, DEFAULT_BACKEND):
+            vol.In([BACKEND_ENGINE, BACKEND_TENSORFLOW]),
+        vol.Optional(CONF_SPEECH_GATE, DEFAULT_SPEECH_GATE): cv.boolean,
+        vol.Optional(CONF_GATE_ENERGY, DEFAULT_GATE_ENERGY): float
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -78,6 +119,9 @@ def async_setup(hass, config):
     model = os.path.expanduser(config[DOMAIN].get(CONF_MODEL))
     sensitivity = config[DOMAIN].get(CONF_SENSITIVITY, DEFAULT_SENSITIVITY)
     trigger_level = config[DOMAIN].get(CONF_TRIGGER_LEVEL, DEFAULT_TRIGGER_LEVEL)
+    backend = config[DOMAIN].get(CONF_BACKEND, DEFAULT_BACKEND)
+    speech_gate = config[DOMAIN].get(CONF_SPEECH_GATE, DEFAULT_SPEECH_GATE)
+    gate_energy = config[DOMAIN].get(CONF_GATE_ENERGY, DEFAULT_GATE_ENERGY)
 
     state_attrs = {
         'friendly_name': 'Hotword',
@@ -85,31 +129,134 @@ def async_setup(hass, config):
     }
 
     assert os.path.exists(model), 'Model does not exist'
+
+    # Chunks of silence that replace all audio in precise-engine's window
+    flush_chunks = int(math.ceil(load_precise_params(model)['buffer_t'] *
+                                 16000 * 2 / PRECISE_CHUNK_SIZE))
     runner = None
+    subscription = None
     terminated = False
-    detected_event = threading.Event()
 
-    @asyncio.coroutine
-    def async_listen(call):
-        nonlocal runner, detected_event
+    # Only used without microphone_hub
+    mic = None
 
-        hass.states.async_set(OBJECT_DECODER, STATE_LISTENING, state_attrs)
+    # Audio passed to the runner (through the speech gate if enabled)
+    gate = None
+    gated_stream = None
+
+    detected_event = threading.Event()
+
+    # Set while a listen is waiting for the hotword (checked by the runner's
+    # thread).
+    armed_event = threading.Event()
+
+    # Time of the last listen call
+    arm_time = None
+
+    # True until the runner's thread has forgotten audio from before the
+    # last listen call
+    reset_pending = False
+
+    def report_rearm(rearm_sec):
+        # Seconds from the listen call until precise gets audio again
+        state_attrs['rearm_sec'] = round(rearm_sec, 3)
+        if armed_event.is_set():
+            hass.states.async_set(OBJECT_DECODER, STATE_LISTENING, state_attrs)
+
+    def on_activation():
+        if armed_event.is_set():
+            armed_event.clear()
+
+            # No predictions until the next listen
+            runner.pause()
+            if mic is not None:
+                mic.disarm()
+
+            detected_event.set()
+
+    def reset_detection(engine):
+        """Forgets audio from before the detector was armed (runner thread)."""
+        if isinstance(engine, PreciseInProcessEngine):
+            engine.reset()
+        else:
+            # precise-engine keeps buffer_t seconds of features, so push the
+            # old audio out with silence.
+            silence = bytes(PRECISE_CHUNK_SIZE)
+            for _ in range(flush_chunks):
+                engine.get_prediction(silence)
+
+        # Count activations from zero again
+        runner.detector.activation = 0
+
+    def start_runner():
+        """Starts the engine process and runner (slow, only done once)."""
+        nonlocal runner, subscription, mic, gate, gated_stream
+
+        # Use shared microphone if available (16-bit 16Khz mono).
+        # Otherwise, the microphone is only open while armed.
+        hub = get_microphone_hub(hass, 16000, 2, 1)
+        if hub is not None:
+            subscription = hub.subscribe()
+            source = subscription
+        else:
+            mic = ArmedMicrophone(16000, 2, 1)
+            source = mic
+
+        def read(size):
+            nonlocal reset_pending
+            data = source.read(size)
+            if reset_pending and armed_event.is_set():
+                reset_detection(engine)
+                reset_pending = False
+                hass.loop.call_soon_threadsafe(report_rearm,
+                                               time.time() - arm_time)
+
+            return data
+
+        if speech_gate:
+            # Skips precise when there's no speech
+            gate = SpeechGate(16000, energy_threshold=gate_energy)
+
+        gated_stream = GatedStream(read, gate)
+
+        if backend == BACKEND_TENSORFLOW:
+            engine = PreciseInProcessEngine(model)
+        else:
+            engine = PreciseEngine('precise-engine', model)
 
-        engine = PreciseEngine('precise-engine', model)
         runner = PreciseRunner(engine,
                                sensitivity=sensitivity,
                                trigger_level=trigger_level,
-                               on_activation=lambda: detected_event.set())
+                               stream=gated_stream,
+                               on_activation=on_activation)
+
+        # Runs in a separate thread (paused until armed)
+        runner.start()
+        runner.pause()
+        _LOGGER.debug('Started precise (%s)' % backend)
+
+    @asyncio.coroutine
+    def async_listen(call):
+        nonlocal arm_time, reset_pending
+        arm_time = time.time()
+        hass.states.async_set(OBJECT_DECODER, STATE_LISTENING, state_attrs)
 
+        if runner is None:
+            yield from hass.loop.run_in_executor(None, start_runner)
 
-        # Runs in a separate thread
         detected_event.clear()
-        runner.start()
-        yield from asyncio.get_event_loop().run_in_executor(None, detected_event.wait)
+        reset_pending = True
+        armed_event.set()
+        runner.play()
+        if mic is not None:
+            mic.arm()
+
+        yield from hass.loop.run_in_executor(None, detected_event.wait)
 
         if not terminated:
-            runner.stop()
-            runner = None
+            if gate is not None:
+                # Fraction of audio passed to precise
+                state_attrs.update(gate.stats)
 
             hass.states.async_set(OBJECT_DECODER, STATE_IDLE, state_attrs)
 
@@ -125,13 +272,26 @@ def async_setup(hass, config):
     # Make sure the runner terminates property when home assistant stops
     @asyncio.coroutine
     def async_terminate(event):
-        nonlocal runner, detected_event, terminated
+        nonlocal runner, subscription, mic, terminated
         terminated = True
+        armed_event.clear()
+
+        # Don't wait for the microphone or speech before stopping
+        if mic is not None:
+            mic.close()
+
+        if gated_stream is not None:
+            gated_stream.close()
 
         if runner is not None:
             runner.stop()
             runner = None
 
+        if subscription is not None:
+            subscription.close()
+            subscription = None
+
+        mic = None
         detected_event.set()
 
     hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
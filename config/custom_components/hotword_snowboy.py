@@ -1,19 +1,32 @@
 """
 Provide functionality to listen for a hot/wake word from snowboy.
+
+The snowboy detector is created on the first listen and kept until Home
+Assistant stops. Audio is only run through the detector while a listen is
+waiting for the hotword.
+
+Without microphone_hub, the microphone is only open while detection is armed,
+so other components can record between listens.
 """
 import logging
 import os
 import asyncio
 import threading
+import queue
+import time
 
 import voluptuous as vol
 
 from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import intent, config_validation as cv
 
+from .microphone_hub import get_microphone_hub
+from .rhasspy_audio import ArmedMicrophone, SpeechGate, DEFAULT_GATE_ENERGY
+
 _LOGGER = logging.getLogger(__name__)
 
-REQUIREMENTS = ['snowboy==1.2.0b1']
+REQUIREMENTS = ['snowboy==1.2.0b1', 'PyAudio>=0.2.8', 'webrtcvad==2.0.10',
+                'numpy==1.14.5']
 
 DOMAIN = 'hotword_snowboy'
 
@@ -22,15 +35,31 @@ DOMAIN = 'hotword_snowboy'
 # ------
 
 # Path to the snowboy hotword model file (.umdl or .pmdl)
+#
+# May also be a list of models, each with its own sensitivity. They are all
+# run by the same detector (models must have one hotword each):
+#
+# model:
+#   - path: $RHASSPY_ASSISTANT/wake/snowboy/okay_rhasspy.pmdl
+#     sensitivity: 0.45
+#   - path: $RHASSPY_ASSISTANT/wake/snowboy/hey_computer.pmdl
 CONF_MODEL = 'model'
 
 # Sensitivity of detection (defaults to 0.5).
-# Ranges from 0-1.
+# Ranges from 0-1. Used for models without their own sensitivity.
 CONF_SENSITIVITY = 'sensitivity'
 
 # Amount of audio gain when recording (defaults to 1.0)
 CONF_AUDIO_GAIN = 'audio_gain'
 
+# True if audio should only be run through snowboy when it's loud enough and
+# webrtcvad thinks it contains speech (defaults to False). Saves CPU in quiet
+# rooms.
+CONF_SPEECH_GATE = 'speech_gate'
+
+# Minimum RMS energy of audio before webrtcvad is checked (defaults to 100).
+CONF_GATE_ENERGY = 'gate_energy'
+
 # ----------------------
 # Configuration defaults
 # ----------------------
@@ -38,14 +67,25 @@ CONF_AUDIO_GAIN = 'audio_gain'
 DEFAULT_NAME = 'hotword_snowboy'
 DEFAULT_SENSITIVITY = 0.5
 DEFAULT_AUDIO_GAIN = 1.0
+DEFAULT_SPEECH_GATE = False
+
+# One model or a list of models with sensitivities
+MODEL_PATH = 'path'
+MODEL_SENSITIVITY = 'sensitivity'
+MODELS_SCHEMA = vol.Any(cv.string, [vol.Schema({
+    vol.Required(MODEL_PATH): cv.string,
+    vol.Optional(MODEL_SENSITIVITY): float
+})])
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Optional(CONF_NAME, DEFAULT_NAME): cv.string,
 
-        vol.Required(CONF_MODEL): cv.string,
+        vol.Required(CONF_MODEL): MODELS_SCHEMA,
         vol.Optional(CONF_SENSITIVITY, DEFAULT_SENSITIVITY): float,
-        vol.Optional(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN): float
+        vol.Optional(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN): float,
+        vol.Optional(CONF_SPEECH_GATE, DEFAULT_SPEECH_GATE): cv.boolean,
+        vol.Optional(CONF_GATE_ENERGY, DEFAULT_GATE_ENERGY): float
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -67,62 +107,182 @@ STATE_LISTENING = 'listening'
 # Fired when the hotword is detected
 EVENT_HOTWORD_DETECTED = 'hotword_detected'
 
+# Samples per buffer when recording without microphone_hub (64 ms)
+CHUNK_SIZE = 1024
+
 # -----------------------------------------------------------------------------
 
 @asyncio.coroutine
 def async_setup(hass, config):
     name = config[DOMAIN].get(CONF_NAME, DEFAULT_NAME)
-    model = os.path.expanduser(config[DOMAIN].get(CONF_MODEL))
     sensitivity = config[DOMAIN].get(CONF_SENSITIVITY, DEFAULT_SENSITIVITY)
     audio_gain = config[DOMAIN].get(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN)
+    speech_gate = config[DOMAIN].get(CONF_SPEECH_GATE, DEFAULT_SPEECH_GATE)
+    gate_energy = config[DOMAIN].get(CONF_GATE_ENERGY, DEFAULT_GATE_ENERGY)
+
+    # List of (path, sensitivity)
+    models = config[DOMAIN].get(CONF_MODEL)
+    if isinstance(models, str):
+        models = [{ MODEL_PATH: models }]
+
+    models = [(os.path.expanduser(model[MODEL_PATH]),
+               model.get(MODEL_SENSITIVITY, sensitivity))
+              for model in models]
+
+    for model, _ in models:
+        assert os.path.exists(model), 'Model does not exist: %s' % model
 
-    assert os.path.exists(model), 'Model does not exist'
     detector = None
+    gate = None
     terminated = False
-    detected_event = threading.Event()
+
+    # Paths of detected models are put here by the audio thread (None when
+    # stopping)
+    detections = queue.Queue()
+
+    # Set while a listen is waiting for the hotword
+    armed_event = threading.Event()
+    reset_pending = False
+
+    # Time of the last listen call (cleared once audio arrives)
+    arm_time = None
+
+    # Audio sources (only one is used)
+    subscription = None
+    mic = None
 
     state_attrs = {
         'friendly_name': 'Hotword',
         'icon': 'mdi:microphone'
     }
 
+    def report_rearm(rearm_sec):
+        # Seconds from the listen call until snowboy gets audio again
+        state_attrs['rearm_sec'] = round(rearm_sec, 3)
+        if armed_event.is_set():
+            hass.states.async_set(OBJECT_SNOWBOY, STATE_LISTENING, state_attrs)
+
+    def handle_buffer(buf):
+        """Runs detection on a buffer of audio (audio thread)."""
+        nonlocal reset_pending
+        if not armed_event.is_set():
+            return
+
+        if reset_pending:
+            # Forget audio from before the detector was armed
+            detector.Reset()
+            reset_pending = False
+
+            hass.loop.call_soon_threadsafe(report_rearm,
+                                           time.time() - arm_time)
+
+        buffers = [buf] if gate is None else gate.process(buf)
+        for detect_buf in buffers:
+            # Index of detected model (starting at 1)
+            index = detector.RunDetection(bytes(detect_buf))
+            if index > 0:
+                armed_event.clear()
+                if mic is not None:
+                    mic.disarm()
+
+                detections.put(models[min(index, len(models)) - 1][0])
+                break
+
+    def read_hub():
+        while True:
+            buf = subscription.get()
+            if buf is None:
+                break
+
+            handle_buffer(buf)
+
+    def read_mic(stream):
+        buf_size = CHUNK_SIZE * stream.sample_width * stream.channels
+        while True:
+            buf = stream.read(buf_size)
+            if stream.closed:
+                break
+
+            handle_buffer(buf)
+
+    def start_detector():
+        """Loads the model and starts feeding it audio (only done once)."""
+        nonlocal detector, gate, subscription, mic
+        from snowboy import snowboydecoder, snowboydetect
+
+        # All models are evaluated by one detector
+        detector = snowboydetect.SnowboyDetect(
+            resource_filename=snowboydecoder.RESOURCE_FILE.encode(),
+            model_str=','.join(path for path, _ in models).encode())
+
+        if detector.NumHotwords() != len(models):
+            _LOGGER.warning('Expected %s hotword(s), but models have %s' % \
+                            (len(models), detector.NumHotwords()))
+
+        detector.SetAudioGain(audio_gain)
+        detector.SetSensitivity(','.join(str(model_sensitivity) for _, model_sensitivity in models).encode())
+
+        if speech_gate:
+            # Skips the detector when there's no speech (16-bit mono only)
+            gate = SpeechGate(detector.SampleRate(), energy_threshold=gate_energy)
+
+        # Use shared microphone if available (16-bit 16Khz mono)
+        hub = get_microphone_hub(hass, detector.SampleRate(),
+                                 detector.BitsPerSample() // 8,
+                                 detector.NumChannels())
+
+        if hub is not None:
+            subscription = hub.subscribe()
+            threading.Thread(target=read_hub, daemon=True).start()
+        else:
+            # Only open while armed
+            mic = ArmedMicrophone(detector.SampleRate(),
+                                  detector.BitsPerSample() // 8,
+                                  detector.NumChannels(),
+                                  frames_per_buffer=CHUNK_SIZE)
+
+            threading.Thread(target=read_mic, args=(mic,), daemon=True).start()
+
+        _LOGGER.debug('Started detector')
+
+    def stop_detector():
+        nonlocal subscription, mic
+        if subscription is not None:
+            subscription.close()
+            subscription = None
+
+        if mic is not None:
+            mic.close()
+            mic = None
+
     @asyncio.coroutine
     def async_listen(call):
-        nonlocal detected_event, terminated
-        from snowboy import snowboydecoder
-
-        interrupted = False
-
-        def interrupt_callback():
-            nonlocal interrupted, terminated
-            return interrupted or terminated
-
-        def detect():
-            detector = snowboydecoder.HotwordDetector(
-                model, sensitivity=sensitivity, audio_gain=audio_gain)
+        nonlocal reset_pending, arm_time
+        arm_time = time.time()
+        hass.states.async_set(OBJECT_SNOWBOY, STATE_LISTENING, state_attrs)
 
-            detector.start(lambda: detected_event.set(),
-                           interrupt_check=interrupt_callback,
-                           sleep_time=0.03)
+        if detector is None:
+            yield from hass.loop.run_in_executor(None, start_detector)
 
-            detector.terminate()
+        reset_pending = True
+        armed_event.set()
+        if mic is not None:
+            mic.arm()
 
-        # Run detector in a separate thread
-        detected_event.clear()
-        thread = threading.Thread(target=detect, daemon=True)
-        hass.states.async_set(OBJECT_SNOWBOY, STATE_LISTENING, state_attrs)
-
-        thread.start()
-        yield from asyncio.get_event_loop().run_in_executor(None, detected_event.wait)
-        interrupted = True
+        # Wait for the audio thread to report a detection
+        detected_model = yield from hass.loop.run_in_executor(None, detections.get)
 
         if not terminated:
+            if gate is not None:
+                # Fraction of audio run through snowboy
+                state_attrs.update(gate.stats)
+
             hass.states.async_set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
 
             # Fire detected event
             hass.bus.async_fire(EVENT_HOTWORD_DETECTED, {
                 'name': name,       # name of the component
-                'model': model      # model used
+                'model': detected_model  # model that was detected
             })
 
     hass.services.async_register(DOMAIN, SERVICE_LISTEN, async_listen)
@@ -133,7 +293,9 @@ def async_setup(hass, config):
     def async_terminate(event):
         nonlocal terminated
         terminated = True
-        detected_event.set()
+        armed_event.clear()
+        yield from hass.loop.run_in_executor(None, stop_detector)
+        detections.put(None)  # wake up listen
 
     hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
 
@@ -0,0 +1,349 @@
+"""
+Provide a single, long-lived microphone that other components can share.
+
+The microphone is opened once when Home Assistant starts. Audio is copied to
+every subscriber (hotword detectors, command listener, speech to text), so
+switching between them doesn't re-open the device or drop audio. Subscribers
+that fall more than buffer_sec behind lose chunks instead of growing memory.
+"""
+import logging
+import math
+import asyncio
+import threading
+import queue
+import time
+
+import voluptuous as vol
+
+from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers import config_validation as cv
+
+from .rhasspy_audio import CallbackStats
+
+_LOGGER = logging.getLogger(__name__)
+
+REQUIREMENTS = ['PyAudio>=0.2.8']
+
+DOMAIN = 'microphone_hub'
+
+# ------
+# Config
+# ------
+
+# Index of the PyAudio device to listen on (-1 for default microphone)
+CONF_DEVICE_INDEX = 'device_index'
+
+# Microphone sample rate (defaults to 16Khz)
+CONF_SAMPLE_RATE = 'sample_rate'
+
+# Microphone sample width (defaults to 2 bytes or 16-bits)
+CONF_SAMPLE_WIDTH = 'sample_width'
+
+# Microphone channels (defaults to 1 or mono)
+CONF_CHANNELS = 'channels'
+
+# Size of recording buffer (defaults to 480 or 30 ms at the default sample rate/width).
+# *MUST* be 10, 20, or 30 ms for subscribers that use webrtcvad.
+CONF_CHUNK_SIZE = 'chunk_size'
+
+# Number of seconds of audio a subscriber may fall behind before chunks are
+# dropped (defaults to 2).
+CONF_BUFFER_SEC = 'buffer_sec'
+
+# ----------------------
+# Configuration defaults
+# ----------------------
+
+DEFAULT_NAME = 'microphone_hub'
+DEFAULT_DEVICE_INDEX = -1    # default microphone
+DEFAULT_SAMPLE_RATE = 16000  # 16Khz
+DEFAULT_SAMPLE_WIDTH = 2     # 16-bit
+DEFAULT_CHANNELS = 1         # mono
+DEFAULT_CHUNK_SIZE = 480     # 30 ms
+DEFAULT_BUFFER_SEC = 2.0
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Optional(CONF_NAME, DEFAULT_NAME): cv.string,
+
+        vol.Optional(CONF_DEVICE_INDEX, DEFAULT_DEVICE_INDEX): int,
+        vol.Optional(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE): int,
+        vol.Optional(CONF_SAMPLE_WIDTH, DEFAULT_SAMPLE_WIDTH): int,
+        vol.Optional(CONF_CHANNELS, DEFAULT_CHANNELS): int,
+        vol.Optional(CONF_CHUNK_SIZE, DEFAULT_CHUNK_SIZE): int,
+        vol.Optional(CONF_BUFFER_SEC, DEFAULT_BUFFER_SEC): float
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+# Represents the shared microphone
+OBJECT_MICROPHONE = '%s.microphone' % DOMAIN
+
+# Microphone is not open
+STATE_IDLE = 'idle'
+
+# Microphone is open and recording
+STATE_RECORDING = 'recording'
+
+# -----------------------------------------------------------------------------
+
+class MicrophoneSubscription(object):
+    """Receives a copy of every chunk recorded by a MicrophoneHub."""
+
+    def __init__(self, hub, max_chunks=0):
+        self._hub = hub
+        self._chunks = queue.Queue(maxsize=max_chunks)  # 0 is unbounded
+        self._pending = bytearray()  # leftover audio from read
+        self.closed = False
+
+        # Number of chunks dropped because the subscriber fell behind
+        self.dropped = 0
+
+    def put(self, chunk):
+        """Adds a chunk (called from the audio thread)."""
+        try:
+            self._chunks.put_nowait(chunk)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1:
+                self._hub.dropping(self)
+
+    def get(self, timeout=None):
+        """Returns the next chunk, or None if the subscription was closed."""
+        if self.closed and self._chunks.empty():
+            return None
+
+        try:
+            return self._chunks.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def read(self, size):
+        """Blocks until size bytes are available (file-like).
+
+        Returns fewer bytes only if the subscription was closed.
+        """
+        while len(self._pending) < size:
+            chunk = self.get()
+            if chunk is None:
+                break
+
+            self._pending += chunk
+
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._hub.unsubscribe(self)
+            try:
+                self._chunks.put_nowait(None)  # wake up readers
+            except queue.Full:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# -----------------------------------------------------------------------------
+
+class MicrophoneHub(object):
+    """Owns a PyAudio input stream and shares its audio with subscribers."""
+
+    def __init__(self, device_index, sample_rate, sample_width, channels,
+                 chunk_size, buffer_sec, on_change=None):
+        self._logger = logging.getLogger(__name__)
+
+        self._device_index = device_index
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self._on_change = on_change
+
+        # Default size of subscription queues
+        self.max_chunks = max(1, int(math.ceil(
+            buffer_sec * sample_rate / chunk_size)))
+
+        # Chunks dropped by closed subscriptions
+        self._closed_dropped = 0
+
+        # Replaced (not modified) when subscribers change, so the audio thread
+        # can iterate without copying.
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+        self._audio = None
+        self._mic = None
+        self._continue = None
+        self.callback_stats = CallbackStats()
+
+    def is_format(self, sample_rate, sample_width, channels):
+        """True if the hub records audio in the given format."""
+        return (self.sample_rate == sample_rate) and \
+            (self.sample_width == sample_width) and \
+            (self.channels == channels)
+
+    @property
+    def is_recording(self):
+        return self._mic is not None
+
+    def start(self):
+        """Opens the microphone (slow)."""
+        import pyaudio
+
+        device_index = None
+        if self._device_index >= 0:
+            device_index = self._device_index
+
+        self._continue = pyaudio.paContinue
+        self.callback_stats = CallbackStats(pyaudio.paInputOverflow)
+        self._audio = pyaudio.PyAudio()
+        self._mic = self._audio.open(
+            format=pyaudio.get_format_from_width(self.sample_width),
+            channels=self.channels,
+            rate=self.sample_rate,
+            input_device_index=device_index,
+            input=True,
+            stream_callback=self._stream_callback,
+            frames_per_buffer=self.chunk_size)
+
+        self._mic.start_stream()
+        self._logger.debug('Recording')
+
+    def stop(self):
+        """Closes the microphone and all subscriptions."""
+        if self._mic is not None:
+            self._mic.stop_stream()
+            self._mic.close()
+            self._mic = None
+
+        if self._audio is not None:
+            self._audio.terminate()
+            self._audio = None
+
+        for subscription in list(self._subscribers):
+            subscription.close()
+
+        self._logger.debug('Stopped recording')
+
+    def subscribe(self, max_chunks=None):
+        """Returns a new MicrophoneSubscription (close it when finished).
+
+        The subscription holds at most max_chunks waiting chunks (defaults to
+        buffer_sec of audio, 0 is unbounded).
+        """
+        if max_chunks is None:
+            max_chunks = self.max_chunks
+
+        subscription = MicrophoneSubscription(self, max_chunks=max_chunks)
+        with self._lock:
+            self._subscribers = self._subscribers + [subscription]
+
+        self._changed()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers
+                                 if s is not subscription]
+            self._closed_dropped += subscription.dropped
+
+        self._changed()
+
+    def dropping(self, subscription):
+        """Called when a subscription starts dropping chunks (audio thread)."""
+        self._logger.warning('Subscriber fell behind. Dropping audio.')
+        self._changed()
+
+    @property
+    def num_subscribers(self):
+        return len(self._subscribers)
+
+    @property
+    def dropped(self):
+        """Total chunks dropped by all subscriptions."""
+        return self._closed_dropped + \
+            sum(s.dropped for s in self._subscribers)
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def _stream_callback(self, buf, frame_count, time_info, status):
+        start_time = time.perf_counter()
+        for subscription in self._subscribers:
+            subscription.put(buf)
+
+        self.callback_stats.record(start_time, status)
+        return (None, self._continue)
+
+# -----------------------------------------------------------------------------
+
+def get_microphone_hub(hass, sample_rate, sample_width, channels):
+    """Returns the shared MicrophoneHub if it's recording in the given format.
+
+    Returns None if microphone_hub isn't configured or its audio format is
+    different (callers should open their own microphone).
+    """
+    hub = hass.data.get(DOMAIN)
+    if (hub is None) or (not hub.is_recording):
+        return None
+
+    if not hub.is_format(sample_rate, sample_width, channels):
+        _LOGGER.warning('Not using %s: need %s Hz, %s byte(s), %s channel(s)' % \
+                        (DOMAIN, sample_rate, sample_width, channels))
+        return None
+
+    return hub
+
+# -----------------------------------------------------------------------------
+
+@asyncio.coroutine
+def async_setup(hass, config):
+    state_attrs = {
+        'friendly_name': 'Microphone',
+        'icon': 'mdi:microphone-variant',
+        'subscribers': 0,
+        'dropped_chunks': 0
+    }
+
+    def update_state():
+        state_attrs['subscribers'] = hub.num_subscribers
+        state_attrs['dropped_chunks'] = hub.dropped
+        state_attrs.update(hub.callback_stats.stats)
+        state = STATE_RECORDING if hub.is_recording else STATE_IDLE
+        hass.states.async_set(OBJECT_MICROPHONE, state, state_attrs)
+
+    def hub_changed():
+        # May be called from any thread
+        hass.loop.call_soon_threadsafe(update_state)
+
+    hub = MicrophoneHub(
+        config[DOMAIN].get(CONF_DEVICE_INDEX, DEFAULT_DEVICE_INDEX),
+        config[DOMAIN].get(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE),
+        config[DOMAIN].get(CONF_SAMPLE_WIDTH, DEFAULT_SAMPLE_WIDTH),
+        config[DOMAIN].get(CONF_CHANNELS, DEFAULT_CHANNELS),
+        config[DOMAIN].get(CONF_CHUNK_SIZE, DEFAULT_CHUNK_SIZE),
+        config[DOMAIN].get(CONF_BUFFER_SEC, DEFAULT_BUFFER_SEC),
+        on_change=hub_changed)
+
+    # Open the microphone once (PortAudio initialization is slow)
+    loop = asyncio.get_event_loop()
+    yield from loop.run_in_executor(None, hub.start)
+    hass.data[DOMAIN] = hub
+    update_state()
+
+    @asyncio.coroutine
+    def async_terminate(event):
+        yield from loop.run_in_executor(None, hub.stop)
+
+    hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
+
+    _LOGGER.info('Started')
+
+    return True
@@ -0,0 +1,1262 @@
+"""
+Audio helpers shared by the rhasspy components.
+
+This is *not* a Home Assistant component, so it doesn't need to be in your
+configuration. Third-party libraries (numpy, etc.) are imported inside
+functions, since the components that use them list them in REQUIREMENTS.
+"""
+import io
+import os
+import json
+import math
+import struct
+import tempfile
+import time
+import wave
+import zlib
+import threading
+from collections import deque
+from functools import lru_cache
+
+# Format required by the pocketsphinx acoustic models
+TARGET_RATE = 16000  # 16Khz
+TARGET_WIDTH = 2     # 16-bit
+TARGET_CHANNELS = 1  # mono
+
+# -----------------------------------------------------------------------------
+# WAV data
+# -----------------------------------------------------------------------------
+
+# WAVE format tags for integer PCM
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def parse_wav_header(data):
+    """
+    Parses the header of (possibly incomplete) WAV data.
+
+    Arguments:
+    data -- bytes-like object with the start of a WAV file
+
+    Returns:
+    (data_offset, data_size, rate, width, channels) or None if more data is
+    needed to find the start of the audio frames.
+
+    Raises ValueError if data is not a PCM WAV file.
+    """
+    view = memoryview(data)
+    if len(view) < 12:
+        return None
+
+    if (view[0:4] != b'RIFF') or (view[8:12] != b'WAVE'):
+        raise ValueError('Not a WAV file')
+
+    audio_format = None
+    pos = 12
+    while (pos + 8) <= len(view):
+        chunk_id = view[pos:pos + 4].tobytes()
+        chunk_size = struct.unpack_from('<I', view, pos + 4)[0]
+        body = pos + 8
+
+        if chunk_id == b'fmt ':
+            if (body + 16) > len(view):
+                return None
+
+            audio_format = struct.unpack_from('<HHIIHH', view, body)
+        elif chunk_id == b'data':
+            if audio_format is None:
+                raise ValueError('Missing fmt chunk')
+
+            format_tag, channels, rate, _, _, bits = audio_format
+            if format_tag not in [WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE]:
+                raise ValueError('Unsupported WAV format: %s' % format_tag)
+
+            return body, chunk_size, rate, bits // 8, channels
+
+        pos = body + chunk_size + (chunk_size % 2)  # chunks are word-aligned
+
+    return None
+
+def parse_wav(data):
+    """
+    Finds the audio frames in WAV data without copying them.
+
+    Arguments:
+    data -- bytes-like object with a complete WAV file
+
+    Returns:
+    (frames, rate, width, channels) where frames is a memoryview into data
+
+    Raises ValueError if data is not a PCM WAV file.
+    """
+    header = parse_wav_header(data)
+    if header is None:
+        raise ValueError('Missing data chunk')
+
+    offset, size, rate, width, channels = header
+
+    # Streaming writers may leave the size as 0 or 0xFFFFFFFF
+    view = memoryview(data)
+    end = offset + size
+    if (size == 0) or (end > len(view)):
+        end = len(view)
+
+    return view[offset:end], rate, width, channels
+
+# Sample widths (bytes) that convert_audio can handle
+SUPPORTED_WIDTHS = [1, 2, 3, 4]
+
+# Limits on client-supplied audio formats
+MAX_RATE = 192000
+MAX_CHANNELS = 32
+
+def check_audio_format(rate, width, channels):
+    """Raises ValueError with the reason if the audio format isn't usable."""
+    if not (0 < rate <= MAX_RATE):
+        raise ValueError('Invalid sample rate: %s (must be 1-%s)' % \
+                         (rate, MAX_RATE))
+
+    if width not in SUPPORTED_WIDTHS:
+        raise ValueError('Invalid sample width: %s (must be one of %s)' % \
+                         (width, SUPPORTED_WIDTHS))
+
+    if not (0 < channels <= MAX_CHANNELS):
+        raise ValueError('Invalid channels: %s (must be 1-%s)' % \
+                         (channels, MAX_CHANNELS))
+
+# Size of a canonical PCM WAV header (see make_wav_header)
+WAV_HEADER_SIZE = 44
+
+def make_wav_header(data_size, rate, width, channels):
+    """Returns a canonical 44-byte PCM WAV header for data_size bytes of audio."""
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, WAVE_FORMAT_PCM, channels, rate,
+                       rate * width * channels,  # bytes per second
+                       width * channels,         # block align
+                       width * 8,                # bits per sample
+                       b'data', data_size)
+
+def make_wav(frames, rate, width, channels):
+    """Wraps audio frames in a WAV header."""
+    with io.BytesIO() as wav_data:
+        with wave.open(wav_data, mode='wb') as wav_file:
+            wav_file.setframerate(rate)
+            wav_file.setsampwidth(width)
+            wav_file.setnchannels(channels)
+            wav_file.writeframesraw(frames)
+
+        return wav_data.getvalue()
+
+# -----------------------------------------------------------------------------
+# Compression
+# -----------------------------------------------------------------------------
+
+# Lossless audio codec for sending commands over slow networks.
+#
+# 16-bit samples are replaced by their order-N differences (a simple linear
+# predictor), which are small for speech. The low and high bytes of the
+# differences are then stored in separate planes (the high bytes are mostly
+# 0x00 or 0xFF) and compressed with zlib.
+#
+# Layout: CODEC_MAGIC, header (CODEC_HEADER), zlib data
+CODEC_MAGIC = b'RDZ1'
+CODEC_HEADER = struct.Struct('<IBBBI')  # rate, width, channels, order, frames size
+CODEC_CONTENT_TYPE = 'application/x-rhasspy-audio'
+
+# Second-order prediction works best for 16Khz speech
+DEFAULT_CODEC_ORDER = 2
+DEFAULT_CODEC_LEVEL = 6
+
+# Highest prediction order accepted by decode_audio
+MAX_CODEC_ORDER = 8
+
+# Most audio bytes decode_audio will inflate (about 17 minutes of 16-bit
+# 16Khz mono). Servers should pass a smaller max_sec.
+MAX_CODEC_SIZE = 32 * 1024 * 1024
+
+def is_encoded_audio(data):
+    """True if data was produced by encode_audio."""
+    return memoryview(data)[:len(CODEC_MAGIC)] == CODEC_MAGIC
+
+def encode_audio(frames, rate, width, channels,
+                 order=DEFAULT_CODEC_ORDER, level=DEFAULT_CODEC_LEVEL):
+    """
+    Losslessly compresses PCM audio.
+
+    Only 16-bit audio is predicted. Other widths are compressed with zlib
+    as-is (order 0).
+
+    Returns:
+    bytes (see decode_audio)
+    """
+    frames = memoryview(frames).cast('B')
+    if width != 2:
+        order = 0
+
+    if order > 0:
+        import numpy as np
+
+        num_samples = (len(frames) // (2 * channels)) * channels
+        samples = np.frombuffer(frames[:num_samples * 2], dtype='<i2')
+        residual = samples.reshape(-1, channels)
+
+        # Differences wrap around (mod 2^16), so decoding is exact
+        for i in range(order):
+            diff = np.empty_like(residual)
+            diff[:1] = residual[:1]
+            np.subtract(residual[1:], residual[:-1], out=diff[1:])
+            residual = diff
+
+        planes = residual.astype('<i2').view(np.uint8).reshape(-1, 2).T
+        body = planes.tobytes() + frames[num_samples * 2:].tobytes()
+    else:
+        body = frames
+
+    header = CODEC_HEADER.pack(rate, width, channels, order, len(frames))
+    return CODEC_MAGIC + header + zlib.compress(body, level)
+
+def parse_codec_header(data, max_sec=None):
+    """
+    Reads and checks the header of audio from encode_audio.
+
+    Arguments:
+    data -- bytes-like object with (at least) the start of encoded audio
+    max_sec -- longest audio accepted in seconds (None for MAX_CODEC_SIZE)
+
+    Returns:
+    (rate, width, channels, order, size) where size is the number of bytes of
+    audio frames
+
+    Raises ValueError if the header is invalid or the audio is too long.
+    """
+    view = memoryview(data)
+    if not is_encoded_audio(view):
+        raise ValueError('Not encoded audio')
+
+    offset = len(CODEC_MAGIC)
+    if len(view) < offset + CODEC_HEADER.size:
+        raise ValueError('Incomplete header')
+
+    rate, width, channels, order, size = CODEC_HEADER.unpack_from(view, offset)
+    check_audio_format(rate, width, channels)
+
+    if (order > MAX_CODEC_ORDER) or ((order > 0) and (width != 2)):
+        raise ValueError('Invalid prediction order: %s' % order)
+
+    if size == 0:
+        raise ValueError('No audio data')
+
+    max_size = MAX_CODEC_SIZE
+    if max_sec is not None:
+        max_size = min(max_size,
+                       int(math.ceil(max_sec * rate)) * width * channels)
+
+    if size > max_size:
+        raise ValueError('Audio is too long: %s byte(s) (max %s)' % \
+                         (size, max_size))
+
+    return rate, width, channels, order, size
+
+def decode_audio(data, max_sec=None):
+    """
+    Decompresses audio from encode_audio.
+
+    Arguments:
+    data -- bytes-like object with encoded audio
+    max_sec -- longest audio accepted in seconds (see parse_codec_header)
+
+    Returns:
+    (frames, rate, width, channels)
+
+    Raises ValueError if data is not valid.
+    """
+    rate, width, channels, order, size = parse_codec_header(data, max_sec)
+    view = memoryview(data)
+    offset = len(CODEC_MAGIC) + CODEC_HEADER.size
+
+    # Never inflate more than the header says (zlib bombs). size is never 0
+    # here, which zlib would treat as unlimited.
+    decompressor = zlib.decompressobj()
+    try:
+        body = decompressor.decompress(view[offset:], size)
+    except zlib.error as e:
+        raise ValueError(str(e))
+
+    if len(body) != size:
+        raise ValueError('Expected %s byte(s), got %s' % (size, len(body)))
+
+    if decompressor.unconsumed_tail or decompressor.unused_data:
+        raise ValueError('Unexpected data after %s byte(s)' % size)
+
+    if not decompressor.eof:
+        raise ValueError('Incomplete compressed data')
+
+    if order == 0:
+        return body, rate, width, channels
+
+    import numpy as np
+
+    num_samples = (size // (2 * channels)) * channels
+    planes = np.frombuffer(body, dtype=np.uint8, count=num_samples * 2)
+    residual = planes.reshape(2, -1).T.copy().view('<i2').reshape(-1, channels)
+
+    samples = residual
+    for i in range(order):
+        samples = np.cumsum(samples, axis=0, dtype='<i2')
+
+    return samples.tobytes() + body[num_samples * 2:], rate, width, channels
+
+# -----------------------------------------------------------------------------
+# Resampling
+# -----------------------------------------------------------------------------
+
+# Number of zero crossings of the sinc function on either side of the center
+# tap of the low-pass filter. More is sharper (and slower).
+RESAMPLE_ZERO_CROSSINGS = 16
+
+# Kaiser window shape parameter (~80 dB stopband attenuation)
+RESAMPLE_KAISER_BETA = 8.0
+
+def pcm_to_float(data, width):
+    """
+    Converts signed little-endian PCM (unsigned for 8-bit) to floats in the
+    16-bit integer range.
+
+    Arguments:
+    data -- bytes-like object with PCM samples
+    width -- sample width in bytes (1-4)
+
+    Returns:
+    numpy float32 array with one value per sample (channels interleaved)
+    """
+    import numpy as np
+
+    data = memoryview(data).cast('B')
+    data = data[:len(data) - (len(data) % width)]  # drop partial sample
+
+    if width == 1:
+        samples = np.frombuffer(data, dtype=np.uint8).astype(np.float32)
+        return (samples - 128.0) * 256.0
+    elif width == 2:
+        return np.frombuffer(data, dtype='<i2').astype(np.float32)
+    elif width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = (samples << 8) >> 8  # sign extend
+        return samples.astype(np.float32) / 256.0
+    elif width == 4:
+        return np.frombuffer(data, dtype='<i4').astype(np.float32) / 65536.0
+
+    raise ValueError('Unsupported sample width: %s' % width)
+
+@lru_cache(maxsize=8)
+def _polyphase_filter(up, down):
+    """Returns low-pass filter split into phases (up x taps) and its center."""
+    import numpy as np
+
+    max_rate = max(up, down)
+    half_len = RESAMPLE_ZERO_CROSSINGS * max_rate
+    n = np.arange(-half_len, half_len + 1)
+
+    # Windowed sinc with cutoff at the lower of the two Nyquist frequencies.
+    # Gain of up compensates for the zeros inserted when upsampling.
+    taps = np.sinc(n / max_rate) * np.kaiser(len(n), RESAMPLE_KAISER_BETA)
+    taps *= up / max_rate
+
+    # phases[r, j] = taps[r + (j * up)]
+    taps_per_phase = int(math.ceil(len(taps) / up))
+    padded = np.zeros(taps_per_phase * up, dtype=np.float32)
+    padded[:len(taps)] = taps
+    phases = padded.reshape(taps_per_phase, up).T.copy()
+
+    return phases, half_len
+
+def resample(samples, rate, target_rate):
+    """
+    Resamples a mono signal with a polyphase windowed-sinc filter.
+
+    Arguments:
+    samples -- numpy float array
+    rate -- sample rate of samples
+    target_rate -- desired sample rate
+
+    Returns:
+    numpy float32 array at target_rate
+    """
+    import numpy as np
+
+    if rate == target_rate:
+        return samples
+
+    gcd = math.gcd(rate, target_rate)
+    up, down = target_rate // gcd, rate // gcd
+    phases, half_len = _polyphase_filter(up, down)
+    num_taps = phases.shape[1]
+
+    # Output sample m is the dot product of the filter phase for m with the
+    # input samples leading up to index q.
+    num_out = int(math.ceil(len(samples) * up / down))
+    offsets = (np.arange(num_out, dtype=np.int64) * down) + half_len
+    phase_idx = offsets % up
+    sample_idx = (offsets // up) + num_taps  # shifted for left padding
+
+    padded = np.zeros(num_taps + len(samples) + (half_len // up) + 2,
+                      dtype=np.float32)
+    padded[num_taps:num_taps + len(samples)] = samples
+
+    output = np.zeros(num_out, dtype=np.float32)
+    for j in range(num_taps):
+        output += phases[phase_idx, j] * padded[sample_idx - j]
+
+    return output
+
+def convert_audio(data, rate, width, channels,
+                  target_rate=TARGET_RATE):
+    """
+    Converts PCM audio to 16-bit mono with NumPy (no temporary files).
+
+    Arguments:
+    data -- bytes-like object with PCM samples (channels interleaved)
+    rate -- sample rate of data
+    width -- sample width of data in bytes
+    channels -- number of channels in data
+
+    Returns:
+    bytes with 16-bit mono PCM at target_rate
+    """
+    import numpy as np
+
+    samples = pcm_to_float(data, width)
+    if channels > 1:
+        # Downmix by averaging channels
+        num_frames = len(samples) // channels
+        samples = samples[:num_frames * channels].reshape(num_frames, channels)
+        samples = samples.mean(axis=1)
+
+    samples = resample(samples, rate, target_rate)
+    return np.clip(np.round(samples), -32768, 32767).astype('<i2').tobytes()
+
+# -----------------------------------------------------------------------------
+# Buffering
+# -----------------------------------------------------------------------------
+
+class RingBuffer(object):
+    """Fixed-size (preallocated) buffer that keeps the most recent bytes written."""
+
+    def __init__(self, size):
+        self._buffer = bytearray(size)
+        self._pos = 0     # next write position
+        self._length = 0  # number of valid bytes
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def size(self):
+        return len(self._buffer)
+
+    def write(self, data):
+        """Appends data, overwriting the oldest bytes if the buffer is full."""
+        data = memoryview(data).cast('B')
+        size = len(self._buffer)
+        if (size == 0) or (len(data) == 0):
+            return
+
+        if len(data) >= size:
+            # Only the end of data fits
+            self._buffer[:] = data[len(data) - size:]
+            self._pos = 0
+            self._length = size
+            return
+
+        end = self._pos + len(data)
+        if end <= size:
+            self._buffer[self._pos:end] = data
+        else:
+            # Wrap around
+            first = size - self._pos
+            self._buffer[self._pos:] = data[:first]
+            self._buffer[:end - size] = data[first:]
+
+        self._pos = end % size
+        self._length = min(size, self._length + len(data))
+
+    def read_last(self, count=None):
+        """Returns (up to) the last count bytes written, oldest first."""
+        size = len(self._buffer)
+        if count is None:
+            count = self._length
+
+        count = min(count, self._length)
+        if count <= 0:
+            return b''
+
+        start = (self._pos - count) % size
+        if (start + count) <= size:
+            return bytes(self._buffer[start:start + count])
+
+        return bytes(self._buffer[start:]) + bytes(self._buffer[:(start + count) - size])
+
+    def clear(self):
+        self._pos = 0
+        self._length = 0
+
+class WavBuffer(object):
+    """
+    Preallocated buffer for recording audio that can be read back as WAV data
+    without copying.
+
+    The first WAV_HEADER_SIZE bytes are reserved for the header, which is
+    filled in by wav().
+    """
+
+    def __init__(self, max_bytes, rate, width, channels):
+        self._buffer = bytearray(WAV_HEADER_SIZE + max_bytes)
+        self._length = 0
+        self.rate = rate
+        self.width = width
+        self.channels = channels
+
+        # Bytes that didn't fit in the buffer
+        self.dropped = 0
+
+    def __len__(self):
+        return self._length
+
+    def clear(self):
+        self._length = 0
+        self.dropped = 0
+
+    def append(self, data):
+        """Appends audio, dropping anything past the end of the buffer."""
+        data = memoryview(data).cast('B')
+        start = WAV_HEADER_SIZE + self._length
+        end = min(start + len(data), len(self._buffer))
+        self._buffer[start:end] = data[:end - start]
+
+        self._length += end - start
+        self.dropped += len(data) - (end - start)
+
+    @property
+    def frames(self):
+        """memoryview of the recorded audio."""
+        return memoryview(self._buffer)[WAV_HEADER_SIZE:WAV_HEADER_SIZE + self._length]
+
+    def wav(self):
+        """memoryview of the recorded audio with a WAV header."""
+        self._buffer[:WAV_HEADER_SIZE] = make_wav_header(
+            self._length, self.rate, self.width, self.channels)
+
+        return memoryview(self._buffer)[:WAV_HEADER_SIZE + self._length]
+
+# -----------------------------------------------------------------------------
+# Endpointing
+# -----------------------------------------------------------------------------
+
+# Results of Endpointer.process
+PHRASE_SILENCE = 'silence'    # outside of a phrase
+PHRASE_START = 'start'        # first buffer of a phrase
+PHRASE_CONTINUE = 'continue'  # inside a phrase
+PHRASE_END = 'end'            # last buffer of a phrase
+PHRASE_TIMEOUT = 'timeout'    # too many buffers (phrase may be incomplete)
+
+class Endpointer(object):
+    """
+    Finds the start and end of spoken phrases with webrtcvad.
+
+    Live audio is passed to process one buffer at a time. Recorded audio can
+    be searched all at once with find_speech.
+    """
+
+    def __init__(self, vad_mode, sample_rate, chunk_size,
+                 min_sec, silence_sec, timeout_sec=None):
+        """
+        Arguments:
+        vad_mode -- webrtcvad aggressiveness (0-3)
+        sample_rate -- sample rate of 16-bit mono audio
+        chunk_size -- samples per buffer (*MUST* be 10, 20, or 30 ms)
+        min_sec -- minimum seconds of a phrase (avoids hisses and pops)
+        silence_sec -- seconds of silence that end a phrase
+        timeout_sec -- maximum seconds to process before giving up (None for no limit)
+        """
+        import webrtcvad
+
+        self._vad = webrtcvad.Vad()
+        self._vad.set_mode(vad_mode)
+
+        self.sample_rate = sample_rate
+        self.chunk_size = chunk_size
+        self.seconds_per_buffer = chunk_size / sample_rate
+
+        self._min_buffers = int(math.ceil(min_sec / self.seconds_per_buffer))
+        self._silence_buffers = int(math.ceil(silence_sec / self.seconds_per_buffer))
+        self._max_buffers = None
+        if timeout_sec is not None:
+            self._max_buffers = int(math.ceil(timeout_sec / self.seconds_per_buffer))
+
+        self.reset()
+
+    def reset(self):
+        """Starts looking for a new phrase."""
+        self.in_phrase = False
+        self.after_phrase = False
+        self.finished = False
+        self.is_speech = False
+
+        # Consecutive non-speech buffers at the end of the current phrase
+        self.silent_buffers = 0
+
+        self._buffers_left = self._max_buffers
+        self._min_left = self._min_buffers
+        self._silence_left = self._silence_buffers
+
+    def process(self, buf):
+        """Updates the phrase state with a buffer of audio (PHRASE_* result)."""
+        if self._buffers_left is not None:
+            self._buffers_left -= 1
+            if self._buffers_left <= 0:
+                self.finished = True
+                return PHRASE_TIMEOUT
+
+        self.is_speech = self._vad.is_speech(bytes(buf), self.sample_rate)
+        if self.is_speech:
+            self.silent_buffers = 0
+        else:
+            self.silent_buffers += 1
+
+        if not self.in_phrase:
+            if self.is_speech:
+                # Start of phrase
+                self.in_phrase = True
+                self.after_phrase = False
+                self._min_left = self._min_buffers
+                return PHRASE_START
+
+            return PHRASE_SILENCE
+
+        if self._min_left > 0:
+            # In phrase, before minimum seconds
+            self._min_left -= 1
+            return PHRASE_CONTINUE
+
+        if self.is_speech:
+            # In phrase, after minimum seconds
+            self.after_phrase = False
+            return PHRASE_CONTINUE
+
+        if not self.after_phrase:
+            # Transition to after phrase
+            self.after_phrase = True
+            self._silence_left = self._silence_buffers
+            return PHRASE_CONTINUE
+
+        if self._silence_left > 0:
+            # After phrase, before stop
+            self._silence_left -= 1
+            return PHRASE_CONTINUE
+
+        # Phrase complete
+        return self.end_phrase()
+
+    @property
+    def trailing_silence_sec(self):
+        """Seconds of non-speech at the end of the current phrase."""
+        return self.silent_buffers * self.seconds_per_buffer
+
+    def end_phrase(self):
+        """Ends the current phrase early (e.g., when it's known to be complete)."""
+        self.in_phrase = False
+        self.after_phrase = False
+        self.finished = True
+        return PHRASE_END
+
+    def find_speech(self, frames, padding_sec=0.0):
+        """
+        Finds the audio from the start of the first phrase to the last speech
+        in the final phrase.
+
+        Arguments:
+        frames -- bytes-like object with 16-bit mono audio at sample_rate
+        padding_sec -- seconds of audio to keep before and after speech
+
+        Returns:
+        (start, end) byte offsets into frames, or None if there's no speech
+        """
+        view = memoryview(frames).cast('B')
+        chunk_bytes = self.chunk_size * 2
+        first_offset = None
+        last_offset = None
+
+        self.reset()
+        for offset in range(0, len(view) - chunk_bytes + 1, chunk_bytes):
+            result = self.process(view[offset:offset + chunk_bytes])
+            if (result == PHRASE_START) and (first_offset is None):
+                first_offset = offset
+
+            if self.is_speech and (self.in_phrase or (result == PHRASE_END)):
+                last_offset = offset + chunk_bytes
+
+            if self.finished:
+                # Look for more phrases
+                self.reset()
+
+        if first_offset is None:
+            return None
+
+        padding = int(padding_sec * self.sample_rate) * 2
+        return max(0, first_offset - padding), min(len(view), last_offset + padding)
+
+# -----------------------------------------------------------------------------
+# Speech gating
+# -----------------------------------------------------------------------------
+
+# Minimum RMS (16-bit samples) of a buffer before webrtcvad is checked.
+# Quiet rooms are usually below 100, and nearby speech is well above it.
+DEFAULT_GATE_ENERGY = 100.0
+
+# webrtcvad aggressiveness (0-3) used by the gate
+DEFAULT_GATE_VAD_MODE = 1
+
+# Seconds of audio from before speech that are passed on when the gate opens
+DEFAULT_GATE_LOOKBACK_SEC = 0.5
+
+# Seconds the gate stays open after the last speech
+DEFAULT_GATE_HANGOVER_SEC = 1.5
+
+# Size of frames checked by webrtcvad (must be 10, 20, or 30 ms)
+GATE_VAD_FRAME_SEC = 0.03
+
+class SpeechGate(object):
+    """
+    Cheap check for likely speech in front of an expensive hotword detector.
+
+    Each buffer of 16-bit mono audio is checked for energy (RMS) and then
+    with webrtcvad. Only buffers near speech are passed on; recent buffers are
+    kept so the detector also hears the start of the hotword.
+    """
+
+    def __init__(self, sample_rate, energy_threshold=DEFAULT_GATE_ENERGY,
+                 vad_mode=DEFAULT_GATE_VAD_MODE,
+                 lookback_sec=DEFAULT_GATE_LOOKBACK_SEC,
+                 hangover_sec=DEFAULT_GATE_HANGOVER_SEC):
+        import webrtcvad
+
+        self._vad = webrtcvad.Vad()
+        self._vad.set_mode(vad_mode)
+
+        self.sample_rate = sample_rate
+        self.energy_threshold = energy_threshold
+
+        bytes_per_sec = sample_rate * 2
+        self._frame_bytes = int(sample_rate * GATE_VAD_FRAME_SEC) * 2
+        self._max_lookback_bytes = int(lookback_sec * bytes_per_sec)
+        self._hangover_bytes = int(hangover_sec * bytes_per_sec)
+
+        self._lookback = deque()
+        self._lookback_bytes = 0
+        self._open_bytes = 0  # bytes left before the gate closes
+
+        # Statistics
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def is_speech(self, buf):
+        """True if a buffer is loud enough and webrtcvad hears speech in it."""
+        import numpy as np
+
+        samples = np.frombuffer(buf, dtype='<i2', count=len(buf) // 2)
+        if len(samples) == 0:
+            return False
+
+        rms = math.sqrt(np.dot(samples, samples.astype(np.float64)) / len(samples))
+        if rms < self.energy_threshold:
+            return False
+
+        frame_bytes = self._frame_bytes
+        for offset in range(0, len(buf) - frame_bytes + 1, frame_bytes):
+            if self._vad.is_speech(buf[offset:offset + frame_bytes], self.sample_rate):
+                return True
+
+        return False
+
+    @property
+    def is_open(self):
+        return self._open_bytes > 0
+
+    def process(self, buf):
+        """Returns the buffers (possibly none) to pass on to the detector."""
+        buf = bytes(buf)  # caller may reuse buf
+        self.bytes_in += len(buf)
+
+        if self.is_speech(buf):
+            # Open (or keep open) and include the audio from just before
+            self._open_bytes = self._hangover_bytes
+            buffers = list(self._lookback)
+            buffers.append(buf)
+            self._lookback.clear()
+            self._lookback_bytes = 0
+        elif self._open_bytes > 0:
+            self._open_bytes -= len(buf)
+            buffers = [buf]
+        else:
+            # Closed: remember recent audio in case speech starts
+            self._lookback.append(buf)
+            self._lookback_bytes += len(buf)
+            while self._lookback_bytes > self._max_lookback_bytes:
+                self._lookback_bytes -= len(self._lookback.popleft())
+
+            return []
+
+        self.bytes_out += sum(len(b) for b in buffers)
+        return buffers
+
+    @property
+    def duty_cycle(self):
+        """Fraction of audio passed on to the detector."""
+        if self.bytes_in == 0:
+            return 0.0
+
+        return self.bytes_out / self.bytes_in
+
+    @property
+    def stats(self):
+        """Statistics (suitable for state attributes)."""
+        return {
+            'gate_duty_cycle': round(self.duty_cycle, 3),
+            'gate_audio_sec': round(self.bytes_in / (self.sample_rate * 2), 1)
+        }
+
+class GatedStream(object):
+    """File-like stream that only returns audio passed by a SpeechGate."""
+
+    def __init__(self, read, gate):
+        """
+        Arguments:
+        read -- function that returns up to size bytes of audio (b'' at the end)
+        gate -- SpeechGate (None passes all audio through)
+        """
+        self._read = read
+        self._gate = gate
+        self._pending = bytearray()
+        self.closed = False
+
+    def read(self, size):
+        """Blocks until size bytes of gated audio are available.
+
+        After close, returns immediately (padded with silence), so readers
+        don't wait forever for speech.
+        """
+        while (not self.closed) and (len(self._pending) < size):
+            buf = self._read(size)
+            if len(buf) == 0:
+                break
+
+            if self._gate is None:
+                self._pending += buf
+                continue
+
+            for gated_buf in self._gate.process(buf):
+                self._pending += gated_buf
+
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+
+        if self.closed:
+            data = data.ljust(size, b'\0')
+
+        return data
+
+    def close(self):
+        self.closed = True
+
+# -----------------------------------------------------------------------------
+# Audio callbacks
+# -----------------------------------------------------------------------------
+
+class CallbackStats(object):
+    """Counts input overflows and time spent in a PortAudio callback."""
+
+    def __init__(self, overflow_flag=0):
+        self._overflow_flag = overflow_flag
+        self.overflows = 0
+        self.callbacks = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+
+    def record(self, start_time, status):
+        """Call at the end of the callback with its start time (perf_counter)."""
+        elapsed_sec = time.perf_counter() - start_time
+        self.callbacks += 1
+        self.total_sec += elapsed_sec
+        self.max_sec = max(self.max_sec, elapsed_sec)
+
+        if status & self._overflow_flag:
+            self.overflows += 1
+
+    @property
+    def stats(self):
+        """Statistics (suitable for state attributes)."""
+        avg_sec = 0.0
+        if self.callbacks > 0:
+            avg_sec = self.total_sec / self.callbacks
+
+        return {
+            'input_overflows': self.overflows,
+            'callback_count': self.callbacks,
+            'callback_avg_ms': round(avg_sec * 1000, 3),
+            'callback_max_ms': round(self.max_sec * 1000, 3)
+        }
+
+class FrameQueue(object):
+    """
+    Hands audio buffers from a PortAudio callback to a worker thread.
+
+    The callback only appends to a deque, so voice activity detection (and
+    anything else slow) happens outside of the audio thread. The worker
+    processes all waiting buffers each time it wakes up.
+    """
+
+    def __init__(self, handle_buffer, continue_flag=0, overflow_flag=0):
+        self._handle_buffer = handle_buffer
+        self._continue_flag = continue_flag
+        self._buffers = deque()
+        self._ready = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+        self.callback_stats = CallbackStats(overflow_flag)
+
+        # Most buffers waiting at once (worker falling behind)
+        self.max_backlog = 0
+
+    def callback(self, buf, frame_count, time_info, status):
+        """PyAudio stream callback."""
+        start_time = time.perf_counter()
+        self._buffers.append(buf)
+        self._ready.set()
+        self.callback_stats.record(start_time, status)
+
+        return (None, self._continue_flag)
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._process, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the worker after it processes any waiting buffers."""
+        self._stopped = True
+        self._ready.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _process(self):
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+
+            self.max_backlog = max(self.max_backlog, len(self._buffers))
+            while len(self._buffers) > 0:
+                self._handle_buffer(self._buffers.popleft())
+
+            if self._stopped:
+                break
+
+    @property
+    def stats(self):
+        """Statistics (suitable for state attributes)."""
+        stats = self.callback_stats.stats
+        stats['max_backlog'] = self.max_backlog
+        return stats
+
+class ArmedMicrophone(object):
+    """
+    Blocking PyAudio input that only holds the microphone while armed.
+
+    read waits until arm is called, opens the microphone, and closes it again
+    on the first read after disarm, so other programs can record in between.
+    The device is only touched by the reading thread.
+    """
+
+    def __init__(self, sample_rate=16000, sample_width=2, channels=1,
+                 frames_per_buffer=1024):
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self.closed = False
+
+        self._armed = threading.Event()
+        self._audio = None
+        self._mic = None
+
+    def arm(self):
+        self._armed.set()
+
+    def disarm(self):
+        self._armed.clear()
+
+    def close(self):
+        """Wakes up read, which releases the microphone and returns silence."""
+        self.closed = True
+        self._armed.set()
+
+    def read(self, size):
+        """Blocks until armed, then returns size bytes of audio."""
+        if not self._armed.is_set():
+            self._close_mic()
+
+        self._armed.wait()
+        if self.closed:
+            self._close_mic()
+            return bytes(size)
+
+        if self._mic is None:
+            self._open_mic()
+
+        frame_size = self.sample_width * self.channels
+        return self._mic.read(size // frame_size, exception_on_overflow=False)
+
+    def _open_mic(self):
+        import pyaudio
+        self._audio = pyaudio.PyAudio()
+        self._mic = self._audio.open(
+            format=self._audio.get_format_from_width(self.sample_width),
+            channels=self.channels,
+            rate=self.sample_rate,
+            input=True,
+            frames_per_buffer=self.frames_per_buffer)
+
+    def _close_mic(self):
+        if self._mic is not None:
+            self._mic.stop_stream()
+            self._mic.close()
+            self._audio.terminate()
+            self._mic = self._audio = None
+
+# -----------------------------------------------------------------------------
+# Pocketsphinx keyphrases
+# -----------------------------------------------------------------------------
+
+# Keys of one hotword in a list of hotwords with thresholds
+KEYPHRASE_PHRASE = 'phrase'
+KEYPHRASE_THRESHOLD = 'threshold'
+
+def get_keyphrases(value, default_threshold):
+    """Returns a list of (phrase, threshold) from a hotword config value.
+
+    value is a single phrase or a list of dicts with KEYPHRASE_PHRASE and
+    (optionally) KEYPHRASE_THRESHOLD.
+    """
+    if isinstance(value, str):
+        return [(value, default_threshold)]
+
+    return [(keyphrase[KEYPHRASE_PHRASE],
+             keyphrase.get(KEYPHRASE_THRESHOLD, default_threshold))
+            for keyphrase in value]
+
+def set_keyphrases(decoder, search, keyphrases):
+    """
+    Adds a keyword spotting search for one or more keyphrases.
+
+    All keyphrases are spotted in a single pass; hyp().hypstr is the phrase
+    that was detected.
+
+    Arguments:
+    decoder -- pocketsphinx decoder
+    search -- name of the search
+    keyphrases -- list of (phrase, threshold)
+    """
+    with tempfile.NamedTemporaryFile(suffix='.kws', mode='w+') as kws_file:
+        for phrase, threshold in keyphrases:
+            print('%s /%s/' % (phrase, threshold), file=kws_file)
+
+        kws_file.flush()
+        decoder.set_kws(search, kws_file.name)
+
+# -----------------------------------------------------------------------------
+# Precise hotword models
+# -----------------------------------------------------------------------------
+
+# Audio parameters used by mycroft-precise when a model has no .params file
+PRECISE_DEFAULT_PARAMS = {
+    'window_t': 0.1,
+    'hop_t': 0.05,
+    'buffer_t': 1.5,
+    'sample_rate': 16000,
+    'sample_depth': 2,
+    'n_mfcc': 13,
+    'n_filt': 20,
+    'n_fft': 512,
+    'use_delta': False
+}
+
+# Bytes of audio read by PreciseRunner for each prediction (1024 samples)
+PRECISE_CHUNK_SIZE = 2048
+
+def load_precise_params(model_path):
+    """Loads the audio parameters of a precise model (from model.pb.params)."""
+    params = dict(PRECISE_DEFAULT_PARAMS)
+    params_path = model_path + '.params'
+    if os.path.exists(params_path):
+        with open(params_path, 'r') as params_file:
+            params.update(json.load(params_file))
+
+    sample_rate = params['sample_rate']
+    params['window_samples'] = int(sample_rate * params['window_t'] + 0.5)
+    params['hop_samples'] = int(sample_rate * params['hop_t'] + 0.5)
+    buffer_samples = params['hop_samples'] * \
+        (int(sample_rate * params['buffer_t']) // params['hop_samples'])
+    params['n_features'] = 1 + int(math.floor(
+        (buffer_samples - params['window_samples']) / params['hop_samples']))
+
+    return params
+
+@lru_cache(maxsize=8)
+def _mel_filterbank(sample_rate, num_filt, fft_len):
+    """Returns triangular mel filters (num_filt x fft_len), same as sonopy."""
+    import numpy as np
+
+    def hertz_to_mels(f):
+        return 1127. * np.log(1. + f / 700.)
+
+    def mels_to_hertz(mel):
+        return 700. * (np.exp(mel / 1127.) - 1.)
+
+    grid_mels = np.linspace(hertz_to_mels(0), hertz_to_mels(sample_rate),
+                            num_filt + 2, True)
+    grid_indices = (mels_to_hertz(grid_mels) * fft_len / sample_rate).astype(int)
+
+    banks = np.zeros([num_filt, fft_len])
+    for i in range(num_filt):
+        left, middle, right = grid_indices[i:i + 3]
+        banks[i, left:middle] = np.linspace(0., 1., middle - left, False)
+        banks[i, middle:right] = np.linspace(1., 0., right - middle, False)
+
+    return banks
+
+@lru_cache(maxsize=8)
+def _dct_matrix(size):
+    """Returns the orthonormal DCT-II matrix (same as scipy's dct(norm='ortho'))."""
+    import numpy as np
+
+    n = np.arange(size)
+    matrix = np.cos(np.pi * np.outer(2 * n + 1, n) / (2 * size))
+    matrix *= np.sqrt(2.0 / size)
+    matrix[:, 0] /= np.sqrt(2.0)
+
+    return matrix
+
+class MfccWindow(object):
+    """
+    Sliding window of MFCC features over a stream of 16-bit mono audio.
+
+    Features for all of the new frames in a chunk are computed at once, so
+    the cost per chunk is a single FFT/matrix product.
+    """
+
+    def __init__(self, params):
+        import numpy as np
+
+        self._window_samples = params['window_samples']
+        self._hop_samples = params['hop_samples']
+        self._n_fft = params['n_fft']
+        self._n_mfcc = params['n_mfcc']
+
+        self._filters = _mel_filterbank(params['sample_rate'], params['n_filt'],
+                                        self._n_fft // 2 + 1)
+        self._dct = _dct_matrix(params['n_filt'])
+        self._audio = np.zeros(0, dtype=np.float32)  # not yet featurized
+
+        # Most recent features (oldest first)
+        self.features = np.zeros((params['n_features'], self._n_mfcc))
+
+    def update(self, chunk):
+        """Adds a chunk of 16-bit audio and returns the current features."""
+        import numpy as np
+
+        audio = np.frombuffer(chunk, dtype='<i2').astype(np.float32) / 32768.0
+        self._audio = np.concatenate((self._audio, audio))
+
+        num_frames = 1 + ((len(self._audio) - self._window_samples) // self._hop_samples)
+        if num_frames <= 0:
+            return self.features
+
+        # frames[i] = audio[i * hop:(i * hop) + window]
+        starts = np.arange(num_frames) * self._hop_samples
+        frames = self._audio[starts[:, None] + np.arange(self._window_samples)]
+        self._audio = self._audio[num_frames * self._hop_samples:]
+
+        fft = np.fft.rfft(frames, n=self._n_fft)
+        powers = ((fft.real ** 2) + (fft.imag ** 2)) / self._n_fft
+        mels = np.log(np.clip(np.dot(powers, self._filters.T),
+                              np.finfo(float).eps, None))
+        mfccs = np.dot(mels, self._dct)[:, :self._n_mfcc]
+
+        # sonopy replaces the first coefficient with the log energy of the frame
+        mfccs[:, 0] = np.log(np.clip(np.sum(powers, 1),
+                                     np.finfo(float).eps, None))
+
+        num_features = len(self.features)
+        if len(mfccs) >= num_features:
+            self.features = mfccs[-num_features:]
+        else:
+            self.features = np.concatenate((self.features[len(mfccs):], mfccs))
+
+        return self.features
+
+class PreciseInProcessEngine(object):
+    """
+    Scores audio with a precise model (.pb) inside this process.
+
+    Drop-in replacement for precise_runner.PreciseEngine: PreciseRunner calls
+    get_prediction for each chunk and applies sensitivity and trigger_level
+    to the result, exactly as it does for the precise-engine process.
+    """
+
+    def __init__(self, model_path, chunk_size=PRECISE_CHUNK_SIZE):
+        self.model_path = model_path
+        self.chunk_size = chunk_size
+        self.params = load_precise_params(model_path)
+
+        self._session = None
+        self._input = None
+        self._output = None
+        self._window = None
+
+    def start(self):
+        """Loads the model (slow)."""
+        import tensorflow as tf
+
+        if self.params['use_delta']:
+            raise ValueError('Models with use_delta are not supported')
+
+        graph = tf.Graph()
+        with graph.as_default():
+            graph_def = tf.GraphDef()
+            with tf.gfile.GFile(self.model_path, 'rb') as model_file:
+                graph_def.ParseFromString(model_file.read())
+
+            tf.import_graph_def(graph_def)
+
+        self._input = graph.get_operation_by_name('import/net_input').outputs[0]
+        self._output = graph.get_operation_by_name('import/net_output').outputs[0]
+        self._session = tf.Session(graph=graph)
+        self._window = MfccWindow(self.params)
+
+    def stop(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def reset(self):
+        """Forgets all audio (call between detections)."""
+        self._window = MfccWindow(self.params)
+
+    def get_prediction(self, chunk):
+        """Returns the network output (0-1) after adding a chunk of audio."""
+        features = self._window.update(chunk)
+        return float(self._session.run(self._output,
+                                       { self._input: features[None] })[0][0])
@@ -80,6 +80,16 @@ CONF_LM_MIXED = 'language_model_mixed'
 # Percentage of large language model to "mix" into smaller model (defaults to 5%)
 CONF_LM_LAMBDA = 'language_model_mix_percent'
 
+# Path to write JSGF grammar generated from training examples (optional).
+# The grammar only accepts the example sentences, so decoding with it is much
+# faster than with a language model (see decode_mode in stt_pocketsphinx).
+CONF_GRAMMAR = 'grammar'
+
+# Path to write the training sentences to, one per line (optional).
+# stt_pocketsphinx uses this to stop recording as soon as a complete sentence
+# has been recognized (see sentences in stt_pocketsphinx).
+CONF_SENTENCES = 'sentences'
+
 # ----------------------
 # Configuration defaults
 # ----------------------
@@ -111,6 +121,8 @@ CONFIG_SCHEMA = vol.Schema({
         vol.Required(CONF_LM_EXAMPLE): cv.string,
         vol.Required(CONF_LM_MIXED): cv.string,
         vol.Optional(CONF_LM_LAMBDA, DEFAULT_LM_LAMBDA): float,
+        vol.Optional(CONF_GRAMMAR, None): cv.string,
+        vol.Optional(CONF_SENTENCES, None): cv.string,
 
         vol.Required(CONF_G2P_FST): cv.string,
     })
@@ -165,6 +177,14 @@ def async_setup(hass, config):
     lm_mixed = os.path.expanduser(config[DOMAIN][CONF_LM_MIXED])
     lm_lambda = config[DOMAIN].get(CONF_LM_LAMBDA, DEFAULT_LM_LAMBDA)
 
+    grammar = config[DOMAIN].get(CONF_GRAMMAR, None)
+    if grammar is not None:
+        grammar = os.path.expanduser(grammar)
+
+    sentences = config[DOMAIN].get(CONF_SENTENCES, None)
+    if sentences is not None:
+        sentences = os.path.expanduser(sentences)
+
     state_attrs = {
         'friendly_name': 'Trainer',
         'icon': 'mdi:paperclip'
@@ -189,7 +209,9 @@ def async_setup(hass, config):
                 train_speech_recognizer(example_files,
                                         dict_files, dict_guess, dict_mixed,
                                         lm_base, lm_example, lm_mixed, lm_lambda,
-                                        ngram, ngram_count, phonetisaurus, g2p_fst)
+                                        ngram, ngram_count, phonetisaurus, g2p_fst,
+                                        grammar=grammar,
+                                        sentences=sentences)
 
                 _LOGGER.info('Finished training')
             finally:
@@ -245,10 +267,19 @@ def train_intent_recognizer(example_files, rasa_config,
 def train_speech_recognizer(example_files,
                             dict_files, dict_guess, dict_mixed,
                             lm_base, lm_example, lm_mixed, lm_lambda,
-                            ngram, ngram_count, phonetisaurus, g2p_fst):
+                            ngram, ngram_count, phonetisaurus, g2p_fst,
+                            grammar=None, sentences=None):
     # Load examples
     intent_examples = load_training_phrases(example_files)
 
+    if grammar is not None:
+        # Write grammar with only the example sentences
+        write_grammar(intent_examples, grammar)
+
+    if sentences is not None:
+        # Write example sentences for early endpointing
+        write_sentences(intent_examples, sentences)
+
     # Write clean sentences to a file
     with tempfile.NamedTemporaryFile(suffix='.vocab', mode='w+') as vocab_file:
         with tempfile.NamedTemporaryFile(suffix='.txt', mode='w+') as sentences_file:
@@ -352,6 +383,70 @@ def train_speech_recognizer(example_files,
 
 # -----------------------------------------------------------------------------
 
+def write_grammar(intent_examples, grammar_path, grammar_name='rhasspy'):
+    """
+    Writes a JSGF grammar that accepts exactly the training sentences.
+
+    Arguments:
+    intent_examples -- dictionary from load_training_phrases
+    grammar_path -- path to write grammar to
+    grammar_name -- name of the grammar (in the JSGF header)
+
+    There is one rule per intent, and a public <command> rule that matches any
+    of them. Rule names are the intent names with unsupported characters
+    replaced, plus a number if two intents end up with the same name.
+
+    Raises ValueError if there are no training sentences (pocketsphinx
+    rejects an empty grammar).
+    """
+    rules = {}
+    for intent_name, examples in sorted(intent_examples.items()):
+        # Collapse whitespace left by sanitize_phrase
+        sentences = set(' '.join(example['clean'].split()) for example in examples)
+        sentences.discard('')
+        if len(sentences) > 0:
+            base_name = re.sub(r'[^A-Za-z0-9_]', '_', intent_name)
+            rule_name = base_name
+            suffix = 1
+            while (rule_name in rules) or (rule_name == 'command'):
+                suffix += 1
+                rule_name = '%s_%s' % (base_name, suffix)
+
+            rules[rule_name] = sorted(sentences)
+
+    if len(rules) == 0:
+        raise ValueError('No training sentences for grammar %s' % grammar_path)
+
+    with open(grammar_path, 'w') as grammar_file:
+        print('#JSGF V1.0;', file=grammar_file)
+        print('grammar %s;' % grammar_name, file=grammar_file)
+        print('', file=grammar_file)
+
+        rule_refs = ' | '.join('<%s>' % rule_name for rule_name in sorted(rules))
+        print('public <command> = (%s);' % rule_refs, file=grammar_file)
+        print('', file=grammar_file)
+
+        for rule_name, sentences in sorted(rules.items()):
+            alternatives = ' | '.join('(%s)' % sentence for sentence in sentences)
+            print('<%s> = %s;' % (rule_name, alternatives), file=grammar_file)
+
+    _LOGGER.debug('Wrote grammar with %s rule(s) to %s' % (len(rules), grammar_path))
+
+def write_sentences(intent_examples, sentences_path):
+    """Writes the unique training sentences (clean text), one per line."""
+    sentences = set(' '.join(example['clean'].split())
+                    for examples in intent_examples.values()
+                    for example in examples)
+    sentences.discard('')
+
+    with open(sentences_path, 'w') as sentences_file:
+        for sentence in sorted(sentences):
+            print(sentence, file=sentences_file)
+
+    _LOGGER.debug('Wrote %s sentence(s) to %s' % (len(sentences), sentences_path))
+
+# -----------------------------------------------------------------------------
+
 def load_training_phrases(data_paths):
     intent_phrases = defaultdict(list)
 
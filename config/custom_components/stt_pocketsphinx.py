@@ -3,7 +3,6 @@ Provide functionality to transform speech into text using pocketsphinx.
 """
 import logging
 import os
-import math
 import asyncio
 import threading
 import wave
@@ -11,22 +10,39 @@ import shutil
 import tempfile
 import subprocess
 import io
+import sys
+import time
+import queue
+import json
+import argparse
+from contextlib import contextmanager
 
 import voluptuous as vol
 
-from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
+from homeassistant.const import (
+    CONF_NAME, EVENT_HOMEASSISTANT_STOP, HTTP_BAD_REQUEST)
 from homeassistant.helpers import intent, config_validation as cv
 from homeassistant.components.http import HomeAssistantView
 
+from .rhasspy_audio import (
+    convert_audio, parse_wav, parse_wav_header, make_wav, RingBuffer,
+    FrameQueue, is_encoded_audio, decode_audio, parse_codec_header,
+    check_audio_format, Endpointer,
+    PHRASE_START, PHRASE_CONTINUE, PHRASE_END, PHRASE_TIMEOUT,
+    KEYPHRASE_PHRASE, KEYPHRASE_THRESHOLD, get_keyphrases, set_keyphrases)
+from .microphone_hub import get_microphone_hub
+
 _LOGGER = logging.getLogger(__name__)
 
-REQUIREMENTS = ['pocketsphinx==0.1.15', 'webrtcvad==2.0.10', 'PyAudio>=0.2.8']
+REQUIREMENTS = ['pocketsphinx==0.1.15', 'webrtcvad==2.0.10', 'PyAudio>=0.2.8',
+                'numpy==1.14.5']
 DEPENDENCIES = ['http']
 
 # -----------------------------------------------------------------------------
-# NOTE: If you have sox installed and in your PATH, stt_pocketsphinx will
-# automatically convert WAV files that are not 16-bit 16Khz mono to the
-# appropriate format.
+# NOTE: stt_pocketsphinx will automatically convert WAV files that are not
+# 16-bit 16Khz mono to the appropriate format. This is done in memory with
+# numpy by default. If you'd rather use sox, set resampler to 'sox' and make
+# sure it's installed and in your PATH.
 #
 # More info on sox: http://sox.sourceforge.net
 # -----------------------------------------------------------------------------
@@ -34,6 +50,23 @@ DEPENDENCIES = ['http']
 DOMAIN = 'stt_pocketsphinx'
 STT_API_ENDPOINT = '/api/%s' % DOMAIN
 
+# Accepts audio as it's uploaded (Transfer-Encoding: chunked) and decodes it
+# while the upload is in progress. Audio that is not 16-bit 16Khz mono is
+# decoded after the upload is finished.
+STT_STREAM_API_ENDPOINT = '%s/stream' % STT_API_ENDPOINT
+
+# Persistent WebSocket sessions for streaming audio (see WS_TYPE_*).
+# Utterances are limited to timeout_sec of audio and are cancelled if the
+# client goes quiet for WS_IDLE_TIMEOUT_SEC.
+STT_WEBSOCKET_API_ENDPOINT = '%s/websocket' % STT_API_ENDPOINT
+
+# Query parameters for POSTing raw PCM data (no WAV header) to
+# STT_API_ENDPOINT or STT_STREAM_API_ENDPOINT. Defaults are 16Khz, 16-bit,
+# mono.
+PARAM_RATE = 'rate'
+PARAM_WIDTH = 'width'
+PARAM_CHANNELS = 'channels'
+
 # ------
 # Config
 # ------
@@ -50,6 +83,48 @@ CONF_LANGUAGE_MODEL = 'language_model'
 # Probably $RHASSPY_TOOLS/pocketsphinx/cmudict-en-us.dict
 CONF_DICTIONARY = 'dictionary'
 
+# Path to JSGF grammar (-jsgf) generated by rhasspy_train (optional).
+# Probably $RHASSPY_ASSISTANT/data/examples.gram
+CONF_GRAMMAR = 'grammar'
+
+# Path to small language model generated from training examples (optional).
+# Used for the first pass in cascade mode when there's no grammar.
+# Probably $RHASSPY_ASSISTANT/data/examples.lm
+CONF_LANGUAGE_MODEL_EXAMPLE = 'language_model_example'
+
+# How audio is decoded (defaults to 'lm').
+# 'lm' searches the language model, so any sentence can be recognized.
+# 'grammar' only recognizes sentences from the grammar, which is much faster
+# and uses less memory (the language model isn't loaded).
+# 'cascade' decodes with the grammar (or example language model) first, and
+# only decodes again with the language model if the first pass has low
+# confidence.
+CONF_DECODE_MODE = 'decode_mode'
+
+# Minimum confidence (posterior probability, 0-1) of the first pass in cascade
+# mode (defaults to 0.5). Below this, audio is decoded again with the language
+# model.
+CONF_CASCADE_THRESHOLD = 'cascade_threshold'
+
+# Hot/wake word to add as a keyword spotting search (optional).
+# hotword_pocketsphinx can then use the decoders in this component's pool
+# (shared_decoder: true) instead of loading the same acoustic model and
+# dictionary a second time. A decoder is leased while listening for the
+# hotword, so increase decoder_pool_size if audio may be POSTed at the same time.
+#
+# May also be a list of hotwords, each with its own threshold:
+#
+# hotword:
+#   - phrase: okay rhasspy
+#     threshold: 1e-30
+#   - phrase: hey computer
+CONF_HOTWORD = 'hotword'
+
+# Likelihood of the hotword occuring (defaults to 1e-40).
+# Used for hotwords without their own threshold (see threshold in
+# hotword_pocketsphinx).
+CONF_HOTWORD_THRESHOLD = 'hotword_threshold'
+
 # Index of the PyAudio device to listen on (-1 for default microphone)
 CONF_AUDIO_DEVICE = 'audio_device'
 
@@ -73,8 +148,62 @@ CONF_MIN_SEC = 'min_sec'
 CONF_SILENCE_SEC = 'silence_sec'
 
 # Total number of seconds to record before timing out (defaults to 30 seconds).
+# Also the longest compressed audio accepted by the HTTP API.
 CONF_TIMEOUT_SEC = 'timeout_sec'
 
+# Number of seconds of audio from *before* speech is detected to include in
+# the recording (defaults to 0.3 seconds). Keeps the first syllable from being
+# cut off when speaking right after the hotword.
+CONF_PREROLL_SEC = 'preroll_sec'
+
+# True if leading and trailing silence should be removed from WAV data before
+# decoding (defaults to True). Applies to decode_wav and POSTed audio, not
+# audio recorded by the listen service.
+CONF_TRIM_SILENCE = 'trim_silence'
+
+# Seconds of audio to keep before and after speech when trimming (defaults to 0.2).
+CONF_TRIM_PADDING_SEC = 'trim_padding_sec'
+
+# Number of decoders to keep loaded (defaults to 1).
+# Decoders are loaded in the background at startup (and after a reset), so the
+# first command doesn't have to wait. Requests beyond this number are queued
+# until a decoder is free. Each decoder holds its own copy of the models.
+CONF_DECODER_POOL_SIZE = 'decoder_pool_size'
+
+# True if audio should be decoded while the command is still being recorded
+# (defaults to False). Each buffer is fed into an open utterance as soon as
+# it's recorded, so the text is ready shortly after the command is finished.
+CONF_STREAMING = 'streaming'
+
+# True if speech_to_text_partial events should be fired with the current
+# hypothesis while audio is still being decoded (defaults to False).
+CONF_PARTIAL_RESULTS = 'partial_results'
+
+# Minimum number of seconds between partial events (defaults to 0.5 seconds).
+CONF_PARTIAL_INTERVAL_SEC = 'partial_interval_sec'
+
+# Path to a file with the training sentences, one per line (see sentences in
+# rhasspy_train). If set, the listen service decodes while recording and stops
+# as soon as the partial hypothesis is a complete training sentence, instead
+# of waiting for min_sec and silence_sec.
+#
+# Early stopping is disabled until the file exists. It's re-read by the reset
+# service, which should be called after training (see rhasspy_trained).
+CONF_SENTENCES = 'sentences'
+
+# Seconds that the partial hypothesis must stay the same before recording is
+# stopped early (defaults to 0.3 seconds).
+CONF_EARLY_STOP_STABLE_SEC = 'early_stop_stable_sec'
+
+# Seconds of non-speech required after a complete sentence before recording
+# is stopped early (defaults to 0.15 seconds). Keeps "turn on the light" from
+# stopping before "...in the kitchen".
+CONF_EARLY_STOP_SILENCE_SEC = 'early_stop_silence_sec'
+
+# Program used to convert WAV data that is not 16-bit 16Khz mono.
+# Either 'numpy' (in memory, the default) or 'sox' (external program).
+CONF_RESAMPLER = 'resampler'
+
 # ----------------------
 # Configuration defaults
 # ----------------------
@@ -83,6 +212,17 @@ DEFAULT_NAME = 'stt_pocketsphinx'
 DEFAULT_ACOUSTIC_MODEL = '/usr/share/pocketsphinx/model/en-us/en-us/'
 DEFAULT_LANGUAGE_MODEL = '/usr/share/pocketsphinx/model/en-us/en-us.lm.bin'
 DEFAULT_DICTIONARY = '/usr/share/pocketsphinx/model/en-us/cmudict-en-us.dict'
+DEFAULT_GRAMMAR = None
+DEFAULT_LANGUAGE_MODEL_EXAMPLE = None
+
+DECODE_MODE_LM = 'lm'
+DECODE_MODE_GRAMMAR = 'grammar'
+DECODE_MODE_CASCADE = 'cascade'
+DEFAULT_DECODE_MODE = DECODE_MODE_LM
+DEFAULT_CASCADE_THRESHOLD = 0.5
+
+DEFAULT_HOTWORD = None
+DEFAULT_HOTWORD_THRESHOLD = 1e-40  # 1e-50 to 1e-5 recommended
 
 DEFAULT_AUDIO_DEVICE = None
 DEFAULT_SAMPLE_RATE = 16000  # 16Khz
@@ -92,6 +232,30 @@ DEFAULT_VAD_MODE = 0         # 0-3 (agressiveness)
 DEFAULT_MIN_SEC = 2.0        # min seconds that command must last
 DEFAULT_SILENCE_SEC = 0.5    # min seconds of silence after command
 DEFAULT_TIMEOUT_SEC = 30.0   # max seconds that command can last
+DEFAULT_PREROLL_SEC = 0.3    # seconds of audio to keep before speech
+DEFAULT_TRIM_SILENCE = True
+DEFAULT_TRIM_PADDING_SEC = 0.2
+
+DEFAULT_DECODER_POOL_SIZE = 1
+DEFAULT_STREAMING = False
+DEFAULT_PARTIAL_RESULTS = False
+DEFAULT_PARTIAL_INTERVAL_SEC = 0.5
+DEFAULT_SENTENCES = None
+DEFAULT_EARLY_STOP_STABLE_SEC = 0.3
+DEFAULT_EARLY_STOP_SILENCE_SEC = 0.15
+
+# Seconds between checks of the partial hypothesis for early stopping
+EARLY_STOP_INTERVAL_SEC = 0.1
+
+RESAMPLER_NUMPY = 'numpy'
+RESAMPLER_SOX = 'sox'
+DEFAULT_RESAMPLER = RESAMPLER_NUMPY
+
+# One hotword or a list of hotwords with thresholds (see get_keyphrases)
+KEYPHRASES_SCHEMA = vol.Any(cv.string, [vol.Schema({
+    vol.Required(KEYPHRASE_PHRASE): cv.string,
+    vol.Optional(KEYPHRASE_THRESHOLD): float
+})])
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
@@ -100,6 +264,15 @@ CONFIG_SCHEMA = vol.Schema({
         vol.Optional(CONF_ACOUSTIC_MODEL, DEFAULT_ACOUSTIC_MODEL): cv.string,
         vol.Optional(CONF_LANGUAGE_MODEL, DEFAULT_LANGUAGE_MODEL): cv.string,
         vol.Optional(CONF_DICTIONARY, DEFAULT_DICTIONARY): cv.string,
+        vol.Optional(CONF_GRAMMAR, DEFAULT_GRAMMAR): cv.string,
+        vol.Optional(CONF_LANGUAGE_MODEL_EXAMPLE, DEFAULT_LANGUAGE_MODEL_EXAMPLE): cv.string,
+        vol.Optional(CONF_DECODE_MODE, DEFAULT_DECODE_MODE):
+            vol.In([DECODE_MODE_LM, DECODE_MODE_GRAMMAR, DECODE_MODE_CASCADE]),
+        vol.Optional(CONF_CASCADE_THRESHOLD, DEFAULT_CASCADE_THRESHOLD):
+            vol.All(vol.Coerce(float), vol.Range(min=0, max=1)),
+
+        vol.Optional(CONF_HOTWORD, DEFAULT_HOTWORD): KEYPHRASES_SCHEMA,
+        vol.Optional(CONF_HOTWORD_THRESHOLD, DEFAULT_HOTWORD_THRESHOLD): float,
 
         vol.Optional(CONF_AUDIO_DEVICE, DEFAULT_AUDIO_DEVICE): int,
         vol.Optional(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE): int,
@@ -108,7 +281,21 @@ CONFIG_SCHEMA = vol.Schema({
         vol.Optional(CONF_VAD_MODE, DEFAULT_VAD_MODE): int,
         vol.Optional(CONF_MIN_SEC, DEFAULT_MIN_SEC): float,
         vol.Optional(CONF_SILENCE_SEC, DEFAULT_SILENCE_SEC): float,
-        vol.Optional(CONF_TIMEOUT_SEC, DEFAULT_TIMEOUT_SEC): float
+        vol.Optional(CONF_TIMEOUT_SEC, DEFAULT_TIMEOUT_SEC): float,
+        vol.Optional(CONF_PREROLL_SEC, DEFAULT_PREROLL_SEC): float,
+        vol.Optional(CONF_TRIM_SILENCE, DEFAULT_TRIM_SILENCE): cv.boolean,
+        vol.Optional(CONF_TRIM_PADDING_SEC, DEFAULT_TRIM_PADDING_SEC): float,
+
+        vol.Optional(CONF_DECODER_POOL_SIZE, DEFAULT_DECODER_POOL_SIZE):
+            vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_STREAMING, DEFAULT_STREAMING): cv.boolean,
+        vol.Optional(CONF_PARTIAL_RESULTS, DEFAULT_PARTIAL_RESULTS): cv.boolean,
+        vol.Optional(CONF_PARTIAL_INTERVAL_SEC, DEFAULT_PARTIAL_INTERVAL_SEC): float,
+        vol.Optional(CONF_SENTENCES, DEFAULT_SENTENCES): cv.string,
+        vol.Optional(CONF_EARLY_STOP_STABLE_SEC, DEFAULT_EARLY_STOP_STABLE_SEC): float,
+        vol.Optional(CONF_EARLY_STOP_SILENCE_SEC, DEFAULT_EARLY_STOP_SILENCE_SEC): float,
+        vol.Optional(CONF_RESAMPLER, DEFAULT_RESAMPLER):
+            vol.In([RESAMPLER_NUMPY, RESAMPLER_SOX])
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -119,6 +306,13 @@ CONFIG_SCHEMA = vol.Schema({
 # Starts listening for commands on the configured microphone
 SERVICE_LISTEN = 'listen'
 
+# Overrides streaming setting for a single command (CONF_STREAMING)
+ATTR_STREAMING = 'streaming'
+
+SCHEMA_SERVICE_LISTEN = vol.Schema({
+    vol.Optional(ATTR_STREAMING): cv.boolean
+})
+
 # Performs speech to text with recorded (or POSTed) WAV data
 SERVICE_DECODE = 'decode_wav'
 
@@ -126,16 +320,38 @@ SERVICE_DECODE = 'decode_wav'
 ATTR_FILENAME = 'filename'
 
 # Raw WAV data to load directly (includes header, etc.)
+# Either bytes or a list of byte values (from JSON).
 ATTR_DATA = 'data'
 
 SCHEMA_SERVICE_DECODE = vol.Schema({
     vol.Optional(ATTR_FILENAME): cv.string,
-    vol.Optional(ATTR_DATA): list
+    vol.Optional(ATTR_DATA): vol.Any(list, bytes, bytearray)
 })
 
-# Clears cached decoder (used after re-training)
+# Reloads decoders in the background (used after re-training)
 SERVICE_RESET = 'reset'
 
+# Decodes many WAV files in parallel (one decoder per process) and writes the
+# results as JSON lines. Each line has the filename, text, audio_sec,
+# decode_sec, and real-time factor (rtf = decode_sec / audio_sec).
+SERVICE_DECODE_BATCH = 'decode_batch'
+
+# Directory with WAV files (searched recursively) or a manifest file with one
+# WAV path per line. Relative paths in a manifest are relative to its directory.
+ATTR_PATH = 'path'
+
+# File path to write JSON lines to
+ATTR_OUTPUT = 'output'
+
+# Number of worker processes (defaults to the number of CPUs)
+ATTR_PROCESSES = 'processes'
+
+SCHEMA_SERVICE_DECODE_BATCH = vol.Schema({
+    vol.Required(ATTR_PATH): cv.string,
+    vol.Required(ATTR_OUTPUT): cv.string,
+    vol.Optional(ATTR_PROCESSES): vol.All(int, vol.Range(min=1))
+})
+
 # Represents the listener and decoder
 OBJECT_POCKETSPHINX = '%s.pocketsphinx' % DOMAIN
 
@@ -157,6 +373,623 @@ EVENT_SPEECH_RECORDED = 'speech_recorded'
 # Fired when decoding has finished
 EVENT_SPEECH_TO_TEXT = 'speech_to_text'
 
+# Fired with the current hypothesis while decoding (see CONF_PARTIAL_RESULTS)
+EVENT_SPEECH_TO_TEXT_PARTIAL = 'speech_to_text_partial'
+
+# Fired when a decode_batch has finished (with a summary of the results)
+EVENT_BATCH_DECODED = 'speech_batch_decoded'
+
+# Names of pocketsphinx searches
+SEARCH_LM = 'lm'
+SEARCH_LM_EXAMPLE = 'lm_example'
+SEARCH_GRAMMAR = 'grammar'
+SEARCH_KWS = 'kws'  # hotword (see CONF_HOTWORD)
+
+# Number of samples VAD looks at when trimming silence (30 ms at 16Khz)
+TRIM_CHUNK_SIZE = 480
+
+# Number of bytes to decode at a time when reporting partial results
+# (100 ms of 16-bit 16Khz mono audio).
+PARTIAL_CHUNK_SIZE = 3200
+
+# ------------------
+# WebSocket messages
+# ------------------
+# JSON messages are sent in text frames with a "type" property.
+# Audio is sent by the client in binary frames between "start" and "end".
+# A session can contain any number of start/end pairs.
+
+# Client -> server: starts an utterance.
+# Optional: rate, width, channels (defaults to 16Khz, 16-bit, mono) and
+# partial (true to receive partial messages).
+WS_TYPE_START = 'start'
+
+# Client -> server: ends the utterance.
+WS_TYPE_END = 'end'
+
+# Server -> client: current hypothesis (with "text").
+WS_TYPE_PARTIAL = 'partial'
+
+# Server -> client: final hypothesis (with "text").
+WS_TYPE_FINAL = 'final'
+
+# Server -> client: something went wrong (with "message").
+WS_TYPE_ERROR = 'error'
+
+# Number of audio frames that can be waiting to be decoded in a WebSocket
+# session. Beyond this, the server stops reading from the socket until the
+# decoder catches up.
+WS_MAX_QUEUED_CHUNKS = 50
+
+# Seconds a WebSocket utterance can go without a message before it's
+# cancelled (so an idle client can't hold a decoder).
+WS_IDLE_TIMEOUT_SEC = 5.0
+
+# -----------------------------------------------------------------------------
+
+class DecoderPool(object):
+    """Fixed-size pool of pocketsphinx decoders, loaded in the background."""
+
+    def __init__(self, size, make_decoder, on_change=None):
+        self._size = size
+        self._make_decoder = make_decoder
+        self._on_change = on_change
+        self._logger = logging.getLogger(__name__)
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._generation = 0
+
+        # Exception from the last load if it failed
+        self.load_error = None
+
+        # Statistics
+        self.loaded = 0
+        self.waiting = 0
+        self.leases = 0
+        self.last_wait_sec = 0.0
+        self.total_wait_sec = 0.0
+
+    def load(self):
+        """(Re-)loads all decoders in a background thread.
+
+        Decoders leased from a previous load are discarded when released.
+        """
+        with self._cond:
+            self._generation += 1
+            self._idle = []
+            self.loaded = 0
+            self.load_error = None
+            generation = self._generation
+
+        thread = threading.Thread(target=self._load_decoders,
+                                  args=(generation,), daemon=True)
+        thread.start()
+
+    def _load_decoders(self, generation):
+        # Load one at a time to avoid a memory/CPU spike at startup
+        for i in range(self._size):
+            self._logger.debug('Loading decoder %s/%s' % (i + 1, self._size))
+            try:
+                decoder = self._make_decoder()
+            except Exception as e:
+                self._logger.exception('Failed to load decoder')
+                with self._cond:
+                    if generation == self._generation:
+                        self.load_error = e
+                        self._cond.notify_all()  # wake up lease
+
+                return
+
+            with self._cond:
+                if generation != self._generation:
+                    return  # reset while loading
+
+                self._idle.append(decoder)
+                self.loaded += 1
+                self._cond.notify()
+
+            if self._on_change is not None:
+                self._on_change()
+
+    @contextmanager
+    def lease(self):
+        """Borrows a decoder, waiting for one to become free if necessary.
+
+        Raises RuntimeError if no decoders could be loaded (instead of waiting
+        forever).
+        """
+        start_time = time.time()
+        with self._cond:
+            self.waiting += 1
+            try:
+                while len(self._idle) == 0:
+                    if (self.load_error is not None) and (self.loaded == 0):
+                        raise RuntimeError('No decoders loaded: %s' % \
+                                           self.load_error)
+
+                    self._cond.wait()
+            finally:
+                self.waiting -= 1
+
+            decoder = self._idle.pop()
+            generation = self._generation
+
+            self.leases += 1
+            self.last_wait_sec = time.time() - start_time
+            self.total_wait_sec += self.last_wait_sec
+
+        try:
+            yield decoder
+        finally:
+            with self._cond:
+                if generation == self._generation:
+                    self._idle.append(decoder)
+                    self._cond.notify()
+
+    @property
+    def stats(self):
+        """Pool statistics (suitable for state attributes)."""
+        with self._cond:
+            avg_wait_sec = 0.0
+            if self.leases > 0:
+                avg_wait_sec = self.total_wait_sec / self.leases
+
+            return {
+                'decoders_loaded': self.loaded,
+                'decoders_busy': self.loaded - len(self._idle),
+                'queue_depth': self.waiting,
+                'wait_sec': round(self.last_wait_sec, 3),
+                'avg_wait_sec': round(avg_wait_sec, 3)
+            }
+
+# -----------------------------------------------------------------------------
+
+class PartialResults(object):
+    """Reports changes to the partial hypothesis, at most once per interval."""
+
+    def __init__(self, callback, interval_sec):
+        self._callback = callback
+        self._interval_sec = interval_sec
+        self._last_time = 0.0
+        self._last_text = None
+
+    def update(self, decoder):
+        """Checks the decoder's current hypothesis (call after process_raw)."""
+        now = time.time()
+        if (now - self._last_time) < self._interval_sec:
+            return
+
+        self._last_time = now
+        hyp = decoder.hyp()
+        if hyp and hyp.hypstr and (hyp.hypstr != self._last_text):
+            self._last_text = hyp.hypstr
+            self._callback(hyp.hypstr)
+
+# -----------------------------------------------------------------------------
+
+class SentenceTracker(object):
+    """Watches the partial hypothesis for a complete training sentence."""
+
+    def __init__(self, sentences, stable_sec, interval_sec=EARLY_STOP_INTERVAL_SEC):
+        self._sentences = sentences
+        self._stable_sec = stable_sec
+        self._interval_sec = interval_sec
+        self._last_time = 0.0
+
+        # Updated from the decoding thread, read from the recording thread
+        self._text = None
+        self._changed_time = None
+
+    def update(self, decoder):
+        """Checks the decoder's current hypothesis (call after process_raw)."""
+        now = time.time()
+        if (now - self._last_time) < self._interval_sec:
+            return
+
+        self._last_time = now
+        hyp = decoder.hyp()
+        text = ' '.join(hyp.hypstr.split()) if hyp and hyp.hypstr else None
+        if text != self._text:
+            self._text, self._changed_time = text, now
+
+    def is_complete(self):
+        """True if the hypothesis is a training sentence and has been stable."""
+        text, changed_time = self._text, self._changed_time
+        return (text is not None) and (text in self._sentences) and \
+            ((time.time() - changed_time) >= self._stable_sec)
+
+# -----------------------------------------------------------------------------
+
+class StreamingDecoder(object):
+    """Decodes audio in a background thread as it's being recorded."""
+
+    def __init__(self, pool, search, partials=None, max_chunks=0,
+                 keep_audio=False, tracker=None):
+        self._pool = pool
+        self._search = search
+        self._partials = partials
+        self._tracker = tracker
+        self._chunks = queue.Queue(maxsize=max_chunks)  # 0 is unbounded
+        self._finished = False
+        self._finish_time = None
+        self._thread = None
+
+        self.text = None
+        self.confidence = 0.0
+
+        # Seconds from finish() to the final hypothesis
+        self.finish_sec = None
+
+        # Decoded audio (if keep_audio is True)
+        self.audio = bytearray() if keep_audio else None
+
+    def start(self):
+        """Leases a decoder and starts an utterance."""
+        self._thread = threading.Thread(target=self._decode, daemon=True)
+        self._thread.start()
+
+    def feed(self, chunk):
+        """Queues a chunk of 16-bit 16Khz mono audio (never blocks).
+
+        Raises queue.Full if max_chunks are already waiting to be decoded.
+        """
+        self._chunks.put_nowait(chunk)
+
+    def feed_wait(self, chunk):
+        """Queues a chunk of audio, waiting for room if necessary."""
+        self._chunks.put(chunk)
+
+    def finish(self):
+        """Signals the end of the utterance (never blocks)."""
+        self._finished = True
+        self._finish_time = time.time()
+        try:
+            self._chunks.put_nowait(None)
+        except queue.Full:
+            pass  # checked after each chunk
+
+    def cancel(self):
+        """Drops audio that wasn't decoded yet and ends the utterance."""
+        try:
+            while True:
+                self._chunks.get_nowait()
+        except queue.Empty:
+            pass
+
+        self.finish()
+
+    def wait(self):
+        """Waits for the final hypothesis and returns its text."""
+        self._thread.join()
+        return self.text
+
+    def _decode(self):
+        remainder = b''  # odd byte from the previous chunk
+        with self._pool.lease() as decoder:
+            decoder.set_search(self._search)
+            decoder.start_utt()
+            try:
+                while True:
+                    chunk = self._chunks.get()
+                    if chunk is None:
+                        break  # end of utterance
+
+                    # Only decode whole 16-bit samples
+                    if len(remainder) > 0:
+                        chunk = remainder + chunk
+                        remainder = b''
+
+                    if (len(chunk) % 2) != 0:
+                        remainder = chunk[-1:]
+                        chunk = chunk[:-1]
+
+                    decoder.process_raw(chunk, False, False)
+                    if self._partials is not None:
+                        self._partials.update(decoder)
+
+                    if self._tracker is not None:
+                        self._tracker.update(decoder)
+
+                    if self.audio is not None:
+                        self.audio += chunk
+
+                    if self._finished and self._chunks.empty():
+                        break  # end of utterance (queue was full)
+            finally:
+                decoder.end_utt()
+
+            self.text, self.confidence = get_hypothesis(decoder)
+
+        if self._finish_time is not None:
+            self.finish_sec = time.time() - self._finish_time
+
+# -----------------------------------------------------------------------------
+
+def convert_wav_sox(data, filename=None):
+    """
+    Converts WAV data to 16-bit 16Khz mono with sox.
+
+    Arguments:
+    data -- WAV data (with header)
+    filename -- path to the same WAV data on disk (optional, avoids a copy)
+
+    Returns:
+    converted audio frames (no header)
+    """
+    if shutil.which('sox') is None:
+        _LOGGER.error("'sox' command not found. Cannot convert WAV file to appropriate format. Expect poor performance.")
+        with io.BytesIO(data) as wav_data:
+            with wave.open(wav_data, mode='rb') as wav_file:
+                return wav_file.readframes(wav_file.getnframes())
+
+    temp_input_file = None
+    if filename is None:
+        # Need to write original WAV data out to a file for sox
+        temp_input_file = tempfile.NamedTemporaryFile(suffix='.wav', mode='wb+')
+        temp_input_file.write(data)
+        temp_input_file.flush()
+        filename = temp_input_file.name
+
+    try:
+        # sox <IN> -r 16000 -e signed-integer -b 16 -c 1 <OUT>
+        with tempfile.NamedTemporaryFile(suffix='.wav', mode='wb+') as out_wav_file:
+            subprocess.check_call(['sox',
+                                   filename,
+                                   '-r', '16000',
+                                   '-e', 'signed-integer',
+                                   '-b', '16',
+                                   '-c', '1',
+                                   out_wav_file.name])
+
+            out_wav_file.seek(0)
+
+            # Use converted data
+            with wave.open(out_wav_file, 'rb') as wav_file:
+                return wav_file.readframes(wav_file.getnframes())
+    finally:
+        if temp_input_file is not None:
+            # Clean up temporary file
+            temp_input_file.close()
+
+# -----------------------------------------------------------------------------
+
+def load_decoder(acoustic_model, dictionary, language_model=None,
+                 language_model_example=None, grammar=None,
+                 keyphrases=None):
+    """
+    Loads a pocketsphinx decoder (slow).
+
+    The language models, grammar, and keyphrases are added as named searches
+    (SEARCH_LM, SEARCH_LM_EXAMPLE, SEARCH_GRAMMAR, and SEARCH_KWS). Use
+    decoder.set_search to pick one before each utterance.
+    """
+    from pocketsphinx import Pocketsphinx
+    decoder = Pocketsphinx(
+        hmm=acoustic_model,
+        lm=False,
+        dic=dictionary)
+
+    if language_model is not None:
+        decoder.set_lm_file(SEARCH_LM, language_model)
+
+    if language_model_example is not None:
+        decoder.set_lm_file(SEARCH_LM_EXAMPLE, language_model_example)
+
+    if grammar is not None:
+        decoder.set_jsgf_file(SEARCH_GRAMMAR, grammar)
+
+    if keyphrases is not None:
+        set_keyphrases(decoder, SEARCH_KWS, keyphrases)
+
+    return decoder
+
+def load_sentences(sentences_path):
+    """Loads training sentences (one per line) into a set.
+
+    Returns None if the file doesn't exist yet (it's written by training).
+    """
+    if not os.path.exists(sentences_path):
+        _LOGGER.warning('Sentences file %s not found (train first). Early stopping is disabled.' % sentences_path)
+        return None
+
+    with open(sentences_path, 'r') as sentences_file:
+        sentences = set(' '.join(line.split()) for line in sentences_file)
+
+    sentences.discard('')
+    _LOGGER.debug('Loaded %s sentence(s) for early stopping' % len(sentences))
+
+    return sentences
+
+def get_hypothesis(decoder):
+    """Returns the text and confidence (posterior probability) of the decoder's hypothesis."""
+    hyp = decoder.hyp()
+    if hyp and hyp.hypstr:
+        return hyp.hypstr, decoder.get_logmath().exp(hyp.prob)
+
+    return None, 0.0
+
+def decode_utterance(decoder, data, search, partials=None):
+    """
+    Decodes 16-bit 16Khz mono audio as a complete utterance.
+
+    Arguments:
+    decoder -- pocketsphinx decoder from load_decoder
+    data -- bytes-like object with audio
+    search -- name of search to use (SEARCH_*)
+    partials -- PartialResults to update while decoding (optional)
+
+    Returns:
+    (text, confidence)
+    """
+    decoder.set_search(search)
+    decoder.start_utt()
+    if partials is None:
+        # Process audio data as a complete utterance (best performance)
+        decoder.process_raw(data, False, True)  # full utterance
+    else:
+        # Process in chunks to report partial results
+        view = memoryview(data)
+        for i in range(0, len(view), PARTIAL_CHUNK_SIZE):
+            decoder.process_raw(view[i:i+PARTIAL_CHUNK_SIZE], False, False)
+            partials.update(decoder)
+
+    decoder.end_utt()
+
+    return get_hypothesis(decoder)
+
+def needs_fallback(result, threshold):
+    """True if a first pass result from decode_cascade has low confidence."""
+    return (result['text'] is None) or (result['confidence'] < threshold)
+
+def decode_fallback(decoder, data, result):
+    """Decodes audio again with the language model, updating a decode_cascade result."""
+    start_time = time.time()
+    result['text'], result['confidence'] = decode_utterance(decoder, data, SEARCH_LM)
+    result['fallback'] = True
+    result['second_pass_sec'] = time.time() - start_time
+
+    return result
+
+def decode_cascade(decoder, data, first_search, threshold, partials=None):
+    """
+    Decodes audio with a fast search first, and again with the language model
+    if the first pass has low confidence.
+
+    Returns:
+    dictionary with text, confidence, fallback (True if second pass was
+    needed), first_pass_sec, and second_pass_sec (None if no fallback)
+    """
+    start_time = time.time()
+    text, confidence = decode_utterance(decoder, data, first_search, partials)
+    result = {
+        'text': text,
+        'confidence': confidence,
+        'fallback': False,
+        'first_pass_sec': time.time() - start_time,
+        'second_pass_sec': None
+    }
+
+    if needs_fallback(result, threshold):
+        decode_fallback(decoder, data, result)
+
+    return result
+
+# -----------------------------------------------------------------------------
+# Batch decoding
+# -----------------------------------------------------------------------------
+
+# Decoder and settings for the current batch worker process
+_batch_decoder = None
+_batch_search = None
+_batch_cascade_threshold = None
+
+def _init_batch_worker(decoder_args, search, cascade_threshold):
+    global _batch_decoder, _batch_search, _batch_cascade_threshold
+    _batch_decoder = load_decoder(**decoder_args)
+    _batch_search = search
+    _batch_cascade_threshold = cascade_threshold
+
+def _decode_batch_file(wav_path):
+    """Decodes a single WAV file in a batch worker process."""
+    start_time = time.time()
+    result = { 'filename': wav_path }
+
+    try:
+        with open(wav_path, 'rb') as wav_file:
+            data = wav_file.read()
+
+        frames, rate, width, channels = parse_wav(data)
+        result['audio_sec'] = len(frames) / (rate * width * channels)
+        if (rate != 16000) or (width != 2) or (channels != 1):
+            frames = convert_audio(frames, rate, width, channels)
+
+        if _batch_cascade_threshold is None:
+            result['text'], result['confidence'] = decode_utterance(
+                _batch_decoder, frames, _batch_search)
+        else:
+            cascade = decode_cascade(_batch_decoder, frames, _batch_search,
+                                     _batch_cascade_threshold)
+            result.update(cascade)
+    except Exception as e:
+        result['error'] = str(e)
+
+    result['decode_sec'] = time.time() - start_time
+    if result.get('audio_sec', 0) > 0:
+        result['rtf'] = result['decode_sec'] / result['audio_sec']
+
+    return result
+
+def read_batch_paths(path):
+    """Returns WAV paths from a directory (recursively) or manifest file."""
+    if os.path.isdir(path):
+        return sorted(os.path.join(dir_path, file_name)
+                      for dir_path, dir_names, file_names in os.walk(path)
+                      for file_name in file_names
+                      if file_name.lower().endswith('.wav'))
+
+    # Manifest file
+    base_dir = os.path.dirname(os.path.abspath(path))
+    wav_paths = []
+    with open(path, 'r') as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if (len(line) == 0) or line.startswith('#'):
+                continue
+
+            wav_paths.append(os.path.join(base_dir, os.path.expanduser(line)))
+
+    return wav_paths
+
+def decode_batch(wav_paths, output_path, decoder_args, search=SEARCH_LM,
+                 cascade_threshold=None, processes=None):
+    """
+    Decodes WAV files across a pool of processes.
+
+    Arguments:
+    wav_paths -- list of WAV file paths
+    output_path -- file path to write JSON lines to (one per WAV file)
+    decoder_args -- keyword arguments for load_decoder
+    search -- name of pocketsphinx search to use (SEARCH_*)
+    cascade_threshold -- if not None, search is the first pass of a cascade
+    processes -- number of worker processes (None for number of CPUs)
+
+    Returns:
+    summary dictionary (files, errors, audio_sec, decode_sec, rtf)
+    """
+    import multiprocessing
+
+    # Don't fork Home Assistant's threads
+    context = multiprocessing.get_context('spawn')
+
+    summary = { 'files': 0, 'errors': 0, 'fallbacks': 0,
+                'audio_sec': 0.0, 'decode_sec': 0.0 }
+    start_time = time.time()
+
+    with open(output_path, 'w') as output_file:
+        with context.Pool(processes, _init_batch_worker,
+                          (decoder_args, search, cascade_threshold)) as workers:
+            for result in workers.imap_unordered(_decode_batch_file, wav_paths,
+                                                 chunksize=4):
+                print(json.dumps(result), file=output_file)
+
+                summary['files'] += 1
+                if 'error' in result:
+                    summary['errors'] += 1
+                    _LOGGER.warning('Failed to decode %s: %s' % (result['filename'], result['error']))
+                else:
+                    summary['audio_sec'] += result['audio_sec']
+                    summary['decode_sec'] += result['decode_sec']
+                    if result.get('fallback', False):
+                        summary['fallbacks'] += 1
+
+    summary['elapsed_sec'] = time.time() - start_time
+    if summary['audio_sec'] > 0:
+        # Real-time factor of the whole batch (wall clock)
+        summary['rtf'] = summary['elapsed_sec'] / summary['audio_sec']
+
+    return summary
+
 # -----------------------------------------------------------------------------
 
 @asyncio.coroutine
@@ -166,6 +999,26 @@ def async_setup(hass, config):
     language_model = os.path.expanduser(config[DOMAIN].get(CONF_LANGUAGE_MODEL, DEFAULT_LANGUAGE_MODEL))
     dictionary = os.path.expanduser(config[DOMAIN].get(CONF_DICTIONARY, DEFAULT_DICTIONARY))
 
+    grammar = config[DOMAIN].get(CONF_GRAMMAR, DEFAULT_GRAMMAR)
+    if grammar is not None:
+        grammar = os.path.expanduser(grammar)
+
+    language_model_example = config[DOMAIN].get(CONF_LANGUAGE_MODEL_EXAMPLE, DEFAULT_LANGUAGE_MODEL_EXAMPLE)
+    if language_model_example is not None:
+        language_model_example = os.path.expanduser(language_model_example)
+
+    decode_mode = config[DOMAIN].get(CONF_DECODE_MODE, DEFAULT_DECODE_MODE)
+    if (decode_mode == DECODE_MODE_GRAMMAR) and (grammar is None):
+        _LOGGER.error('A grammar is required for decode mode %s' % decode_mode)
+        return False
+
+    if (decode_mode == DECODE_MODE_CASCADE) and \
+       (grammar is None) and (language_model_example is None):
+        _LOGGER.error('A grammar or example language model is required for decode mode %s' % decode_mode)
+        return False
+
+    cascade_threshold = config[DOMAIN].get(CONF_CASCADE_THRESHOLD, DEFAULT_CASCADE_THRESHOLD)
+
     audio_device_index = config[DOMAIN].get(CONF_AUDIO_DEVICE, DEFAULT_AUDIO_DEVICE)
     if (audio_device_index is not None) and  (audio_device_index < 0):
         audio_device_index = None  # default device
@@ -175,30 +1028,42 @@ def async_setup(hass, config):
     sample_rate = config[DOMAIN].get(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE)
     buffer_size = config[DOMAIN].get(CONF_BUFFER_SIZE, DEFAULT_BUFFER_SIZE)
 
-    # Set up voice activity detection (VAD)
-    import webrtcvad
+    # Voice activity detection (VAD) aggressiveness
     vad_mode = config[DOMAIN].get(CONF_VAD_MODE, DEFAULT_VAD_MODE)
     assert 0 <= vad_mode <= 3, 'VAD mode must be in [0-3]'
-    vad = webrtcvad.Vad()
-    vad.set_mode(vad_mode)  # agressiveness (0-3)
 
     # Controls how phrase is recorded
     min_sec = config[DOMAIN].get(CONF_MIN_SEC, DEFAULT_MIN_SEC)
     silence_sec = config[DOMAIN].get(CONF_SILENCE_SEC, DEFAULT_SILENCE_SEC)
     timeout_sec = config[DOMAIN].get(CONF_TIMEOUT_SEC, DEFAULT_TIMEOUT_SEC)
-    seconds_per_buffer = buffer_size / sample_rate
-
-    # Speech-to-text decoder will be loaded on the fly
-    from pocketsphinx import Pocketsphinx, Ad
-    decoder = None
+    preroll_sec = config[DOMAIN].get(CONF_PREROLL_SEC, DEFAULT_PREROLL_SEC)
+    trim_silence = config[DOMAIN].get(CONF_TRIM_SILENCE, DEFAULT_TRIM_SILENCE)
+    trim_padding_sec = config[DOMAIN].get(CONF_TRIM_PADDING_SEC, DEFAULT_TRIM_PADDING_SEC)
+
+    # Audio from just before speech starts (preallocated)
+    preroll = RingBuffer(int(preroll_sec * sample_rate) * sample_width * channels)
+    streaming = config[DOMAIN].get(CONF_STREAMING, DEFAULT_STREAMING)
+    partial_results = config[DOMAIN].get(CONF_PARTIAL_RESULTS, DEFAULT_PARTIAL_RESULTS)
+    partial_interval_sec = config[DOMAIN].get(CONF_PARTIAL_INTERVAL_SEC, DEFAULT_PARTIAL_INTERVAL_SEC)
+    resampler = config[DOMAIN].get(CONF_RESAMPLER, DEFAULT_RESAMPLER)
+
+    # Stop recording early when a training sentence is recognized
+    sentences_path = config[DOMAIN].get(CONF_SENTENCES, DEFAULT_SENTENCES)
+    sentences = None
+    if sentences_path is not None:
+        sentences_path = os.path.expanduser(sentences_path)
+        sentences = load_sentences(sentences_path)
+
+    early_stop_stable_sec = config[DOMAIN].get(CONF_EARLY_STOP_STABLE_SEC, DEFAULT_EARLY_STOP_STABLE_SEC)
+    early_stop_silence_sec = config[DOMAIN].get(CONF_EARLY_STOP_SILENCE_SEC, DEFAULT_EARLY_STOP_SILENCE_SEC)
+    early_stops = 0
 
     import pyaudio
     data_format = pyaudio.get_format_from_width(sample_width)
 
     # Events for asynchronous recording/decoding
     recorded_event = threading.Event()
-    decoded_event = threading.Event()
-    decoded_phrase = None
+    pending_events = set()
     terminated = False
 
     # -------------------------------------------------------------------------
@@ -209,100 +1074,350 @@ def async_setup(hass, config):
         'text': ''
     }
 
+    current_state = STATE_LOADING
+
+    def set_state(state):
+        nonlocal current_state
+        current_state = state
+        state_attrs.update(pool.stats)
+        with cascade_lock:
+            state_attrs.update(cascade_stats)
+        hass.states.async_set(OBJECT_POCKETSPHINX, state, state_attrs)
+
+    def pool_changed():
+        # Called from the pool's loading thread
+        def update_state():
+            if current_state == STATE_LOADING:
+                set_state(STATE_IDLE)  # at least one decoder is ready
+            else:
+                set_state(current_state)
+
+        hass.loop.call_soon_threadsafe(update_state)
+
+    # Speech-to-text decoders are loaded in the background
+    # Only load what the decode mode needs
+    decoder_args = {
+        'acoustic_model': acoustic_model,
+        'dictionary': dictionary
+    }
+
+    if decode_mode == DECODE_MODE_GRAMMAR:
+        decoder_args['grammar'] = grammar
+        search = SEARCH_GRAMMAR
+    elif decode_mode == DECODE_MODE_CASCADE:
+        # Fast search first, language model as a fallback
+        decoder_args['language_model'] = language_model
+        if grammar is not None:
+            decoder_args['grammar'] = grammar
+            search = SEARCH_GRAMMAR
+        else:
+            decoder_args['language_model_example'] = language_model_example
+            search = SEARCH_LM_EXAMPLE
+    else:
+        decoder_args['language_model'] = language_model
+        search = SEARCH_LM
+
+    # Statistics for cascade mode (updated from decoding threads)
+    cascade_stats = {}
+    cascade_lock = threading.Lock()
+    cascade_decodes = 0
+    cascade_fallbacks = 0
+
+    def record_cascade(result):
+        nonlocal cascade_decodes, cascade_fallbacks
+        with cascade_lock:
+            cascade_decodes += 1
+            if result['fallback']:
+                cascade_fallbacks += 1
+                cascade_stats['second_pass_sec'] = round(result['second_pass_sec'], 3)
+
+            cascade_stats['first_pass_sec'] = round(result['first_pass_sec'], 3)
+            cascade_stats['confidence'] = round(result['confidence'], 3)
+            cascade_stats['fallbacks'] = cascade_fallbacks
+            cascade_stats['fallback_rate'] = round(cascade_fallbacks / cascade_decodes, 3)
+
+    # Keyword search for hotword_pocketsphinx (only in pooled decoders)
+    hotword = config[DOMAIN].get(CONF_HOTWORD, DEFAULT_HOTWORD)
+    hotword_threshold = config[DOMAIN].get(CONF_HOTWORD_THRESHOLD, DEFAULT_HOTWORD_THRESHOLD)
+    keyphrases = None
+    if hotword is not None:
+        keyphrases = get_keyphrases(hotword, hotword_threshold)
+
+    def make_decoder():
+        return load_decoder(keyphrases=keyphrases, **decoder_args)
+
+    pool_size = config[DOMAIN].get(CONF_DECODER_POOL_SIZE, DEFAULT_DECODER_POOL_SIZE)
+    pool = DecoderPool(pool_size, make_decoder, on_change=pool_changed)
+
+    if hotword is not None:
+        # Share decoders with hotword_pocketsphinx
+        hass.data[DOMAIN] = pool
+        state_attrs['hotwords'] = [phrase for phrase, _ in keyphrases]
+
+    def fire_partial(text):
+        # Called from decoding threads
+        hass.bus.fire(EVENT_SPEECH_TO_TEXT_PARTIAL, {
+            'name': name,  # name of the component
+            'text': text
+        })
+
+    def make_partials(on_partial=None):
+        callbacks = []
+        if partial_results:
+            callbacks.append(fire_partial)
+
+        if on_partial is not None:
+            callbacks.append(on_partial)
+
+        if len(callbacks) == 0:
+            return None
+
+        def report(text):
+            for callback in callbacks:
+                callback(text)
+
+        return PartialResults(report, partial_interval_sec)
+
+    def decode_data(data):
+        """Decodes 16-bit 16Khz mono audio with a leased decoder."""
+        partials = make_partials()
+        with pool.lease() as decoder:
+            if decode_mode == DECODE_MODE_CASCADE:
+                result = decode_cascade(decoder, data, search,
+                                        cascade_threshold, partials=partials)
+                record_cascade(result)
+                return result['text']
+
+            text, confidence = decode_utterance(decoder, data, search,
+                                                partials=partials)
+            return text
+
+    def wait_streaming(streamer):
+        """Waits for the final hypothesis of a StreamingDecoder."""
+        text = streamer.wait()
+        if decode_mode != DECODE_MODE_CASCADE:
+            return text
+
+        # Streamed audio was the first pass
+        result = {
+            'text': text,
+            'confidence': streamer.confidence,
+            'fallback': False,
+            'first_pass_sec': streamer.finish_sec or 0.0,
+            'second_pass_sec': None
+        }
+
+        if needs_fallback(result, cascade_threshold):
+            with pool.lease() as decoder:
+                decode_fallback(decoder, streamer.audio, result)
+
+        record_cascade(result)
+        return result['text']
+
+    def make_streaming(partials=None, max_chunks=0, tracker=None):
+        return StreamingDecoder(pool, search,
+                                partials=partials,
+                                max_chunks=max_chunks,
+                                keep_audio=(decode_mode == DECODE_MODE_CASCADE),
+                                tracker=tracker)
+
+    @asyncio.coroutine
+    def async_run_thread(target, *args):
+        """Runs target in a daemon thread and waits for it to finish.
+
+        Returns None immediately if Home Assistant is stopped first.
+        """
+        result = None
+        done_event = threading.Event()
+
+        def run():
+            nonlocal result
+            try:
+                result = target(*args)
+            except Exception:
+                _LOGGER.exception('Decoding failed')
+            finally:
+                done_event.set()
+
+        pending_events.add(done_event)
+        try:
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            yield from hass.loop.run_in_executor(None, done_event.wait)
+        finally:
+            pending_events.discard(done_event)
+
+        return result
+
+    @asyncio.coroutine
+    def async_decode_data(data, streamer=None, speech_end_time=None):
+        """Decodes audio data, updating state and firing events.
+
+        If streamer is given, its final hypothesis is used instead of
+        decoding data again. If speech_end_time is given, the time from the
+        end of speech to the final hypothesis is reported.
+        """
+        set_state(STATE_DECODING)
+        if streamer is not None:
+            decoded_phrase = yield from async_run_thread(wait_streaming, streamer)
+        else:
+            decoded_phrase = yield from async_run_thread(decode_data, data)
+
+        if not terminated:
+            state_attrs['text'] = decoded_phrase
+
+            if speech_end_time is not None:
+                # Latency from end of speech to text
+                latency_sec = round(time.time() - speech_end_time, 3)
+                mode = 'streaming' if streamer is not None else 'batch'
+                _LOGGER.debug('Decoded in %s second(s) (%s)' % (latency_sec, mode))
+
+                state_attrs['latency_sec'] = latency_sec
+                state_attrs['%s_latency_sec' % mode] = latency_sec
+
+            set_state(STATE_IDLE)
+
+            # Fire decoded event
+            hass.bus.async_fire(EVENT_SPEECH_TO_TEXT, {
+                'name': name,  # name of the component
+                'text': decoded_phrase
+            })
+
+        return decoded_phrase
+
+    # -------------------------------------------------------------------------
+
     @asyncio.coroutine
     def async_listen(call):
-        nonlocal decoded_phrase, terminated
-        decoded_phrase = None
+        nonlocal terminated, early_stops
         terminated = False
 
-        hass.states.async_set(OBJECT_POCKETSPHINX, STATE_LISTENING, state_attrs)
+        set_state(STATE_LISTENING)
 
-        # Recording state
-        max_buffers = int(math.ceil(timeout_sec / seconds_per_buffer))
-        silence_buffers = int(math.ceil(silence_sec / seconds_per_buffer))
-        min_phrase_buffers = int(math.ceil(min_sec / seconds_per_buffer))
-        in_phrase = False
-        after_phrase = False
-        finished = False
+        # Early stopping needs the partial hypothesis while recording
+        tracker = None
+        if sentences is not None:
+            tracker = SentenceTracker(sentences, early_stop_stable_sec)
 
-        recorded_data = bytearray()
+        # Decode while recording
+        streamer = None
+        if call.data.get(ATTR_STREAMING, streaming) or (tracker is not None):
+            streamer = make_streaming(partials=make_partials(), tracker=tracker)
+            streamer.start()
 
-        # PyAudio callback for each buffer from audio device
-        def stream_callback(buf, frame_count, time_info, status):
-            nonlocal max_buffers, silence_buffers, min_phrase_buffers
-            nonlocal in_phrase, after_phrase
-            nonlocal recorded_data, finished
-
-            # Check maximum number of seconds to record
-            max_buffers -= 1
-            if max_buffers <= 0:
-                # Timeout
-                finished = True
-
-                # Reset
-                in_phrase = False
-                after_phrase = False
-
-            # Detect speech in buffer
-            is_speech = vad.is_speech(buf, sample_rate)
-            if is_speech and not in_phrase:
-                # Start of phrase
-                in_phrase = True
-                after_phrase = False
-                recorded_data += buf
-                min_phrase_buffers = int(math.ceil(min_sec / seconds_per_buffer))
-            elif in_phrase and (min_phrase_buffers > 0):
-                # In phrase, before minimum seconds
-                recorded_data += buf
-                min_phrase_buffers -= 1
-            elif in_phrase and is_speech:
-                # In phrase, after minimum seconds
-                recorded_data += buf
-            elif not is_speech:
-                # Outside of speech
-                if after_phrase and (silence_buffers > 0):
-                    # After phrase, before stop
-                    recorded_data += buf
-                    silence_buffers -= 1
-                elif after_phrase and (silence_buffers <= 0):
-                    # Phrase complete
-                    recorded_data += buf
-                    finished = True
-
-                    # Reset
-                    in_phrase = False
-                    after_phrase = False
-                elif in_phrase and (min_phrase_buffers <= 0):
-                    # Transition to after phrase
-                    after_phrase = True
-                    silence_buffers = int(math.ceil(silence_sec / seconds_per_buffer))
-
-            if finished:
+        # Use shared microphone if available
+        hub = get_microphone_hub(hass, sample_rate, sample_width, channels)
+        chunk_size = buffer_size if hub is None else hub.chunk_size
+        endpointer = Endpointer(vad_mode, sample_rate, chunk_size,
+                                min_sec, silence_sec, timeout_sec)
+
+        recorded_data = bytearray()
+        speech_end_time = None
+        stopped_early = False
+
+        preroll.clear()
+
+        def add_buffer(buf):
+            nonlocal recorded_data
+            if len(buf) == 0:
+                return
+
+            recorded_data += buf
+            if streamer is not None:
+                streamer.feed(buf)
+
+        # Called for each buffer from audio device (outside of the PyAudio
+        # callback, so VAD doesn't hold up the audio thread).
+        def process_buffer(buf):
+            nonlocal speech_end_time, stopped_early
+
+            if endpointer.finished:
+                # Ignore audio until the stream is stopped
+                return
+
+            result = endpointer.process(buf)
+            if result == PHRASE_START:
+                # Include audio from just before speech
+                add_buffer(preroll.read_last())
+                add_buffer(buf)
+            elif (result in [PHRASE_CONTINUE, PHRASE_END]) or \
+                 ((result == PHRASE_TIMEOUT) and endpointer.in_phrase):
+                add_buffer(buf)
+
+                # Stop at the end of a complete sentence (ignores min_sec)
+                if (result == PHRASE_CONTINUE) and (tracker is not None) and \
+                   (endpointer.trailing_silence_sec >= early_stop_silence_sec) and \
+                   tracker.is_complete():
+                    endpointer.end_phrase()
+                    stopped_early = True
+            else:
+                # Keep recent audio in case speech starts in the next buffer
+                preroll.write(buf)
+
+            if endpointer.finished:
+                speech_end_time = time.time()
                 recorded_event.set()
 
-            return (buf, pyaudio.paContinue)
+        loop = asyncio.get_event_loop()
+        recorded_event.clear()
 
-        # Open microphone device
-        audio = pyaudio.PyAudio()
-        mic = audio.open(format=data_format,
-                         channels=channels,
-                         rate=sample_rate,
-                         input_device_index=audio_device_index,
-                         input=True,
-                         stream_callback=stream_callback,
-                         frames_per_buffer=buffer_size)
+        if hub is not None:
+            # Read from shared microphone
+            subscription = hub.subscribe()
 
-        loop = asyncio.get_event_loop()
+            def read_hub():
+                while not recorded_event.is_set():
+                    buf = subscription.get()
+                    if buf is None:
+                        break
 
-        # Wait for recorded to complete
-        recorded_event.clear()
-        mic.start_stream()
-        yield from loop.run_in_executor(None, recorded_event.wait)
+                    process_buffer(buf)
 
-        # Stop audio
-        mic.stop_stream()
-        mic.close()
-        audio.terminate()
+            thread = threading.Thread(target=read_hub, daemon=True)
+            thread.start()
+
+            # Wait for recorded to complete
+            yield from loop.run_in_executor(None, recorded_event.wait)
+            subscription.close()
+        else:
+            # PyAudio callback only queues buffers for process_buffer
+            frame_queue = FrameQueue(process_buffer,
+                                     continue_flag=pyaudio.paContinue,
+                                     overflow_flag=pyaudio.paInputOverflow)
+
+            # Open microphone device
+            audio = pyaudio.PyAudio()
+            mic = audio.open(format=data_format,
+                             channels=channels,
+                             rate=sample_rate,
+                             input_device_index=audio_device_index,
+                             input=True,
+                             stream_callback=frame_queue.callback,
+                             frames_per_buffer=buffer_size)
+
+            # Wait for recorded to complete
+            frame_queue.start()
+            mic.start_stream()
+            yield from loop.run_in_executor(None, recorded_event.wait)
+
+            # Stop audio
+            mic.stop_stream()
+            mic.close()
+            audio.terminate()
+            frame_queue.stop()
+
+            # Show that the callback stays short
+            state_attrs.update(frame_queue.stats)
+
+        if streamer is not None:
+            streamer.finish()
+
+        if stopped_early:
+            early_stops += 1
+
+        state_attrs['recorded_sec'] = round(len(recorded_data) / (sample_rate * sample_width), 3)
+        state_attrs['stopped_early'] = stopped_early
+        state_attrs['early_stops'] = early_stops
 
         if not terminated:
             # Fire recorded event
@@ -311,164 +1426,182 @@ def async_setup(hass, config):
                 'size': len(recorded_data)  # bytes of recorded audio data
             })
 
-            hass.states.async_set(OBJECT_POCKETSPHINX, STATE_DECODING, state_attrs)
-
-            def decode():
-                nonlocal decoder, decoded_phrase
-
-                # Dynamically load decoder
-                if decoder is None:
-                    _LOGGER.debug('Loading decoder')
-                    hass.states.async_set(OBJECT_POCKETSPHINX, STATE_LOADING, state_attrs)
-                    decoder = Pocketsphinx(
-                        hmm=acoustic_model,
-                        lm=language_model,
-                        dic=dictionary)
-                    hass.states.async_set(OBJECT_POCKETSPHINX, STATE_DECODING, state_attrs)
-
-                # Do actual decoding
-                with decoder.start_utterance():
-                    decoder.process_raw(recorded_data, False, True)  # full utterance
-                    hyp = decoder.hyp()
-                    if hyp:
-                        with decoder.end_utterance():
-                            decoded_phrase = hyp.hypstr
-
-                decoded_event.set()
-
-            # Decode in separate thread
-            decoded_event.clear()
-            thread = threading.Thread(target=decode, daemon=True)
-            thread.start()
-            yield from loop.run_in_executor(None, decoded_event.wait)
+            yield from async_decode_data(recorded_data, streamer=streamer,
+                                         speech_end_time=speech_end_time)
 
-            if not terminated:
-                thread.join()
-                state_attrs['text'] = decoded_phrase
-                hass.states.async_set(OBJECT_POCKETSPHINX, STATE_IDLE, state_attrs)
+    # -------------------------------------------------------------------------
 
-                # Fire decoded event
-                hass.bus.async_fire(EVENT_SPEECH_TO_TEXT, {
-                    'name': name,  # name of the component
-                    'text': decoded_phrase
-                })
+    def convert(frames, rate, width, channels, wav_data=None, filename=None):
+        """Converts audio to 16-bit 16Khz mono (required by pocketsphinx acoustic models)."""
+        _LOGGER.debug('Need to convert to 16-bit 16Khz mono.')
+        if resampler == RESAMPLER_NUMPY:
+            try:
+                return convert_audio(frames, rate, width, channels)
+            except ImportError:
+                _LOGGER.warning('numpy not available. Falling back to sox.')
 
-    # -------------------------------------------------------------------------
+        if wav_data is None:
+            wav_data = make_wav(frames, rate, width, channels)
+
+        return convert_wav_sox(wav_data, filename)
+
+    def trim(frames):
+        """Removes leading and trailing silence from 16-bit 16Khz mono audio.
+
+        Returns the trimmed audio (a memoryview into frames) and the number
+        of frames that were removed.
+        """
+        endpointer = Endpointer(vad_mode, 16000, TRIM_CHUNK_SIZE,
+                                0, silence_sec)
+
+        span = endpointer.find_speech(frames, padding_sec=trim_padding_sec)
+        if span is None:
+            # Decode everything if VAD doesn't find speech
+            return frames, 0
+
+        start, end = span
+        removed_frames = (len(frames) - (end - start)) // 2
+        return memoryview(frames)[start:end], removed_frames
 
     @asyncio.coroutine
-    def async_decode(call):
-        nonlocal decoded_phrase, terminated
-        decoded_phrase = None
+    def async_decode_audio(frames, rate, width, channels,
+                           wav_data=None, filename=None):
+        """Converts (if necessary), trims, and decodes audio frames.
+
+        frames can be any bytes-like object (e.g., a memoryview into a WAV
+        file). Returns the decoded text.
+        """
+        nonlocal terminated
         terminated = False
 
-        if ATTR_FILENAME in call.data:
-            # Use WAV file
-            filename = call.data[ATTR_FILENAME]
-            with wave.open(filename, mode='rb') as wav_file:
-                data = wav_file.readframes(wav_file.getnframes())
-        else:
-            # Use data directly from JSON
-            filename = None
-            data = bytearray(call.data[ATTR_DATA])
+        _LOGGER.debug('rate=%s, width=%s, channels=%s.' % (rate, width, channels))
+        if (rate != 16000) or (width != 2) or (channels != 1):
+            set_state(STATE_DECODING)
+            frames = yield from async_run_thread(convert, frames, rate, width,
+                                                 channels, wav_data, filename)
 
-        hass.states.async_set(OBJECT_POCKETSPHINX, STATE_DECODING, state_attrs)
+        if trim_silence and (frames is not None) and not terminated:
+            set_state(STATE_DECODING)
+            result = yield from async_run_thread(trim, frames)
+            if result is not None:
+                frames, removed_frames = result
+                _LOGGER.debug('Trimmed %s frame(s) of silence' % removed_frames)
+                state_attrs['trimmed_frames'] = removed_frames
+                state_attrs['trimmed_sec'] = round(removed_frames / 16000, 3)
 
-        def decode():
-            nonlocal decoder, decoded_phrase, data, filename
+        if terminated:
+            return None
 
-            # Check if WAV is in the correct format.
-            # Convert with sox if not.
-            with io.BytesIO(data) as wav_data:
-                with wave.open(wav_data, mode='rb') as wav_file:
-                    rate, width, channels = wav_file.getframerate(), wav_file.getsampwidth(), wav_file.getnchannels()
-                    _LOGGER.debug('rate=%s, width=%s, channels=%s.' % (rate, width, channels))
+        decoded_phrase = yield from async_decode_data(frames)
+        return decoded_phrase
 
-                    if (rate != 16000) or (width != 2) or (channels != 1):
-                        # Convert to 16-bit 16Khz mono (required by pocketsphinx acoustic models)
-                        _LOGGER.debug('Need to convert to 16-bit 16Khz mono.')
-                        if shutil.which('sox') is None:
-                            _LOGGER.error("'sox' command not found. Cannot convert WAV file to appropriate format. Expect poor performance.")
-                        else:
-                            temp_input_file = None
-                            if filename is None:
-                                # Need to write original WAV data out to a file for sox
-                                temp_input_file = tempfile.NamedTemporaryFile(suffix='.wav', mode='wb+')
-                                temp_input_file.write(data)
-                                temp_input_file.seek(0)
-                                filename = temp_input_file.name
-
-                            # sox <IN> -r 16000 -e signed-integer -b 16 -c 1 <OUT>
-                            with tempfile.NamedTemporaryFile(suffix='.wav', mode='wb+') as out_wav_file:
-                                subprocess.check_call(['sox',
-                                                       filename,
-                                                       '-r', '16000',
-                                                       '-e', 'signed-integer',
-                                                       '-b', '16',
-                                                       '-c', '1',
-                                                       out_wav_file.name])
-
-                                out_wav_file.seek(0)
-
-                                # Use converted data
-                                with wave.open(out_wav_file, 'rb') as wav_file:
-                                    data = wav_file.readframes(wav_file.getnframes())
-
-                            if temp_input_file is not None:
-                                # Clean up temporary file
-                                del temp_input_file
-
-            # Dynamically load decoder
-            if decoder is None:
-                _LOGGER.debug('Loading decoder')
-                hass.states.async_set(OBJECT_POCKETSPHINX, STATE_LOADING, state_attrs)
-                decoder = Pocketsphinx(
-                    hmm=acoustic_model,
-                    lm=language_model,
-                    dic=dictionary)
-                hass.states.async_set(OBJECT_POCKETSPHINX, STATE_DECODING, state_attrs)
-
-            # Process WAV data as a complete utterance (best performance)
-            with decoder.start_utterance():
-                decoder.process_raw(data, False, True)  # full utterance
-                if decoder.hyp():
-                    with decoder.end_utterance():
-                        decoded_phrase = decoder.hyp().hypstr
-
-            decoded_event.set()
+    def start_streaming(on_partial=None, max_chunks=0):
+        """Starts decoding a stream of 16-bit 16Khz mono audio.
 
-        loop = asyncio.get_event_loop()
+        on_partial is called from the decoding thread with partial results.
+        """
+        nonlocal terminated
+        terminated = False
 
-        # Decode in separate thread
-        decoded_event.clear()
-        thread = threading.Thread(target=decode, daemon=True)
-        thread.start()
-        yield from loop.run_in_executor(None, decoded_event.wait)
+        set_state(STATE_DECODING)
+        streamer = make_streaming(partials=make_partials(on_partial),
+                                  max_chunks=max_chunks)
+        streamer.start()
 
-        if not terminated:
-            thread.join()
-            state_attrs['text'] = decoded_phrase
-            hass.states.async_set(OBJECT_POCKETSPHINX, STATE_IDLE, state_attrs)
+        return streamer
 
-            # Fire decoded event
-            hass.bus.async_fire(EVENT_SPEECH_TO_TEXT, {
-                'name': name,  # name of the component
-                'text': decoded_phrase
-            })
+    @asyncio.coroutine
+    def async_finish_streaming(streamer):
+        """Ends a stream from start_streaming and returns the decoded text."""
+        streamer.finish()
+        decoded_phrase = yield from async_decode_data(
+            None, streamer=streamer, speech_end_time=time.time())
+
+        return decoded_phrase
+
+    def cancel_streaming(streamer):
+        """Abandons a stream from start_streaming (client went away)."""
+        streamer.cancel()  # returns decoder to the pool
+        set_state(STATE_IDLE)
+
+    @asyncio.coroutine
+    def async_decode(call):
+        if ATTR_FILENAME in call.data:
+            # Use WAV file
+            filename = call.data[ATTR_FILENAME]
+            with open(filename, 'rb') as wav_file:
+                data = wav_file.read()
+        else:
+            # Use data directly
+            filename = None
+            data = call.data[ATTR_DATA]
+            if isinstance(data, list):
+                data = bytes(data)  # from JSON
+
+        frames, rate, width, channels = parse_wav(data)
+        yield from async_decode_audio(frames, rate, width, channels,
+                                      wav_data=data, filename=filename)
 
     # -------------------------------------------------------------------------
 
     @asyncio.coroutine
     def async_reset(call):
-        nonlocal decoder
+        nonlocal sentences
         _LOGGER.debug('Reset decoder')
-        decoder = None  # will load dynamically
+        pool.load()  # reloads in the background
+
+        if sentences_path is not None:
+            # Training may have changed the sentences too
+            sentences = yield from hass.loop.run_in_executor(
+                None, load_sentences, sentences_path)
+
+        if current_state == STATE_IDLE:
+            set_state(STATE_LOADING)
 
     # -------------------------------------------------------------------------
 
-    hass.http.register_view(ExternalSpeechView)
+    @asyncio.coroutine
+    def async_decode_batch(call):
+        path = os.path.expanduser(call.data[ATTR_PATH])
+        output_path = os.path.expanduser(call.data[ATTR_OUTPUT])
+        processes = call.data.get(ATTR_PROCESSES)
+
+        def run_batch():
+            wav_paths = read_batch_paths(path)
+            _LOGGER.info('Decoding %s WAV file(s) from %s' % (len(wav_paths), path))
+            threshold = None
+            if decode_mode == DECODE_MODE_CASCADE:
+                threshold = cascade_threshold
+
+            return decode_batch(wav_paths, output_path, decoder_args,
+                                search=search, cascade_threshold=threshold,
+                                processes=processes)
+
+        summary = yield from async_run_thread(run_batch)
+        if (summary is not None) and not terminated:
+            _LOGGER.info('Batch decoded: %s' % summary)
+            hass.bus.async_fire(EVENT_BATCH_DECODED, dict(summary, **{
+                'name': name,  # name of the component
+                'output': output_path
+            }))
+
+    # -------------------------------------------------------------------------
+
+    hass.http.register_view(ExternalSpeechView(async_decode_audio,
+                                               max_sec=timeout_sec))
+    hass.http.register_view(StreamingSpeechView(start_streaming,
+                                                async_finish_streaming,
+                                                cancel_streaming,
+                                                async_decode_audio))
+    hass.http.register_view(WebSocketSpeechView(start_streaming,
+                                                async_finish_streaming,
+                                                cancel_streaming,
+                                                async_decode_audio,
+                                                max_sec=timeout_sec))
 
     # Service to record commands
-    hass.services.async_register(DOMAIN, SERVICE_LISTEN, async_listen)
+    hass.services.async_register(DOMAIN, SERVICE_LISTEN, async_listen,
+                                 schema=SCHEMA_SERVICE_LISTEN)
 
     # Service to do speech to text
     hass.services.async_register(DOMAIN, SERVICE_DECODE, async_decode,
@@ -477,7 +1610,13 @@ def async_setup(hass, config):
     # Service to reload decoder
     hass.services.async_register(DOMAIN, SERVICE_RESET, async_reset)
 
-    hass.states.async_set(OBJECT_POCKETSPHINX, STATE_IDLE, state_attrs)
+    # Service to decode many WAV files in parallel
+    hass.services.async_register(DOMAIN, SERVICE_DECODE_BATCH, async_decode_batch,
+                                 schema=SCHEMA_SERVICE_DECODE_BATCH)
+
+    # Start loading decoders
+    set_state(STATE_LOADING)
+    pool.load()
 
     # Make sure everything terminates property when home assistant stops
     @asyncio.coroutine
@@ -485,7 +1624,9 @@ def async_setup(hass, config):
         nonlocal terminated
         terminated = True
         recorded_event.set()
-        decoded_event.set()
+
+        for done_event in list(pending_events):
+            done_event.set()
 
     hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
 
@@ -502,14 +1643,352 @@ class ExternalSpeechView(HomeAssistantView):
     url = STT_API_ENDPOINT
     name = 'api:%s' % DOMAIN
 
+    def __init__(self, async_decode_audio, max_sec=None):
+        self._async_decode_audio = async_decode_audio
+        self._max_sec = max_sec  # longest compressed audio accepted
+
     async def post(self, request):
-        """Handle speech to text from POSTed WAV data."""
-        hass = request.app['hass']
-        data = await request.read()
+        """Handle speech to text from POSTed WAV, compressed, or raw PCM data.
 
+        Compressed audio comes from rhasspy_audio.encode_audio.
+        Responds with the decoded text as JSON.
+        """
+        data = await request.read()
         _LOGGER.debug("Received speech to text request: %s byte(s)", len(data))
 
-        await hass.services.async_call(DOMAIN, SERVICE_DECODE,
-                                       { ATTR_DATA: list(data) })
+        wav_data = None
+        try:
+            if data[:4] == b'RIFF':
+                # WAV data (frames are not copied)
+                wav_data = data
+                frames, rate, width, channels = parse_wav(data)
+            elif is_encoded_audio(data):
+                # Compressed by satellite. The header is checked first, so
+                # nothing is inflated for bad or overly long audio.
+                parse_codec_header(data, max_sec=self._max_sec)
+
+                # numpy/zlib work off the event loop
+                hass = request.app['hass']
+                frames, rate, width, channels = \
+                    await hass.loop.run_in_executor(
+                        None, decode_audio, data, self._max_sec)
+            else:
+                # Raw PCM data
+                frames = data
+                rate = int(request.query.get(PARAM_RATE, 16000))
+                width = int(request.query.get(PARAM_WIDTH, 2))
+                channels = int(request.query.get(PARAM_CHANNELS, 1))
+
+            check_audio_format(rate, width, channels)
+        except ValueError as e:
+            return self.json_message(str(e), HTTP_BAD_REQUEST)
+
+        text = await self._async_decode_audio(frames, rate, width, channels,
+                                              wav_data=wav_data)
+
+        return self.json({ 'text': text })
+
+# -----------------------------------------------------------------------------
+
+class StreamingSpeechView(HomeAssistantView):
+    """Handle speech to text requests with audio streamed via HTTP."""
+
+    url = STT_STREAM_API_ENDPOINT
+    name = 'api:%s:stream' % DOMAIN
+
+    def __init__(self, start_streaming, async_finish_streaming,
+                 cancel_streaming, async_decode_audio):
+        self._start_streaming = start_streaming
+        self._async_finish_streaming = async_finish_streaming
+        self._cancel_streaming = cancel_streaming
+        self._async_decode_audio = async_decode_audio
+
+    async def post(self, request):
+        """Handle speech to text from WAV or raw PCM data sent in chunks.
+
+        Responds with the decoded text as JSON.
+        """
+        header = bytearray()  # start of data until format is known
+        audio_format = None
+        streamer = None
+        pending = bytearray()  # unconverted audio
+        num_bytes = 0
+
+        try:
+            async for chunk in request.content.iter_any():
+                num_bytes += len(chunk)
+                if audio_format is None:
+                    # Determine audio format
+                    header += chunk
+                    if len(header) < 4:
+                        continue
+
+                    if header[:4] == b'RIFF':
+                        wav_header = parse_wav_header(header)
+                        if wav_header is None:
+                            continue  # need more data
+
+                        offset, _, rate, width, channels = wav_header
+                        chunk = bytes(header[offset:])
+                    else:
+                        rate = int(request.query.get(PARAM_RATE, 16000))
+                        width = int(request.query.get(PARAM_WIDTH, 2))
+                        channels = int(request.query.get(PARAM_CHANNELS, 1))
+                        chunk = bytes(header)
+
+                    check_audio_format(rate, width, channels)
+                    header = None
+                    audio_format = (rate, width, channels)
+                    if audio_format == (16000, 2, 1):
+                        streamer = self._start_streaming()
+                    else:
+                        _LOGGER.debug('Audio will be converted after upload: rate=%s, width=%s, channels=%s' % audio_format)
+
+                if streamer is not None:
+                    streamer.feed(chunk)
+                else:
+                    pending += chunk
+
+            _LOGGER.debug("Received streaming speech to text request: %s byte(s)", num_bytes)
+
+            if streamer is not None:
+                text = await self._async_finish_streaming(streamer)
+                streamer = None
+            elif audio_format is not None:
+                text = await self._async_decode_audio(pending, *audio_format)
+            else:
+                return self.json_message('No audio data', HTTP_BAD_REQUEST)
+        except ValueError as e:
+            return self.json_message(str(e), HTTP_BAD_REQUEST)
+        finally:
+            if streamer is not None:
+                # Rejected, or the client went away during the upload. No
+                # speech_to_text event is fired.
+                self._cancel_streaming(streamer)
+
+        return self.json({ 'text': text })
+
+# -----------------------------------------------------------------------------
+
+class WebSocketSpeechView(HomeAssistantView):
+    """Handle speech to text sessions over a WebSocket."""
+
+    url = STT_WEBSOCKET_API_ENDPOINT
+    name = 'api:%s:websocket' % DOMAIN
+
+    def __init__(self, start_streaming, async_finish_streaming,
+                 cancel_streaming, async_decode_audio, max_sec):
+        self._start_streaming = start_streaming
+        self._async_finish_streaming = async_finish_streaming
+        self._cancel_streaming = cancel_streaming
+        self._async_decode_audio = async_decode_audio
+
+        # Longest utterance in seconds of audio. The utterance is also
+        # cancelled if it takes twice as long to send.
+        self._max_sec = max_sec
+
+    async def get(self, request):
+        """Handle a session with any number of utterances."""
+        from aiohttp import web, WSMsgType
+
+        hass = request.app['hass']
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        # All messages are sent from a single task to keep them in order
+        outgoing = asyncio.Queue()
+
+        async def send_messages():
+            while True:
+                message = await outgoing.get()
+                if message is None:
+                    break
+
+                try:
+                    await ws.send_json(message)
+                except (RuntimeError, ConnectionError):
+                    break  # socket closed
+
+        sender = hass.loop.create_task(send_messages())
+
+        def send_error(message):
+            outgoing.put_nowait({ 'type': WS_TYPE_ERROR, 'message': message })
+
+        def send_partial(text):
+            # Called from the decoding thread
+            hass.loop.call_soon_threadsafe(
+                outgoing.put_nowait, { 'type': WS_TYPE_PARTIAL, 'text': text })
+
+        audio_format = None  # set between start/end
+        streamer = None
+        pending = bytearray()  # unconverted audio
+        num_bytes = 0          # audio in the utterance
+        max_bytes = 0
+        deadline = None        # time when the utterance is cancelled
+
+        def cancel_utterance(reason):
+            nonlocal audio_format, streamer, pending
+            if streamer is not None:
+                self._cancel_streaming(streamer)
+                streamer = None
+
+            audio_format = None
+            pending = bytearray()
+            send_error(reason)
+
+        try:
+            while True:
+                timeout = None
+                if audio_format is not None:
+                    timeout = max(0, min(WS_IDLE_TIMEOUT_SEC,
+                                         deadline - time.time()))
+
+                try:
+                    msg = await ws.receive(timeout=timeout)
+                except asyncio.TimeoutError:
+                    cancel_utterance('Utterance timed out')
+                    continue
+
+                if msg.type in [WSMsgType.CLOSE, WSMsgType.CLOSING,
+                                WSMsgType.CLOSED]:
+                    break
+
+                if msg.type == WSMsgType.BINARY:
+                    if audio_format is not None:
+                        num_bytes += len(msg.data)
+
+                    if audio_format is None:
+                        send_error('Audio received before start')
+                    elif num_bytes > max_bytes:
+                        cancel_utterance('Utterance is longer than %s second(s)' % \
+                                         self._max_sec)
+                    elif streamer is not None:
+                        try:
+                            streamer.feed(msg.data)
+                        except queue.Full:
+                            # Stop reading from the socket until the decoder
+                            # catches up.
+                            await hass.loop.run_in_executor(
+                                None, streamer.feed_wait, msg.data)
+                    else:
+                        pending += msg.data
+                elif msg.type == WSMsgType.TEXT:
+                    try:
+                        message = json.loads(msg.data)
+                        message_type = message.get('type')
+                    except (ValueError, AttributeError):
+                        send_error('Invalid message')
+                        continue
+
+                    if message_type == WS_TYPE_START:
+                        if audio_format is not None:
+                            send_error('Utterance already started')
+                            continue
+
+                        try:
+                            audio_format = (int(message.get('rate', 16000)),
+                                            int(message.get('width', 2)),
+                                            int(message.get('channels', 1)))
+                            check_audio_format(*audio_format)
+                        except (TypeError, ValueError) as e:
+                            audio_format = None
+                            send_error('Invalid audio format: %s' % e)
+                            continue
+
+                        rate, width, channels = audio_format
+                        num_bytes = 0
+                        max_bytes = int(self._max_sec * rate) * width * channels
+                        deadline = time.time() + (2 * self._max_sec)
+
+                        if audio_format == (16000, 2, 1):
+                            on_partial = None
+                            if message.get('partial', False):
+                                on_partial = send_partial
+
+                            streamer = self._start_streaming(
+                                on_partial=on_partial,
+                                max_chunks=WS_MAX_QUEUED_CHUNKS)
+                    elif message_type == WS_TYPE_END:
+                        if audio_format is None:
+                            send_error('Utterance not started')
+                            continue
+
+                        if streamer is not None:
+                            text = await self._async_finish_streaming(streamer)
+                            streamer = None
+                        else:
+                            text = await self._async_decode_audio(
+                                bytes(pending), *audio_format)
+
+                        outgoing.put_nowait({ 'type': WS_TYPE_FINAL, 'text': text })
+                        audio_format = None
+                        pending = bytearray()
+                    else:
+                        send_error('Unknown message type: %s' % message_type)
+                elif msg.type == WSMsgType.ERROR:
+                    _LOGGER.warning('WebSocket error: %s' % ws.exception())
+                    break
+        finally:
+            if streamer is not None:
+                # Disconnected during an utterance
+                self._cancel_streaming(streamer)
+
+            outgoing.put_nowait(None)
+            await sender
+
+        return ws
+
+# -----------------------------------------------------------------------------
+
+def main():
+    """Decodes a batch of WAV files from the command line.
+
+    Run from your Home Assistant configuration directory with:
+    python3 -m custom_components.stt_pocketsphinx <PATH> <OUTPUT>
+    """
+    parser = argparse.ArgumentParser(
+        description='Decode WAV files with pocketsphinx in parallel')
+    parser.add_argument('path',
+                        help='Directory with WAV files or manifest file')
+    parser.add_argument('output', help='File to write JSON lines to')
+    parser.add_argument('--acoustic-model', default=DEFAULT_ACOUSTIC_MODEL)
+    parser.add_argument('--language-model', default=DEFAULT_LANGUAGE_MODEL)
+    parser.add_argument('--dictionary', default=DEFAULT_DICTIONARY)
+    parser.add_argument('--grammar', default=DEFAULT_GRAMMAR,
+                        help='JSGF grammar (used instead of language model)')
+    parser.add_argument('--cascade-threshold', type=float, default=None,
+                        help='Decode with grammar first, and with language model if confidence is below this')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of worker processes (default: CPU count)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    decoder_args = {
+        'acoustic_model': os.path.expanduser(args.acoustic_model),
+        'dictionary': os.path.expanduser(args.dictionary)
+    }
 
-        return 'OK'
+    if args.grammar is not None:
+        decoder_args['grammar'] = os.path.expanduser(args.grammar)
+        search = SEARCH_GRAMMAR
+        if args.cascade_threshold is not None:
+            decoder_args['language_model'] = os.path.expanduser(args.language_model)
+    else:
+        if args.cascade_threshold is not None:
+            parser.error('--cascade-threshold requires --grammar')
+
+        decoder_args['language_model'] = os.path.expanduser(args.language_model)
+        search = SEARCH_LM
+
+    wav_paths = read_batch_paths(os.path.expanduser(args.path))
+    _LOGGER.info('Decoding %s WAV file(s)' % len(wav_paths))
+
+    summary = decode_batch(wav_paths, args.output, decoder_args,
+                           search=search,
+                           cascade_threshold=args.cascade_threshold,
+                           processes=args.processes)
+    print(json.dumps(summary), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
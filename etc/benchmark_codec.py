@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Compares lossless compression of recorded commands (size vs. CPU time).
+
+Each WAV file is compressed with the rhasspy_audio codec at different
+prediction orders, plain zlib/bz2/lzma, and FLAC (if the flac program is
+installed). Every method is checked to decode back to the original audio.
+
+Usage: benchmark_codec.py [--repeat 10] [WAV_FILE ...]
+"""
+import os
+import sys
+import bz2
+import lzma
+import time
+import zlib
+import shutil
+import argparse
+import subprocess
+
+import numpy as np
+
+ETC_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ETC_DIR, '..', 'config', 'custom_components'))
+
+from rhasspy_audio import encode_audio, decode_audio, parse_wav, make_wav
+
+def codec(order):
+    def encode(frames, rate, width, channels):
+        return encode_audio(frames, rate, width, channels, order=order)
+
+    def decode(data):
+        return decode_audio(data)[0]
+
+    return encode, decode
+
+def stdlib(module):
+    def encode(frames, rate, width, channels):
+        return module.compress(frames)
+
+    return encode, module.decompress
+
+def flac():
+    def encode(frames, rate, width, channels):
+        return subprocess.run(['flac', '--silent', '--best', '-c', '-'],
+                              input=make_wav(frames, rate, width, channels),
+                              stdout=subprocess.PIPE, check=True).stdout
+
+    def decode(data):
+        wav_data = subprocess.run(['flac', '--silent', '-d', '-c', '-'],
+                                  input=data, stdout=subprocess.PIPE,
+                                  check=True).stdout
+        return bytes(parse_wav(wav_data)[0])
+
+    return encode, decode
+
+def time_call(func, args, repeat):
+    times = []
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start_time)
+
+    return result, np.median(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of times to time each method')
+    parser.add_argument('wav_files', nargs='*',
+                        help='WAV files to compress (default: etc/wav)')
+    args = parser.parse_args()
+
+    wav_files = args.wav_files
+    if len(wav_files) == 0:
+        wav_dir = os.path.join(ETC_DIR, 'wav')
+        wav_files = [os.path.join(wav_dir, name)
+                     for name in sorted(os.listdir(wav_dir))
+                     if name.endswith('.wav')]
+
+    methods = [('delta1', codec(1)),
+               ('delta2', codec(2)),
+               ('delta3', codec(3)),
+               ('zlib', stdlib(zlib)),
+               ('bz2', stdlib(bz2)),
+               ('lzma', stdlib(lzma))]
+
+    if shutil.which('flac') is not None:
+        methods.append(('flac', flac()))
+    else:
+        print("'flac' not found. Skipping.")
+
+    totals = { name: [0, 0.0, 0.0] for name, _ in methods }
+    total_bytes = 0
+
+    print('')
+    print('%-28s %-8s %8s %7s %8s %8s' % ('file', 'method', 'bytes', 'ratio',
+                                         'enc ms', 'dec ms'))
+    print('-' * 72)
+
+    for wav_path in wav_files:
+        with open(wav_path, 'rb') as wav_file:
+            frames, rate, width, channels = parse_wav(wav_file.read())
+            frames = bytes(frames)
+
+        total_bytes += len(frames)
+        for name, (encode, decode) in methods:
+            encoded, encode_sec = time_call(encode, (frames, rate, width, channels),
+                                            args.repeat)
+            decoded, decode_sec = time_call(decode, (encoded,), args.repeat)
+            assert bytes(decoded) == frames, '%s is not lossless' % name
+
+            totals[name][0] += len(encoded)
+            totals[name][1] += encode_sec
+            totals[name][2] += decode_sec
+
+            print('%-28s %-8s %8d %7.3f %8.2f %8.2f' % (
+                os.path.basename(wav_path), name, len(encoded),
+                len(encoded) / len(frames), encode_sec * 1000, decode_sec * 1000))
+
+    print('-' * 72)
+    for name, (num_bytes, encode_sec, decode_sec) in totals.items():
+        print('%-28s %-8s %8d %7.3f %8.2f %8.2f' % (
+            'TOTAL', name, num_bytes, num_bytes / total_bytes,
+            encode_sec * 1000, decode_sec * 1000))
+
+    print('')
+
+if __name__ == '__main__':
+    main()
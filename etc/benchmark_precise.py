@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Compares CPU use of the precise-engine process and the in-process backend.
+
+The same audio is scored by both backends one chunk at a time (like
+PreciseRunner does). CPU time is measured after the model is loaded and is
+scaled to one hour of audio. The precise-engine process's CPU time is read
+from /proc, so this only works on Linux.
+
+When precise-engine is installed, the backends' predictions are also
+compared. The exit status is 1 if they differ by more than --tolerance, so
+this doubles as a check that the in-process MFCCs match sonopy's.
+
+Usage: benchmark_precise.py --model okay-rhasspy.pb [--seconds 300]
+                            [--tolerance 0.01] [WAV_FILE ...]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+
+import numpy as np
+
+ETC_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ETC_DIR, '..', 'config', 'custom_components'))
+
+from rhasspy_audio import parse_wav, convert_audio, \
+    PreciseInProcessEngine, PRECISE_CHUNK_SIZE
+
+def process_cpu_sec(pid):
+    """Returns user + system CPU seconds of a process (Linux only)."""
+    with open('/proc/%s/stat' % pid, 'r') as stat_file:
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+
+    # utime and stime are fields 14 and 15 (counting from 1)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def load_audio(wav_files, seconds):
+    """Loads 16-bit 16Khz mono audio, repeating the files to fill seconds."""
+    audio = bytearray()
+    for wav_path in wav_files:
+        with open(wav_path, 'rb') as wav_file:
+            frames, rate, width, channels = parse_wav(wav_file.read())
+            audio += convert_audio(frames, rate, width, channels)
+
+    num_bytes = int(seconds * 16000) * 2
+    repeats = 1 + (num_bytes // max(1, len(audio)))
+    return bytes(audio * repeats)[:num_bytes]
+
+def run_engine(engine, chunks, get_cpu_sec):
+    engine.start()
+    try:
+        engine.get_prediction(chunks[0])  # wait for model to load
+
+        start_cpu = get_cpu_sec()
+        start_time = time.perf_counter()
+        predictions = [engine.get_prediction(chunk) for chunk in chunks]
+        wall_sec = time.perf_counter() - start_time
+        cpu_sec = get_cpu_sec() - start_cpu
+    finally:
+        engine.stop()
+
+    return np.array(predictions), cpu_sec, wall_sec
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True,
+                        help='Path to precise model (.pb)')
+    parser.add_argument('--seconds', type=float, default=300,
+                        help='Seconds of audio to score')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='Largest allowed difference between predictions')
+    parser.add_argument('wav_files', nargs='*',
+                        help='WAV files to score (default: etc/wav)')
+    args = parser.parse_args()
+
+    wav_files = args.wav_files
+    if len(wav_files) == 0:
+        wav_dir = os.path.join(ETC_DIR, 'wav')
+        wav_files = [os.path.join(wav_dir, name)
+                     for name in sorted(os.listdir(wav_dir))
+                     if name.endswith('.wav')]
+
+    audio = load_audio(wav_files, args.seconds)
+    chunks = [audio[i:i + PRECISE_CHUNK_SIZE]
+              for i in range(0, len(audio) - PRECISE_CHUNK_SIZE + 1,
+                             PRECISE_CHUNK_SIZE)]
+    audio_sec = (len(chunks) * PRECISE_CHUNK_SIZE) / (16000 * 2)
+
+    results = []
+
+    if shutil.which('precise-engine') is not None:
+        from precise_runner import PreciseEngine
+        engine = PreciseEngine('precise-engine', args.model,
+                               chunk_size=PRECISE_CHUNK_SIZE)
+
+        def engine_cpu_sec():
+            # This process (piping audio) + precise-engine process
+            return time.process_time() + process_cpu_sec(engine.proc.pid)
+
+        results.append(('engine',) + run_engine(engine, chunks, engine_cpu_sec))
+    else:
+        print("'precise-engine' not found. Skipping.")
+
+    engine = PreciseInProcessEngine(args.model)
+    results.append(('tensorflow',) + run_engine(engine, chunks, time.process_time))
+
+    print('')
+    print('%.1f second(s) of audio in %s chunk(s)' % (audio_sec, len(chunks)))
+    print('')
+    print('%-12s %12s %10s %8s' % ('backend', 'cpu sec/hr', 'ms/chunk', 'rtf'))
+    print('-' * 45)
+    for name, predictions, cpu_sec, wall_sec in results:
+        print('%-12s %12.1f %10.2f %8.4f' % (
+            name, cpu_sec * (3600 / audio_sec),
+            (wall_sec / len(chunks)) * 1000, wall_sec / audio_sec))
+
+    agree = True
+    if len(results) > 1:
+        # Backends should agree (same features and model)
+        difference = np.abs(results[0][1] - results[1][1]).max()
+        agree = difference <= args.tolerance
+        print('')
+        print('Max prediction difference: %.4f (%s)' % \
+              (difference, 'OK' if agree else 'FAILED'))
+
+    print('')
+    return 0 if agree else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Compares in-memory (numpy) and sox conversion to 16-bit 16Khz mono.
+
+Test signals are sums of sine waves, so the ideal 16Khz output can be computed
+exactly and used to measure quality (signal-to-noise ratio in dB).
+
+Usage: benchmark_resample.py [--seconds 5] [--repeat 10]
+"""
+import os
+import sys
+import io
+import time
+import wave
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'config', 'custom_components'))
+
+from rhasspy_audio import convert_audio
+
+# Frequencies (Hz) of test tones. All are below 8Khz (16Khz Nyquist).
+FREQUENCIES = [220, 1000, 3000, 6000, 7000]
+
+# (rate, channels) pairs commonly sent by satellites
+FORMATS = [(8000, 1), (22050, 1), (44100, 2), (48000, 2)]
+
+# Seconds to ignore at the start/end of the output (filter edge effects)
+EDGE_SEC = 0.1
+
+def make_signal(rate, seconds):
+    t = np.arange(int(rate * seconds)) / rate
+    nyquist = rate / 2
+    freqs = [f for f in FREQUENCIES if f < nyquist * 0.9]
+    amplitude = 20000 / len(freqs)
+    return freqs, sum(amplitude * np.sin(2 * np.pi * f * t) for f in freqs), amplitude
+
+def to_pcm(signal, channels):
+    # Right channel is quieter, so downmixing is checked too
+    if channels == 2:
+        signal = np.stack([signal, 0.5 * signal], axis=1)
+
+    return np.round(signal).astype('<i2').tobytes()
+
+def reference(freqs, amplitude, channels, num_samples):
+    t = np.arange(num_samples) / 16000
+    gain = 0.75 if channels == 2 else 1.0
+    return sum(gain * amplitude * np.sin(2 * np.pi * f * t)
+               for f in freqs if f < 8000 * 0.9)
+
+def snr_db(output, expected):
+    edge = int(EDGE_SEC * 16000)
+    output, expected = output[edge:-edge], expected[edge:-edge]
+    noise = np.sum((output - expected) ** 2)
+    return 10 * np.log10(np.sum(expected ** 2) / max(noise, 1e-12))
+
+def convert_sox(wav_data):
+    # Same steps as stt_pocketsphinx.convert_wav_sox
+    with tempfile.NamedTemporaryFile(suffix='.wav', mode='wb+') as in_file:
+        in_file.write(wav_data)
+        in_file.flush()
+        with tempfile.NamedTemporaryFile(suffix='.wav', mode='wb+') as out_file:
+            subprocess.check_call(['sox', in_file.name,
+                                   '-r', '16000', '-e', 'signed-integer',
+                                   '-b', '16', '-c', '1', out_file.name])
+            out_file.seek(0)
+            with wave.open(out_file, 'rb') as wav_file:
+                return wav_file.readframes(wav_file.getnframes())
+
+def convert_numpy(wav_data):
+    # Same steps as stt_pocketsphinx.async_decode_audio (convert_audio with
+    # the default numpy resampler)
+    with io.BytesIO(wav_data) as wav_io:
+        with wave.open(wav_io, 'rb') as wav_file:
+            rate, width, channels = wav_file.getframerate(), wav_file.getsampwidth(), wav_file.getnchannels()
+            frames = wav_file.readframes(wav_file.getnframes())
+
+    return convert_audio(frames, rate, width, channels)
+
+def time_convert(convert, wav_data, repeat):
+    times = []
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        output = convert(wav_data)
+        times.append(time.perf_counter() - start_time)
+
+    return output, np.median(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=5.0,
+                        help='Length of test signal')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of times to time each conversion')
+    args = parser.parse_args()
+
+    converters = [('numpy', convert_numpy)]
+    if shutil.which('sox') is not None:
+        converters.append(('sox', convert_sox))
+    else:
+        print("'sox' not found. Only benchmarking numpy.")
+
+    print('')
+    print('%-8s %-14s %10s %10s' % ('method', 'format', 'ms', 'SNR (dB)'))
+    print('-' * 45)
+
+    for rate, channels in FORMATS:
+        freqs, signal, amplitude = make_signal(rate, args.seconds)
+
+        with io.BytesIO() as wav_io:
+            with wave.open(wav_io, 'wb') as wav_file:
+                wav_file.setframerate(rate)
+                wav_file.setsampwidth(2)
+                wav_file.setnchannels(channels)
+                wav_file.writeframes(to_pcm(signal, channels))
+
+            wav_data = wav_io.getvalue()
+
+        for method, convert in converters:
+            output, seconds = time_convert(convert, wav_data, args.repeat)
+            output = np.frombuffer(output, dtype='<i2').astype(np.float64)
+            expected = reference(freqs, amplitude, channels, len(output))
+
+            audio_format = '%sHz/%sch' % (rate, channels)
+            print('%-8s %-14s %10.2f %10.1f' % (method, audio_format,
+                                               seconds * 1000,
+                                               snr_db(output, expected)))
+
+    print('')
+
+if __name__ == '__main__':
+    main()